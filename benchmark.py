@@ -0,0 +1,1215 @@
+#benchmarks for the heavy steps of the bot, run against synthetic data so they never touch the live datasets
+#usage: python benchmark.py retention --visits 10000000
+import argparse
+import asyncio
+import contextlib
+import functools
+import io
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+import numpy as np
+import pandas as pd
+import psutil
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+import dataset_cache
+import fetch_data_latest_commit
+import granular
+import rollups
+from retention import retention_tables
+from synthetic import (STATES, DONATIONS_COLUMNS, NEWDONORS_COLUMNS, make_granular_data, write_granular_parquet,
+                       make_state_data, to_csv_bytes, MockDataServer, pointed_at, FakeBotAPIServer, FakeBot,
+                       make_report_workspace, report_module, run_streaming_job)
+
+#===============Reference implementations==============
+
+def legacy_retention_table(data, donated_min_x_times):
+    """
+    The original nested-loop retention table, kept only as the benchmark baseline.
+    """
+    data['visit_date'] = pd.to_datetime(data['visit_date'])
+    data['visit_year'] = data['visit_date'].dt.year
+
+    min_year = data['visit_year'].min()
+    max_year = data['visit_year'].max()
+
+    donor_yearly_counts = data.groupby(['donor_id', 'visit_year']).size().reset_index(name='donation_count')
+    repeating_donors = donor_yearly_counts[donor_yearly_counts['donation_count'] >= donated_min_x_times]
+    percentage_data = pd.DataFrame(index=range(min_year, max_year + 1), columns=range(max_year - min_year + 1))
+
+    for first_year in range(min_year, max_year + 1):
+        first_year_donors = repeating_donors[repeating_donors['visit_year'] == first_year]['donor_id']
+
+        for N in range(max_year - first_year + 1):
+            current_year = first_year + N
+            still_donating_count = donor_yearly_counts[(donor_yearly_counts['visit_year'] == current_year) &
+                (donor_yearly_counts['donor_id'].isin(first_year_donors))]['donor_id'].nunique()
+
+            if len(first_year_donors) > 0:
+                percentage = round((still_donating_count / len(first_year_donors)) * 100)
+            else:
+                percentage = 0
+            percentage_data.at[first_year, N] = percentage
+
+    return percentage_data.fillna(0)
+
+#===============Benchmarks==============
+
+def bench_retention(args):
+    thresholds = [1, 3, 6]
+    print(f"generating {args.visits:,} synthetic visits..")
+    data = make_granular_data(args.visits)
+    print(f"rows: {len(data):,}, donors: {data['donor_id'].nunique():,}")
+
+    start = time.perf_counter()
+    tables = retention_tables(granular.from_frame(data), thresholds)
+    engine_time = time.perf_counter() - start
+    print(f"cohort engine ({len(thresholds)} thresholds): {engine_time:.2f}s")
+
+    if args.skip_legacy:
+        return
+
+    start = time.perf_counter()
+    legacy = {x: legacy_retention_table(data.copy(), x) for x in thresholds}
+    legacy_time = time.perf_counter() - start
+    print(f"nested loop ({len(thresholds)} thresholds): {legacy_time:.2f}s")
+    print(f"speedup: {legacy_time / engine_time:.1f}x")
+
+    for x in thresholds:
+        if not (legacy[x].astype(int).values == tables[x].values).all():
+            raise SystemExit(f"mismatch for donated_min_x_times={x}")
+    print("results identical")
+
+def bench_sync(args):
+    today = datetime.now().date()
+    start_date = today - timedelta(days=365 * args.years)
+    donations = make_state_data(DONATIONS_COLUMNS, start_date, today, seed=1)
+    newdonors = make_state_data(NEWDONORS_COLUMNS, start_date, today, seed=2)
+    granular = io.BytesIO()
+    make_granular_data(args.visits).to_parquet(granular)
+
+    #the day before: everything up to yesterday
+    yesterday = today.strftime('%Y-%m-%d') > donations['date']
+    day_before = {'donations_state.csv': to_csv_bytes(donations[yesterday]),
+                  'newdonors_state.csv': to_csv_bytes(newdonors[yesterday])}
+    #a typical daily update: one new date row per state in each CSV, granular parquet unchanged
+    daily_update = {'donations_state.csv': to_csv_bytes(donations),
+                    'newdonors_state.csv': to_csv_bytes(newdonors)}
+
+    with MockDataServer(bandwidth=args.bandwidth * 1e6) as server:
+        server.files['/granular'] = granular.getvalue()
+        results = {}
+        for mode, full in [('full re-download', True), ('incremental sync', False)]:
+            with tempfile.TemporaryDirectory() as workdir, pointed_at(server, workdir):
+                server.publish(day_before)
+                fetch_data_latest_commit.main(full=full)
+
+                server.publish(daily_update)
+                server.reset_counters()
+                start = time.perf_counter()
+                fetch_data_latest_commit.main(full=full)
+                results[mode] = (time.perf_counter() - start, server.bytes_sent, server.requests)
+
+                synced = pd.read_csv(os.path.join(fetch_data_latest_commit.CSV_FOLDER, 'donations_state.csv'))
+                if len(synced) != len(donations):
+                    raise SystemExit(f"{mode}: expected {len(donations)} rows, got {len(synced)}")
+
+    print(f"daily update of {len(day_before)} CSVs ({args.years} years) + {len(granular.getvalue()) / 1e6:.1f}MB granular parquet")
+    for mode, (elapsed, bytes_sent, n_requests) in results.items():
+        print(f"{mode}: {elapsed:.3f}s, {bytes_sent / 1e6:.2f}MB transferred, {n_requests} requests")
+
+def download(url, filepath):
+    async def run():
+        async with fetch_data_latest_commit.make_client() as client:
+            return await fetch_data_latest_commit.stream_download(client, url, filepath)
+    return asyncio.run(run())
+
+def bench_fetch(args):
+    today = datetime.now().date()
+    start_date = today - timedelta(days=365 * args.years)
+    #the CSVs an upstream commit touches: the two the report reads, and others like them
+    columns = [DONATIONS_COLUMNS, NEWDONORS_COLUMNS] + [NEWDONORS_COLUMNS] * (args.files - 2)
+    names = ['donations_state.csv', 'newdonors_state.csv'] + [f'dataset_{i}.csv' for i in range(args.files - 2)]
+    datasets = {name: make_state_data(cols, start_date, today, seed=i) for i, (name, cols) in enumerate(zip(names, columns))}
+    yesterday = today.strftime('%Y-%m-%d')
+    day_before = {name: to_csv_bytes(data[data['date'] < yesterday]) for name, data in datasets.items()}
+    daily_update = {name: to_csv_bytes(data) for name, data in datasets.items()}
+    granular = [io.BytesIO(), io.BytesIO()]
+    make_granular_data(args.visits).to_parquet(granular[0])
+    make_granular_data(args.visits + 1000).to_parquet(granular[1])
+
+    results = {}
+    with MockDataServer(bandwidth=args.bandwidth * 1e6, latency=args.latency) as server:
+        for mode, cap in [('one file at a time', 1), (f'{args.concurrency} at a time', args.concurrency)]:
+            old_cap, fetch_data_latest_commit.MAX_DOWNLOADS = fetch_data_latest_commit.MAX_DOWNLOADS, cap
+            try:
+                with tempfile.TemporaryDirectory() as workdir, pointed_at(server, workdir):
+                    server.files['/granular'] = granular[0].getvalue()
+                    server.publish(day_before)
+                    fetch_data_latest_commit.main()
+
+                    #a new commit touching every CSV, and a new granular parquet
+                    server.files['/granular'] = granular[1].getvalue()
+                    server.publish(daily_update)
+                    server.reset_counters()
+                    start = time.perf_counter()
+                    fetch_data_latest_commit.main()
+                    results[mode] = (time.perf_counter() - start, server.requests, server.api_calls)
+
+                    #the hourly polls that follow, with nothing new upstream
+                    polls = {}
+                    for poll, conditional in [('unconditional poll', False), ('conditional poll', True)]:
+                        if not conditional:
+                            manifest = fetch_data_latest_commit.load_manifest()
+                            manifest['api'] = {}
+                            fetch_data_latest_commit.save_manifest(manifest)
+                        server.reset_counters()
+                        fetch_data_latest_commit.main()
+                        polls[poll] = (server.api_calls, server.api_not_modified)
+                    synced = pd.read_csv(os.path.join(fetch_data_latest_commit.CSV_FOLDER, 'donations_state.csv'))
+                    if len(synced) != len(datasets['donations_state.csv']):
+                        raise SystemExit(f"{mode}: expected {len(datasets['donations_state.csv'])} rows, got {len(synced)}")
+            finally:
+                fetch_data_latest_commit.MAX_DOWNLOADS = old_cap
+
+    print(f"new commit touching {args.files} CSVs ({args.years} years) + a new {len(granular[1].getvalue()) / 1e6:.1f}MB granular parquet, "
+          f"{args.latency * 1000:.0f}ms latency, {args.bandwidth:.0f}MB/s per connection")
+    for mode, (elapsed, n_requests, api_calls) in results.items():
+        print(f"{mode}: {elapsed:.2f}s, {n_requests} requests ({api_calls} rate-limited API calls)")
+    for poll, (api_calls, not_modified) in polls.items():
+        print(f"{poll} with nothing new: {api_calls} rate-limited API calls, {not_modified} free 304s")
+
+def bench_download(args):
+    size = int(args.size_mb * 1e6)
+    payload = np.random.default_rng(0).bytes(size)
+
+    with MockDataServer() as server, tempfile.TemporaryDirectory() as workdir:
+        server.files['/granular'] = payload
+        filepath = os.path.join(workdir, 'ds-data-granular')
+        process = psutil.Process()
+
+        rss_before = process.memory_info().rss
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            download(f'{server.url}/granular', filepath)
+        elapsed = time.perf_counter() - start
+        rss_growth = process.memory_info().rss - rss_before
+        print(f"streamed {size / 1e6:.0f}MB in {elapsed:.2f}s, RSS grew by {rss_growth / 1e6:.1f}MB")
+
+        #cut the connection twice mid-transfer; the download should resume instead of starting over
+        os.remove(filepath)
+        server.drop_after, server.drops_left = size // 3, 2
+        server.reset_counters()
+        old_backoff, fetch_data_latest_commit.BACKOFF_SECONDS = fetch_data_latest_commit.BACKOFF_SECONDS, 0
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                download(f'{server.url}/granular', filepath)
+        finally:
+            fetch_data_latest_commit.BACKOFF_SECONDS = old_backoff
+        with open(filepath, 'rb') as file:
+            intact = file.read() == payload
+        print(f"with 2 dropped connections: {server.requests} requests, {server.bytes_sent / 1e6:.0f}MB sent, "
+              f"file {'intact' if intact else 'CORRUPT'}")
+        if not intact:
+            raise SystemExit(1)
+
+def bench_cache(args):
+    end_date = pd.Timestamp('2006-01-01') + pd.DateOffset(years=args.years)
+    datasets = {'donations_state': (DONATIONS_COLUMNS, ['date', 'state', 'daily']),
+                'newdonors_state': (NEWDONORS_COLUMNS, ['date', 'state', 'total'])}
+
+    with tempfile.TemporaryDirectory() as workdir:
+        old_cwd = os.getcwd()
+        os.chdir(workdir)
+        try:
+            for name, (columns, _) in datasets.items():
+                make_state_data(columns, '2006-01-01', end_date).to_csv(f'{name}.csv', index=False)
+            rows = sum(1 for _ in open('donations_state.csv')) - 1
+
+            def timed(load):
+                start = time.perf_counter()
+                for name, (_, used_columns) in datasets.items():
+                    load(f'{name}.csv', used_columns)
+                return time.perf_counter() - start
+
+            csv_time = timed(lambda path, columns: pd.read_csv(path))
+            cold_time = timed(dataset_cache.load_dataset)
+            warm_time = min(timed(dataset_cache.load_dataset) for _ in range(5))
+        finally:
+            os.chdir(old_cwd)
+
+    print(f"{len(datasets)} datasets, {args.years} years, {rows:,} rows each")
+    print(f"pd.read_csv (all columns): {csv_time * 1000:.0f}ms")
+    print(f"cache cold start (parse + write): {cold_time * 1000:.0f}ms")
+    print(f"cache warm start (memory-mapped, used columns only): {warm_time * 1000:.0f}ms")
+
+def bench_rollups(args):
+    print("report inputs: raw group-bys over the cached CSVs vs reading the rollups")
+    for years in args.years:
+        end_date = pd.Timestamp('2006-01-01') + pd.DateOffset(years=years)
+        with tempfile.TemporaryDirectory() as workdir:
+            old_cwd = os.getcwd()
+            os.chdir(workdir)
+            try:
+                make_state_data(DONATIONS_COLUMNS, '2006-01-01', end_date).to_csv('donations_state.csv', index=False)
+                make_state_data(NEWDONORS_COLUMNS, '2006-01-01', end_date).to_csv('newdonors_state.csv', index=False)
+                with contextlib.redirect_stdout(io.StringIO()):
+                    rollups.update_all('.')
+
+                start = time.perf_counter()
+                donations = dataset_cache.load_dataset('donations_state.csv', columns=['date', 'state', 'daily'])
+                newdonors = dataset_cache.load_dataset('newdonors_state.csv', columns=['date', 'state', 'total'])
+                donations.groupby(['state', donations['date'].dt.to_period('M')], observed=True)['daily'].sum()
+                donations.groupby(['state', donations['date'].dt.year], observed=True)['daily'].sum()
+                newdonors.groupby(['state', newdonors['date'].dt.year], observed=True)['total'].sum()
+                donations[donations['date'] == donations['date'].max()]
+                raw_time = time.perf_counter() - start
+
+                start = time.perf_counter()
+                for dataset, grain in [('donations_state', 'latest'), ('donations_state', 'monthly'),
+                                       ('donations_state', 'yearly'), ('newdonors_state', 'yearly')]:
+                    rollups.load_rollup(dataset, grain)
+                rollup_time = time.perf_counter() - start
+            finally:
+                os.chdir(old_cwd)
+        print(f"{years} years: raw {raw_time * 1000:.0f}ms, rollups {rollup_time * 1000:.1f}ms")
+
+def bench_report(args):
+    with tempfile.TemporaryDirectory() as workdir:
+        print(f"building workspace ({args.visits:,} granular visits)..")
+        make_report_workspace(workdir, visits=args.visits)
+        bot = FakeBot(upload_latency=args.upload_latency)
+        with report_module(workdir, bot) as send_to_telegram:
+            #warm up imports and the dataset caches, so both runs start from the same state
+            asyncio.run(send_to_telegram.main(render_workers=0))
+            results = {}
+            for mode, workers in [('serial rendering', 0), ('process pool', args.workers)]:
+                bot.photos.clear()
+                start = time.perf_counter()
+                asyncio.run(send_to_telegram.main(render_workers=workers))
+                results[mode] = time.perf_counter() - start
+        print(f"{len(bot.photos)} charts, {args.upload_latency:.2f}s simulated latency per Telegram call")
+        for mode, elapsed in results.items():
+            print(f"{mode}: {elapsed:.2f}s end-to-end")
+
+def bench_queries(args):
+    import queries
+    from telegram import Update
+
+    rng = np.random.default_rng(0)
+    periods = ['', '2024', '2023-03', '2024-05-17', 'last 30 days', 'last 365 days', '2020-01-01 2023-12-31']
+    texts = [f"/{rng.choice(list(queries.DATASETS))} {rng.choice(STATES)} {rng.choice(periods)}".strip()
+             for _ in range(args.queries)]
+
+    def update(i, text):
+        command = text.split()[0]
+        return {'update_id': i, 'message': {'message_id': i, 'date': int(time.time()), 'text': text,
+                                            'chat': {'id': -1000000000 - i % 1000, 'type': 'group'},
+                                            'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(command)}]}}
+
+    with tempfile.TemporaryDirectory() as workdir:
+        end_date = pd.Timestamp('2024-06-30')
+        start_date = end_date - pd.DateOffset(years=args.years)
+        folder = os.path.join(workdir, 'data-darah-public')
+        os.makedirs(folder)
+        make_state_data(DONATIONS_COLUMNS, start_date, end_date, seed=1).to_csv(os.path.join(folder, 'donations_state.csv'), index=False)
+        make_state_data(NEWDONORS_COLUMNS, start_date, end_date, seed=2).to_csv(os.path.join(folder, 'newdonors_state.csv'), index=False)
+        old_cwd = os.getcwd()
+        os.chdir(workdir)
+        try:
+            start = time.perf_counter()
+            holder = queries.StoreHolder(folder)
+            built = time.perf_counter() - start
+
+            #the answers alone
+            answer_times = []
+            for text in texts:
+                command, *words = text[1:].split()
+                start = time.perf_counter()
+                holder.store.answer(command, words)
+                answer_times.append(time.perf_counter() - start)
+
+            #end to end through python-telegram-bot, from an incoming update to the reply sent to the fake Bot API,
+            #with the data refreshed halfway through
+            async def load_test(server):
+                application = queries.build_application('123456:benchmark', holder, base_url=server.url)
+                latencies = []
+                async with application:
+                    slots = asyncio.Semaphore(args.concurrency)
+
+                    async def one(i, text):
+                        async with slots:
+                            start = time.perf_counter()
+                            await application.process_update(Update.de_json(update(i, text), application.bot))
+                            latencies.append(time.perf_counter() - start)
+
+                    async def refresh():
+                        await asyncio.sleep(0.5)
+                        #the next day lands in the donations CSV
+                        path = os.path.join(folder, 'donations_state.csv')
+                        data = pd.read_csv(path)
+                        last = data[data['date'] == data['date'].max()].copy()
+                        last['date'] = (pd.Timestamp(last['date'].iloc[0]) + pd.Timedelta(days=1)).strftime('%Y-%m-%d')
+                        last.to_csv(path, mode='a', header=False, index=False)
+                        return await holder.refresh()
+
+                    start = time.perf_counter()
+                    refreshed, *_ = await asyncio.gather(refresh(), *(one(i, text) for i, text in enumerate(texts)))
+                    elapsed = time.perf_counter() - start
+                return latencies, elapsed, refreshed
+
+            with FakeBotAPIServer(latency=args.latency, per_chat_burst=10**6, global_rate=10**6, global_burst=10**6) as server:
+                latencies, elapsed, refreshed = asyncio.run(load_test(server))
+                replies = server.messages
+        finally:
+            os.chdir(old_cwd)
+
+    def percentiles(times):
+        return f"p50 {np.percentile(times, 50) * 1000:.2f}ms, p99 {np.percentile(times, 99) * 1000:.2f}ms"
+
+    print(f"store of {args.years} years x {len(STATES)} states built in {built:.2f}s")
+    print(f"{len(texts):,} queries, answer only: {percentiles(answer_times)}")
+    print(f"end to end with {args.concurrency} at a time ({args.latency * 1000:.0f}ms Bot API latency): {percentiles(latencies)}, "
+          f"{len(texts) / elapsed:.0f} queries/s, {replies} replies")
+    print(f"refreshed during the load test: {'yes, by swapping the store' if refreshed else 'NO'}, "
+          f"now up to {holder.store.datasets['donations'].end}")
+    if replies != len(texts) or not refreshed:
+        raise SystemExit(1)
+
+def bench_stages(args):
+    import json
+    import stages
+
+    #the cost of one (empty) stage: two /proc reads, a peak reset and the clocks
+    with stages.run('overhead') as run:
+        start = time.perf_counter()
+        for _ in range(args.stages):
+            with stages.stage('empty'):
+                pass
+        overhead = (time.perf_counter() - start) / args.stages
+        run.records.clear()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        print(f"building workspace ({args.visits:,} granular visits)..")
+        make_report_workspace(workdir, visits=args.visits)
+        bot = FakeBot(upload_latency=args.upload_latency)
+        with report_module(workdir, bot) as send_to_telegram:
+            asyncio.run(send_to_telegram.main(render_workers=args.workers))
+        with open(os.path.join(workdir, stages.METRICS_FOLDER, stages.LOG_FILE)) as file:
+            records = [record for record in map(json.loads, file) if 'stage' in record]
+        with open(os.path.join(workdir, stages.METRICS_FOLDER, 'report.prom')) as file:
+            gauges = sum(1 for line in file if not line.startswith('#'))
+
+    print(f"one stage costs {overhead * 1e6:.0f}us of instrumentation")
+    print(f"report run: {len(records)} stages, {gauges} Prometheus gauges")
+    print(f"{'stage':45} {'wall':>7} {'cpu':>7} {'peak RSS':>9} {'down':>8} {'up':>8} {'rows':>9}")
+    for record in sorted(records, key=lambda r: -r['wall_seconds']):
+        print(f"{record['stage']:45} {record['wall_seconds']:6.3f}s {record['cpu_seconds']:6.3f}s "
+              f"{record['peak_rss_delta'] / 1e6:7.1f}MB {record['bytes_downloaded'] / 1e3:6.0f}kB "
+              f"{record['bytes_uploaded'] / 1e3:6.0f}kB {record['rows']:9,}")
+
+def bench_charts(args):
+    import json
+
+    def append_day(workdir):
+        #one more day of donations for every state, as the next sync would append it
+        path = os.path.join(workdir, 'data-darah-public', 'donations_state.csv')
+        data = pd.read_csv(path)
+        last = data[data['date'] == data['date'].max()].copy()
+        last['date'] = (pd.Timestamp(last['date'].iloc[0]) + pd.Timedelta(days=1)).strftime('%Y-%m-%d')
+        last.to_csv(path, mode='a', header=False, index=False)
+
+    def append_later_day(workdir):
+        #a day after the plotted years (2019-2024): the yearly and monthly charts don't change
+        path = os.path.join(workdir, 'data-darah-public', 'donations_state.csv')
+        data = pd.read_csv(path)
+        last = data[data['date'] == data['date'].max()].copy()
+        last['date'] = '2025-07-01'
+        last.to_csv(path, mode='a', header=False, index=False)
+
+    def forget_file_ids(workdir):
+        #a new bot: the stored file_ids are not valid for it, so they are uploaded again
+        bot.file_ids.clear()
+
+    runs = [('no cache', False, None), ('cold cache', True, None), ('unchanged data', True, None),
+            ('a new day of donations', True, append_day), ('a day after the plotted years', True, append_later_day),
+            ('stale file_ids', True, forget_file_ids)]
+    with tempfile.TemporaryDirectory() as workdir:
+        print(f"building workspace ({args.visits:,} granular visits)..")
+        make_report_workspace(workdir, visits=args.visits)
+        bot = FakeBot(upload_latency=args.upload_latency)
+        #warm up imports and the dataset caches, so every run starts from the same state
+        with report_module(workdir, bot) as send_to_telegram:
+            asyncio.run(send_to_telegram.main(render_workers=args.workers))
+
+        print(f"{'run':30} {'time':>7} {'hits':>5} {'misses':>7} {'uploads':>8} {'uploaded':>9}")
+        for label, chart_cache, prepare in runs:
+            if prepare:
+                prepare(workdir)
+            bot.photos.clear()
+            with report_module(workdir, bot, chart_cache=chart_cache) as send_to_telegram:
+                start = time.perf_counter()
+                asyncio.run(send_to_telegram.main(render_workers=args.workers))
+                elapsed = time.perf_counter() - start
+            with open(os.path.join(workdir, 'metrics', 'stages.jsonl')) as file:
+                totals = [record for record in map(json.loads, file)][-1].get('totals', {})
+            uploads = [photo for _, _, photo in bot.photos if not isinstance(photo, str)]
+            print(f"{label:30} {elapsed:6.2f}s {totals.get('chart_cache_hits', 0):5} {totals.get('chart_cache_misses', 0):7} "
+                  f"{len(uploads):8} {sum(len(photo.input_file_content) for photo in uploads) / 1e3:7.0f}kB")
+
+def bench_templates(args):
+    import tracemalloc
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.image
+    import plots
+    import templates
+
+    end_date = pd.Timestamp('2024-06-30')
+    start_date = end_date - pd.DateOffset(years=args.years)
+    donations = make_state_data(['daily'], start_date, end_date, seed=1).assign(date=lambda data: pd.to_datetime(data['date']))
+    newdonors = make_state_data(['total'], start_date, end_date, seed=2).assign(date=lambda data: pd.to_datetime(data['date']))
+    donations_monthly, donations_yearly = rollups.aggregate(donations, 'daily')
+    _, newdonors_yearly = rollups.aggregate(newdonors, 'total')
+    with tempfile.TemporaryDirectory() as workdir:
+        path = os.path.join(workdir, 'ds-data-granular')
+        write_granular_parquet(path, args.visits)
+        data = granular.load_granular(path)
+    donor_counts_per_year = plots.donor_status_counts(data)
+    age_counts = plots.age_group_year_counts(data, 2019, 2024)
+    retention_by_threshold = retention_tables(data, [1, 3, 6])
+    del data
+
+    rng = np.random.default_rng(0)
+    def scaled(frame, *columns):
+        #the same layout with new numbers, as a day of new data gives
+        return frame.assign(**{column: (frame[column] * rng.uniform(1, 1.02, len(frame))).astype(frame[column].dtype)
+                               for column in columns})
+
+    def charts():
+        retention = {x: (table + rng.integers(-2, 3, table.shape)).clip(0, 100) for x, table in retention_by_threshold.items()}
+        return [('count_new_donors_by_year', (scaled(newdonors_yearly, 'total'), 2019, 2024), {}),
+                ('plot_blood_donation_trends', (scaled(donations_monthly, 'daily'), 2019, 2024), {}),
+                ('plot_blood_donation_trends_by_state', (scaled(donations_yearly, 'daily'), 2019, 2024), {}),
+                ('plot_donor_counts_by_age_and_year', (scaled(age_counts, 'donor_id'), 2019, 2024), {}),
+                ('plot_returning_new_donor_counts', (scaled(donor_counts_per_year, 'New', 'Returning'),), {})] + \
+               [('plot_donor_retention_heatmap', (retention[x],), {'donated_min_x_times': x}) for x in [1, 3, 6]]
+
+    def label(plot_name, kwargs):
+        return plot_name + (f" ({kwargs['donated_min_x_times']}x)" if kwargs else '')
+
+    def timed(function, *args, **kwargs):
+        start = time.perf_counter()
+        png_bytes = function(*args, **kwargs)
+        return png_bytes, time.perf_counter() - start
+
+    #the first render of anything loads fonts and fills matplotlib's caches
+    for plot_name, chart_args, kwargs in charts():
+        getattr(plots, plot_name)(*chart_args, output_folder=None, **kwargs)
+
+    cold, built, warm, allocated, differing = {}, {}, {}, {}, {}
+    for cycle in range(args.renders):
+        for plot_name, chart_args, kwargs in charts():
+            name = label(plot_name, kwargs)
+            cold_png, elapsed = timed(getattr(plots, plot_name), *chart_args, output_folder=None, **kwargs)
+            cold.setdefault(name, []).append(elapsed)
+            first = plot_name not in templates.templates
+            template_png, elapsed = timed(templates.render, plot_name, *chart_args, output_folder=None, **kwargs)
+            (built if first else warm).setdefault(name, []).append(elapsed)
+
+            if cycle == args.renders - 1:
+                #peak Python allocations of one more render each way, and how far the templated PNG is from the cold one
+                for mode, function in [('cold', getattr(plots, plot_name)), ('templated', functools.partial(templates.render, plot_name))]:
+                    tracemalloc.start()
+                    function(*chart_args, output_folder=None, **kwargs)
+                    allocated[name, mode] = tracemalloc.get_traced_memory()[1]
+                    tracemalloc.stop()
+                cold_pixels = matplotlib.image.imread(io.BytesIO(cold_png))
+                template_pixels = matplotlib.image.imread(io.BytesIO(template_png))
+                differing[name] = (np.any(cold_pixels != template_pixels, axis=-1).mean() * 100
+                                   if cold_pixels.shape == template_pixels.shape else None)
+    templates.close_all()
+
+    print(f"{args.renders} renders of every chart with new numbers each time ({args.years} years of state data, "
+          f"{args.visits:,} granular visits)")
+    print(f"{'chart':42} {'cold':>8} {'build':>8} {'templated':>10} {'speedup':>8} {'cold alloc':>11} {'tmpl alloc':>11} {'pixels off':>11}")
+    total_cold = total_warm = 0
+    for name in cold:
+        cold_ms = np.median(cold[name]) * 1000
+        warm_ms = np.median(warm[name]) * 1000
+        build = f"{np.median(built[name]) * 1000:6.0f}ms" if name in built else '-'
+        total_cold += cold_ms
+        total_warm += warm_ms
+        off = f"{differing[name]:.2f}%" if differing[name] is not None else "size"
+        print(f"{name:42} {cold_ms:6.0f}ms {build:>8} {warm_ms:8.0f}ms {cold_ms / warm_ms:7.2f}x "
+              f"{allocated[name, 'cold'] / 1e6:9.1f}MB {allocated[name, 'templated'] / 1e6:9.1f}MB {off:>11}")
+    print(f"{'all charts':42} {total_cold:6.0f}ms {'':8} {total_warm:8.0f}ms {total_cold / total_warm:7.2f}x")
+
+def bench_delivery(args):
+    import delivery
+    from telegram import Bot
+
+    #a report: the info message, 8 charts in 3 related groups, and the retention message
+    rng = np.random.default_rng(0)
+    charts = [rng.bytes(args.chart_kb * 1024) for _ in range(8)]
+    groups = [charts[0:3], charts[3:5], charts[5:8]]
+    chat_ids = [str(-1000000000 - i) for i in range(args.chats)]
+
+    async def one_by_one(server):
+        #the old way: one chat after another, every chart uploaded again for every chat
+        bot = Bot(token='123456:benchmark', base_url=server.url)
+        for chat_id in chat_ids:
+            await bot.send_message(chat_id=chat_id, text="TODAY'S UPDATE!")
+            for chart in charts:
+                await bot.send_photo(chat_id=chat_id, photo=chart, caption="chart")
+            await bot.send_message(chat_id=chat_id, text="---DONOR RETENTION DATA---")
+        await bot.shutdown()
+        return 0
+
+    async def scheduled(server):
+        bot = delivery.make_bot('123456:benchmark', base_url=server.url)
+        sender = delivery.Delivery(bot, chat_ids)
+        await sender.send_message("TODAY'S UPDATE!")
+        for i, group in enumerate(groups):
+            if i == 2:
+                await sender.send_message("---DONOR RETENTION DATA---")
+            await sender.send_media_group([(chart, "chart") for chart in group])
+        await bot.shutdown()
+        return sender.retries
+
+    print(f"{args.chats} chats, {len(charts)} charts of {args.chart_kb}KB, {args.latency * 1000:.0f}ms per call, "
+          f"{args.bandwidth:.0f}MB/s upload, Telegram limits enforced by the stand-in")
+    for mode, run in [('one by one', one_by_one), ('delivery scheduler', scheduled)]:
+        with FakeBotAPIServer(latency=args.latency, bandwidth=args.bandwidth * 1e6) as server:
+            start = time.perf_counter()
+            retries = asyncio.run(run(server))
+            elapsed = time.perf_counter() - start
+        print(f"{mode}: {elapsed:.2f}s, {server.messages / elapsed:.1f} messages/s, {server.calls} API calls, "
+              f"{server.uploaded_bytes / 1e6:.1f}MB uploaded, {server.rate_limited} rate-limited, {retries} retries")
+
+#the two jobs of the old scheduler, each in a fresh interpreter pointed at the stand-in servers;
+#benchmark.py itself is only imported for the fake bot, once the report knows it has work to do
+FETCH_JOB = ("import sys; sys.path.insert(0, {repo!r}); import fetch_data_latest_commit as fetch; "
+             "fetch.GITHUB_API = sys.argv[1]; fetch.GRANULAR_URL = sys.argv[1] + '/granular'; fetch.main()")
+REPORT_JOB = ("import os, sys; sys.path.insert(0, {repo!r}); os.environ.setdefault('BOT_TOKEN', '123456:benchmark'); "
+              "os.environ.setdefault('CHAT_ID', '-100123456'); import send_to_telegram; "
+              "send_to_telegram.data_was_fetched() or sys.exit(); import benchmark; benchmark.report_job(send_to_telegram)")
+
+def report_job(send_to_telegram):
+    send_to_telegram.bot = FakeBot()
+    asyncio.run(send_to_telegram.main())
+    os.remove('data_fetched.txt')
+
+def bench_daemon(args):
+    import scheduler
+    from render import ChartRenderer
+
+    end_date = datetime.now().date()
+    start_date = end_date - timedelta(days=365 * args.years)
+    donations = make_state_data(DONATIONS_COLUMNS, start_date, end_date, seed=1)
+    newdonors = make_state_data(NEWDONORS_COLUMNS, start_date, end_date, seed=2)
+    granular = io.BytesIO()
+    make_granular_data(args.visits).to_parquet(granular)
+
+    def publish_day(server, day):
+        #the CSVs as they were `day` days before end_date
+        cutoff = (end_date - timedelta(days=day)).strftime('%Y-%m-%d')
+        server.publish({'donations_state.csv': to_csv_bytes(donations[donations['date'] <= cutoff]),
+                        'newdonors_state.csv': to_csv_bytes(newdonors[newdonors['date'] <= cutoff])})
+
+    repo = os.path.dirname(os.path.abspath(__file__))
+    fetch_job = [sys.executable, '-c', FETCH_JOB.format(repo=repo)]
+    report_job = [sys.executable, '-c', REPORT_JOB.format(repo=repo)]
+
+    #startup: everything a daemon imports and warms once, in a fresh interpreter
+    startup = subprocess.run([sys.executable, '-c', f"import sys, time; start = time.perf_counter(); sys.path.insert(0, {repo!r}); "
+                              "import fetch_data_latest_commit, send_to_telegram, pandas, rollups, retention, plots, delivery; "
+                              "print(time.perf_counter() - start)"], capture_output=True, text=True, check=True)
+    print(f"daemon startup (imports, once): {float(startup.stdout) * 1000:.0f}ms")
+
+    results = {}
+    with MockDataServer() as server:
+        server.files['/granular'] = granular.getvalue()
+
+        with tempfile.TemporaryDirectory() as workdir:
+            publish_day(server, 2)
+            subprocess.run(fetch_job + [server.url], cwd=workdir, check=True, capture_output=True)
+            subprocess.run(report_job, cwd=workdir, check=True, capture_output=True)
+            for mode, day in [('new data', 1), ('no new data', 1)]:
+                publish_day(server, day)
+                start = time.perf_counter()
+                subprocess.run(fetch_job + [server.url], cwd=workdir, check=True, capture_output=True)
+                subprocess.run(report_job, cwd=workdir, check=True, capture_output=True)
+                results.setdefault('subprocess per job', {})[mode] = time.perf_counter() - start
+
+        with tempfile.TemporaryDirectory() as workdir, pointed_at(server, workdir):
+            bot = FakeBot()
+            with report_module(workdir, bot) as send_to_telegram:
+                async def cycle(client, renderer):
+                    if await scheduler.fetch_once(client):
+                        await scheduler.report_once(renderer)
+
+                async def daemon():
+                    #like scheduler.run_daemon: one HTTP client and one renderer for every cycle
+                    async with fetch_data_latest_commit.make_client() as client:
+                        with ChartRenderer() as renderer:
+                            publish_day(server, 2)
+                            await cycle(client, renderer)
+                            for mode, day in [('new data', 1), ('no new data', 1)]:
+                                publish_day(server, day)
+                                start = time.perf_counter()
+                                await cycle(client, renderer)
+                                results.setdefault('asyncio daemon', {})[mode] = time.perf_counter() - start
+                asyncio.run(daemon())
+                if not bot.photos or os.path.exists('data_fetched.txt'):
+                    raise SystemExit("daemon did not send the report through the in-process event")
+
+    print(f"per-cycle latency, {args.years} years of CSVs, {args.visits:,} granular visits:")
+    for mode, cycles in results.items():
+        print(f"{mode}: " + ", ".join(f"{name} {elapsed * 1000:.0f}ms" for name, elapsed in cycles.items()))
+
+def import_times(stderr):
+    """
+    Parse `python -X importtime` output into {module: cumulative microseconds}, top-level imports only.
+    """
+    times = {}
+    for line in stderr.splitlines():
+        match = re.match(r'import time:\s+(\d+) \|\s+(\d+) \| (\S.*)$', line)
+        if match:
+            times[match.group(3)] = int(match.group(2))
+    return times
+
+def bench_startup(args):
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'send_to_telegram.py')
+    heavy = ['pandas', 'numpy', 'matplotlib', 'seaborn', 'telegram', 'pyarrow']
+    with tempfile.TemporaryDirectory() as workdir:
+        #no data_fetched.txt in workdir, so this is the hourly no-op run
+        runs = []
+        for _ in range(args.runs):
+            start = time.perf_counter()
+            result = subprocess.run([sys.executable, '-X', 'importtime', script], cwd=workdir,
+                                    capture_output=True, text=True, check=True)
+            runs.append(time.perf_counter() - start)
+        baseline = []
+        for _ in range(args.runs):
+            start = time.perf_counter()
+            bare = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'pass'], cwd=workdir,
+                                  capture_output=True, text=True, check=True)
+            baseline.append(time.perf_counter() - start)
+
+    #only count what the script imports on top of the interpreter's own startup
+    interpreter_modules = import_times(bare.stderr)
+    times = {module: us for module, us in import_times(result.stderr).items() if module not in interpreter_modules}
+    imports_ms = sum(times.values()) / 1000
+    loaded = [module for module in heavy if module in times]
+    print(f"no-op run of send_to_telegram.py: {min(runs) * 1000:.0f}ms wall (bare interpreter {min(baseline) * 1000:.0f}ms), "
+          f"{imports_ms:.0f}ms of imports")
+    for module, us in sorted(times.items(), key=lambda item: -item[1])[:5]:
+        print(f"  {module}: {us / 1000:.1f}ms")
+    if loaded:
+        print(f"FAIL: the no-op run imported {', '.join(loaded)}")
+        raise SystemExit(1)
+    if imports_ms > args.budget_ms:
+        print(f"FAIL: imports took more than the {args.budget_ms}ms budget")
+        raise SystemExit(1)
+
+#loads the granular parquet one way in a fresh interpreter and prints seconds, peak RSS (MB) and frame size (MB)
+#(peak RSS comes from VmHWM, as ru_maxrss would carry over the benchmark's own peak through fork)
+LOAD_JOB = ("import re, sys, time; sys.path.insert(0, {repo!r}); import pandas as pd, granular; "
+            "start = time.perf_counter(); {load}; elapsed = time.perf_counter() - start; "
+            "peak_kb = int(re.search(r'VmHWM:\\s+(\\d+)', open('/proc/self/status').read()).group(1)); "
+            "print(elapsed, peak_kb / 1024, data.memory_usage(deep=True).sum() / 1e6)")
+GRANULAR_LOADERS = {
+    'pd.read_parquet': "data = pd.read_parquet(sys.argv[1]); data['visit_date'] = pd.to_datetime(data['visit_date'])",
+    'load_granular': "data = granular.load_granular(sys.argv[1])",
+    'load_granular 2019-2024': "data = granular.load_granular(sys.argv[1], 2019, 2024)",
+}
+
+def bench_granular(args):
+    repo = os.path.dirname(os.path.abspath(__file__))
+    for scale in args.scales:
+        with tempfile.TemporaryDirectory() as workdir:
+            path = os.path.join(workdir, 'ds-data-granular')
+            rows = write_granular_parquet(path, args.base_visits * scale)
+            print(f"{scale}x ({rows:,} visits, {os.path.getsize(path) / 1e6:.0f}MB parquet):")
+            for name, load in GRANULAR_LOADERS.items():
+                result = subprocess.run([sys.executable, '-c', LOAD_JOB.format(repo=repo, load=load), path],
+                                        capture_output=True, text=True)
+                if result.returncode:
+                    print(f"  {name}: failed ({result.stderr.strip().splitlines()[-1]})")
+                    continue
+                elapsed, peak_mb, frame_mb = map(float, result.stdout.split())
+                print(f"  {name}: {elapsed:.2f}s, peak RSS {peak_mb:.0f}MB, frame {frame_mb:.0f}MB")
+
+def bench_donors(args):
+    import donor_state
+    import plots
+    from retention import retention_from_counts
+
+    with tempfile.TemporaryDirectory() as workdir:
+        old_cwd = os.getcwd()
+        os.chdir(workdir)
+        try:
+            write_granular_parquet('full', args.visits)
+            table = pq.read_table('full')
+            last_day = pc.max(table.column('visit_date'))
+            #yesterday's file, then today's with one more day of visits appended
+            pq.write_table(table.filter(pc.less(table.column('visit_date'), last_day)), 'ds-data-granular', row_group_size=1_000_000)
+            donor_state.update_donor_state('ds-data-granular')
+            pq.write_table(table, 'ds-data-granular', row_group_size=1_000_000)
+            del table
+
+            start = time.perf_counter()
+            data = granular.load_granular('ds-data-granular')
+            full = (plots.donor_status_counts(data), plots.age_group_year_counts(data, 2019, 2024),
+                    retention_tables(data, [1, 3, 6]))
+            full_time = time.perf_counter() - start
+            del data
+
+            start = time.perf_counter()
+            new_visits = donor_state.update_donor_state('ds-data-granular')
+            update_time = time.perf_counter() - start
+            donors = donor_state.load_donors()
+            incremental = (donor_state.donor_status_counts(donors), donor_state.age_group_year_counts(donors, 2019, 2024),
+                           retention_from_counts(*donor_state.presence_counts(donors), [1, 3, 6]))
+            incremental_time = time.perf_counter() - start
+        finally:
+            os.chdir(old_cwd)
+
+    print(f"{args.visits:,} visits, {len(donors):,} donors, daily delta of {new_visits:,} visits")
+    print(f"full history (load + group-bys): {full_time:.2f}s")
+    print(f"donor table (merge delta {update_time:.2f}s + aggregates): {incremental_time:.2f}s")
+    same = ((full[0].values == incremental[0].values).all()
+            and (full[1].astype(str).values == incremental[1].astype(str).values).all()
+            and all(full[2][x].equals(incremental[2][x]) for x in full[2]))
+    print("results identical" if same else "MISMATCH")
+    if not same:
+        raise SystemExit(1)
+
+def bench_streaming(args):
+    import plots
+
+    budget = int(args.budget_mb * 1024 * 1024)
+    with tempfile.TemporaryDirectory() as workdir:
+        path = os.path.join(workdir, 'ds-data-granular')
+        rows = write_granular_parquet(path, args.visits)
+
+        start = time.perf_counter()
+        streamed, baseline_kb, peak_kb = run_streaming_job(path, budget, os.path.join(workdir, 'result.pickle'))
+        elapsed = time.perf_counter() - start
+
+        data = granular.load_granular(path)
+        in_memory_mb = data.memory_usage(deep=True).sum() / 1e6
+        pandas_mb = rows * 80 / 1e6  #pd.read_parquet holds ~80 bytes per visit (see the granular benchmark)
+        expected = (plots.donor_status_counts(data), plots.age_group_year_counts(data, 2019, 2024),
+                    retention_tables(data, [1, 3, 6]))
+
+    growth_mb = (peak_kb - baseline_kb) / 1024
+    print(f"{rows:,} visits: {pandas_mb:.0f}MB as a pandas frame, {in_memory_mb:.0f}MB as the compact frame")
+    print(f"streaming with a {args.budget_mb:.0f}MB budget: {elapsed:.2f}s, "
+          f"peak RSS {peak_kb / 1024:.0f}MB ({growth_mb:.0f}MB above the {baseline_kb / 1024:.0f}MB after imports)")
+    same = (expected[0].equals(streamed[0])
+            and (expected[1].astype(str).values == streamed[1].astype(str).values).all()
+            and all(expected[2][x].equals(streamed[2][x]) for x in expected[2]))
+    print("results identical to the in-memory path" if same else "MISMATCH with the in-memory path")
+    if not same or growth_mb > args.budget_mb:
+        if growth_mb > args.budget_mb:
+            print(f"FAIL: memory grew {growth_mb:.0f}MB, over the {args.budget_mb:.0f}MB budget")
+        raise SystemExit(1)
+
+def bench_sharded(args):
+    import plots
+    from sharded import sharded_granular_aggregates
+
+    with tempfile.TemporaryDirectory() as workdir:
+        path = os.path.join(workdir, 'ds-data-granular')
+        rows = write_granular_parquet(path, args.visits, row_group_size=args.row_group_size)
+        start = time.perf_counter()
+        data = granular.load_granular(path)
+        expected = (plots.donor_status_counts(data), plots.age_group_year_counts(data, 2019, 2024),
+                    retention_tables(data, [1, 3, 6]))
+        single = time.perf_counter() - start
+        del data
+        print(f"{rows:,} visits, {pq.read_metadata(path).num_row_groups} row groups, {os.cpu_count()} CPUs available")
+        print(f"in-memory, one core: {single:.2f}s")
+
+        baseline = None
+        for workers in args.workers:
+            start = time.perf_counter()
+            result = sharded_granular_aggregates(path, 2019, 2024, workers=workers)
+            elapsed = time.perf_counter() - start
+            baseline = baseline or elapsed
+            same = (expected[0].equals(result[0])
+                    and (expected[1].astype(str).values == result[1].astype(str).values).all()
+                    and all(expected[2][x].equals(result[2][x]) for x in expected[2]))
+            print(f"sharded, {workers} workers: {elapsed:.2f}s ({baseline / elapsed:.2f}x vs 1 worker)"
+                  + ("" if same else " MISMATCH with the in-memory path"))
+            if not same:
+                raise SystemExit(1)
+
+def bench_memory(args):
+    with tempfile.TemporaryDirectory() as workdir:
+        print(f"building workspace ({args.visits:,} granular visits)..")
+        make_report_workspace(workdir, visits=args.visits)
+        bot = FakeBot()
+        process = psutil.Process()
+        with report_module(workdir, bot) as send_to_telegram:
+            #the first cycles warm up imports, caches and matplotlib's font cache
+            for _ in range(args.warmup):
+                asyncio.run(send_to_telegram.main(render_workers=0, output_folder=None))
+            baseline = peak = process.memory_info().rss
+            for cycle in range(1, args.cycles + 1):
+                #drop what the fake bot kept, so only the report's own memory is measured
+                bot.photos.clear()
+                bot.messages.clear()
+                asyncio.run(send_to_telegram.main(render_workers=0, output_folder=None))
+                peak = max(peak, process.memory_info().rss)
+                if cycle % 10 == 0:
+                    print(f"cycle {cycle}: RSS {process.memory_info().rss / 1e6:.0f}MB", file=sys.stderr)
+
+    import matplotlib.pyplot as plt
+    growth = (peak - baseline) / 1e6
+    print(f"{args.cycles} report cycles: baseline RSS {baseline / 1e6:.0f}MB, peak {peak / 1e6:.0f}MB "
+          f"(+{growth:.1f}MB), {len(plt.get_fignums())} figures left open")
+    if growth > args.max_growth_mb or plt.get_fignums():
+        print(f"FAIL: memory grew more than {args.max_growth_mb}MB or figures were left open")
+        raise SystemExit(1)
+
+#===============Benchmark suite==============
+
+SUITE_VISITS = 1_000_000  #granular visits at scale 1 (about 250k donors); --scale 10 and 100 are 10x and 100x the donors
+SUITE_CHUNK_VISITS = 5_000_000  #granular visits generated at a time, so the generator fits in memory at any scale
+SUITE_FOLDER = 'benchmark-results'
+
+def write_suite_data(workdir, scale, years, seed=0):
+    """
+    Synthetic data-darah-public CSVs (every state, `years` years of days) and a granular parquet with
+    scale times SUITE_VISITS visits over the same years, laid out in workdir as the bot expects them.
+    """
+    end_date = pd.Timestamp('2024-12-31')
+    start_date = end_date - pd.DateOffset(years=years) + pd.Timedelta(days=1)
+    csv_folder = os.path.join(workdir, 'data-darah-public')
+    os.makedirs(csv_folder, exist_ok=True)
+    os.makedirs(os.path.join(workdir, 'data-granular'), exist_ok=True)
+    csv_rows = 0
+    for name, columns, offset in [('donations_state', DONATIONS_COLUMNS, 1), ('newdonors_state', NEWDONORS_COLUMNS, 2)]:
+        data = make_state_data(columns, start_date, end_date, seed=seed + offset)
+        data.to_csv(os.path.join(csv_folder, f'{name}.csv'), index=False)
+        csv_rows += len(data)
+    visits = write_granular_parquet(os.path.join(workdir, 'data-granular', 'ds-data-granular'), int(scale * SUITE_VISITS),
+                                    start_year=start_date.year, end_year=end_date.year, seed=seed,
+                                    chunk_visits=SUITE_CHUNK_VISITS)
+    return {'csv_rows': csv_rows, 'visits': visits,
+            'parquet_bytes': os.path.getsize(os.path.join(workdir, 'data-granular', 'ds-data-granular'))}
+
+def suite_cases(workdir, server):
+    """
+    (name, function, setup) for every step of the fetch and the report. Each function's inputs are prepared
+    outside the measured call; setup (if any) runs before every repeat, to measure a cold start.
+    """
+    import shutil
+    import plots
+    import send_to_telegram
+    import donor_state
+    from donor_state import update_donor_state
+    from retention import retention_from_counts
+
+    def removed(folder):
+        return lambda: shutil.rmtree(folder, ignore_errors=True)
+
+    def process_latest_commit():
+        #a first sync of the latest commit into an empty folder: every CSV and the parquet, downloaded and merged
+        async def run():
+            async with fetch_data_latest_commit.make_client() as client:
+                manifest = fetch_data_latest_commit.load_manifest()
+                commit = await fetch_data_latest_commit.fetch_latest_commit(client, manifest)
+                return await fetch_data_latest_commit.process_latest_commit(client, commit, manifest, full=True)
+        with tempfile.TemporaryDirectory(dir=workdir) as folder, pointed_at(server, folder):
+            return asyncio.run(run())
+
+    cases = [('fetch.process_latest_commit', process_latest_commit, None)]
+    for dataset in ['donations_state', 'newdonors_state']:
+        csv_path = os.path.join('data-darah-public', f'{dataset}.csv')
+        cases += [(f'load_data.{dataset}.cold', functools.partial(send_to_telegram.load_data, csv_path), removed('data-cache')),
+                  (f'load_data.{dataset}.cached', functools.partial(send_to_telegram.load_data, csv_path), None)]
+    cases.append(('rollups.update_all', functools.partial(rollups.update_all, 'data-darah-public'), removed('data-rollups')))
+    granular_path = os.path.join('data-granular', 'ds-data-granular')
+    cases += [('granular.load_granular', functools.partial(granular.load_granular, granular_path), None),
+              ('donor_state.update_donor_state', functools.partial(update_donor_state, granular_path), removed('data-donors'))]
+
+    #the report's inputs, prepared once
+    start_year, end_year = 2019, 2024
+    rollups.update_all('data-darah-public')
+    newdonors_yearly = rollups.load_rollup('newdonors_state', 'yearly')
+    donations_monthly = rollups.load_rollup('donations_state', 'monthly')
+    donations_yearly = rollups.load_rollup('donations_state', 'yearly')
+    #the aggregates as the report computes them by default: from the per-donor table (see donor_state.py)
+    update_donor_state(granular_path)
+    donors = donor_state.load_donors()
+    presence = donor_state.presence_counts(donors)
+    cases += [('aggregates.load_donors', donor_state.load_donors, None),
+              ('aggregates.donor_status_counts', functools.partial(donor_state.donor_status_counts, donors), None),
+              ('aggregates.age_group_year_counts', functools.partial(donor_state.age_group_year_counts, donors, start_year, end_year), None),
+              ('aggregates.presence_counts', functools.partial(donor_state.presence_counts, donors), None)]
+    cases += [(f'aggregates.retention_table.{x}x', functools.partial(retention_from_counts, *presence, thresholds=[x]), None) for x in [1, 3, 6]]
+    donor_counts_per_year = donor_state.donor_status_counts(donors)
+    age_counts = donor_state.age_group_year_counts(donors, start_year, end_year)
+    retention_by_threshold = retention_from_counts(*presence, thresholds=[1, 3, 6])
+    del donors, presence
+
+    def plot(name, *args, **kwargs):
+        return functools.partial(getattr(plots, name), *args, output_folder=None, **kwargs)
+    cases += [('plot.count_new_donors_by_year', plot('count_new_donors_by_year', newdonors_yearly, start_year, end_year), None),
+              ('plot.plot_blood_donation_trends', plot('plot_blood_donation_trends', donations_monthly, start_year, end_year), None),
+              ('plot.plot_blood_donation_trends_by_state', plot('plot_blood_donation_trends_by_state', donations_yearly, start_year, end_year), None),
+              ('plot.plot_returning_new_donor_counts', plot('plot_returning_new_donor_counts', donor_counts_per_year), None),
+              ('plot.plot_donor_counts_by_age_and_year', plot('plot_donor_counts_by_age_and_year', age_counts, start_year, end_year), None)]
+    cases += [(f'plot.plot_donor_retention_heatmap.{x}x',
+               plot('plot_donor_retention_heatmap', retention_by_threshold[x], donated_min_x_times=x), None) for x in [1, 3, 6]]
+    return cases
+
+def measure(function, setup, repeat):
+    """
+    Run function repeat times, each in a stage of stages.py: median wall and CPU time, largest peak RSS growth.
+    """
+    import gc
+    import stages
+    records = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        gc.collect()
+        with stages.stage('suite') as record:
+            function()
+        records.append(record)
+    return {'wall_seconds': round(float(np.median([r['wall_seconds'] for r in records])), 6),
+            'wall_seconds_min': min(r['wall_seconds'] for r in records),
+            'cpu_seconds': round(float(np.median([r['cpu_seconds'] for r in records])), 6),
+            'peak_rss_delta': max(r['peak_rss_delta'] for r in records)}
+
+def bench_suite(args):
+    import platform
+    import matplotlib
+    matplotlib.use('Agg')
+
+    only = re.compile(args.only) if args.only else None
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        print(f"generating {args.scale:g}x data: {args.years} years, {int(args.scale * SUITE_VISITS):,} granular visits..", file=sys.stderr)
+        sizes = write_suite_data(workdir, args.scale, args.years)
+        with MockDataServer() as server:
+            with open(os.path.join(workdir, 'data-granular', 'ds-data-granular'), 'rb') as file:
+                server.files['/granular'] = file.read()
+            server.publish({f'{name}.csv': open(os.path.join(workdir, 'data-darah-public', f'{name}.csv'), 'rb').read()
+                            for name in ['donations_state', 'newdonors_state']})
+
+            old_cwd = os.getcwd()
+            os.chdir(workdir)
+            try:
+                with contextlib.redirect_stdout(sys.stderr):
+                    cases = suite_cases(workdir, server)
+                for name, function, setup in cases:
+                    if only and not only.search(name):
+                        continue
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        results[name] = measure(function, setup, args.repeat)
+                    print(f"{name:48} {results[name]['wall_seconds']:8.3f}s {results[name]['peak_rss_delta'] / 1e6:8.1f}MB",
+                          file=sys.stderr)
+            finally:
+                os.chdir(old_cwd)
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    baseline = {'meta': {'created': datetime.now().isoformat(timespec='seconds'), 'commit': commit,
+                         'scale': args.scale, 'years': args.years, 'repeat': args.repeat, **sizes,
+                         'python': platform.python_version(), 'machine': platform.machine(),
+                         'cpus': os.cpu_count(), 'memory_bytes': psutil.virtual_memory().total},
+                'results': results}
+    output = args.output or os.path.join(SUITE_FOLDER, f'suite-{args.scale:g}x-{args.years}y.json')
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w') as file:
+        json.dump(baseline, file, indent=2)
+    print(f"{len(results)} measurements saved to {output}")
+
+def bench_compare(args):
+    with open(args.baseline) as file:
+        baseline = json.load(file)
+    with open(args.current) as file:
+        current = json.load(file)
+
+    for key in ['scale', 'years', 'machine', 'cpus']:
+        if baseline['meta'].get(key) != current['meta'].get(key):
+            print(f"note: {key} differs ({baseline['meta'].get(key)} vs {current['meta'].get(key)})")
+    #baselines of a different data size are compared for capacity planning: the growth is the point, not a regression
+    growth = any(baseline['meta'].get(key) != current['meta'].get(key) for key in ['scale', 'years'])
+
+    regressions = []
+    print(f"{'measurement':48} {'baseline':>9} {'current':>9} {'change':>8} {'base RSS':>9} {'curr RSS':>9}")
+    for name in list(baseline['results']) + [name for name in current['results'] if name not in baseline['results']]:
+        old, new = baseline['results'].get(name), current['results'].get(name)
+        if old is None or new is None:
+            print(f"{name:48} {'only in ' + ('current' if old is None else 'baseline'):>30}")
+            continue
+        change = new['wall_seconds'] / old['wall_seconds'] - 1 if old['wall_seconds'] else 0
+        flags = []
+        if not growth and change > args.tolerance and new['wall_seconds'] - old['wall_seconds'] > args.min_seconds:
+            flags.append('SLOWER')
+        memory_growth = new['peak_rss_delta'] - old['peak_rss_delta']
+        if not growth and memory_growth > args.min_memory_mb * 1e6 and new['peak_rss_delta'] > old['peak_rss_delta'] * (1 + args.tolerance):
+            flags.append('MORE MEMORY')
+        if flags:
+            regressions.append(name)
+        print(f"{name:48} {old['wall_seconds']:8.3f}s {new['wall_seconds']:8.3f}s {change * 100:+7.0f}% "
+              f"{old['peak_rss_delta'] / 1e6:7.1f}MB {new['peak_rss_delta'] / 1e6:7.1f}MB {' '.join(flags)}")
+
+    if growth:
+        print("growth between data sizes, not checked for regressions")
+    elif regressions:
+        print(f"{len(regressions)} regressions over {args.tolerance:.0%}: {', '.join(regressions)}")
+        raise SystemExit(1)
+    else:
+        print("no regressions")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the blood donation bot")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    retention_parser = subparsers.add_parser('retention', help="cohort engine vs the nested-loop heatmap")
+    retention_parser.add_argument('--visits', type=int, default=10_000_000)
+    retention_parser.add_argument('--skip-legacy', action='store_true', help="only time the cohort engine")
+    retention_parser.set_defaults(func=bench_retention)
+
+    sync_parser = subparsers.add_parser('sync', help="incremental vs full fetch against a local HTTP stand-in")
+    sync_parser.add_argument('--years', type=int, default=18, help="years of history in the state CSVs")
+    sync_parser.add_argument('--visits', type=int, default=1_000_000, help="rows in the granular parquet")
+    sync_parser.add_argument('--bandwidth', type=float, default=10, help="simulated download speed in MB/s")
+    sync_parser.set_defaults(func=bench_sync)
+
+    download_parser = subparsers.add_parser('download', help="streaming download memory and range resume")
+    download_parser.add_argument('--size-mb', type=float, default=500)
+    download_parser.set_defaults(func=bench_download)
+
+    cache_parser = subparsers.add_parser('cache', help="columnar dataset cache cold vs warm load times")
+    cache_parser.add_argument('--years', type=int, default=18, help="years of history in the state CSVs")
+    cache_parser.set_defaults(func=bench_cache)
+
+    rollups_parser = subparsers.add_parser('rollups', help="report inputs from raw rows vs the rollup store")
+    rollups_parser.add_argument('--years', type=int, nargs='+', default=[18, 50, 100])
+    rollups_parser.set_defaults(func=bench_rollups)
+
+    report_parser = subparsers.add_parser('report', help="end-to-end report latency, serial vs parallel rendering")
+    report_parser.add_argument('--visits', type=int, default=1_000_000, help="rows in the granular parquet")
+    report_parser.add_argument('--upload-latency', type=float, default=0.5, help="seconds per simulated Telegram call")
+    report_parser.add_argument('--workers', type=int, default=None, help="render processes (default: one per CPU)")
+    report_parser.set_defaults(func=bench_report)
+
+    delivery_parser = subparsers.add_parser('delivery', help="report fan-out to many chats against a fake Bot API server")
+    delivery_parser.add_argument('--chats', type=int, default=30)
+    delivery_parser.add_argument('--chart-kb', type=int, default=80, help="size of each chart")
+    delivery_parser.add_argument('--latency', type=float, default=0.05, help="seconds per Bot API call")
+    delivery_parser.add_argument('--bandwidth', type=float, default=2, help="upload speed in MB/s")
+    delivery_parser.set_defaults(func=bench_delivery)
+
+    daemon_parser = subparsers.add_parser('daemon', help="scheduler daemon vs a subprocess per job: startup and cycle latency")
+    daemon_parser.add_argument('--years', type=int, default=18, help="years of history in the state CSVs")
+    daemon_parser.add_argument('--visits', type=int, default=1_000_000, help="rows in the granular parquet")
+    daemon_parser.set_defaults(func=bench_daemon)
+
+    startup_parser = subparsers.add_parser('startup', help="no-op run of send_to_telegram.py, fails over the import budget")
+    startup_parser.add_argument('--runs', type=int, default=5)
+    startup_parser.add_argument('--budget-ms', type=float, default=30, help="allowed import time of the no-op run")
+    startup_parser.set_defaults(func=bench_startup)
+
+    granular_parser = subparsers.add_parser('granular', help="granular parquet load time and peak memory, pandas vs the compact loader")
+    granular_parser.add_argument('--base-visits', type=int, default=1_000_000, help="visits at 1x")
+    granular_parser.add_argument('--scales', type=int, nargs='+', default=[1, 5, 20])
+    granular_parser.set_defaults(func=bench_granular)
+
+    donors_parser = subparsers.add_parser('donors', help="report aggregates from the full history vs the incremental donor table")
+    donors_parser.add_argument('--visits', type=int, default=5_000_000)
+    donors_parser.set_defaults(func=bench_donors)
+
+    streaming_parser = subparsers.add_parser('streaming', help="out-of-core aggregation on data bigger than its memory budget")
+    streaming_parser.add_argument('--visits', type=int, default=5_000_000)
+    streaming_parser.add_argument('--budget-mb', type=float, default=128)
+    streaming_parser.set_defaults(func=bench_streaming)
+
+    charts_parser = subparsers.add_parser('charts', help="report runs with the chart cache: cold, unchanged data, a new day in and outside the plotted years")
+    charts_parser.add_argument('--visits', type=int, default=1_000_000)
+    charts_parser.add_argument('--workers', type=int, default=None)
+    charts_parser.add_argument('--upload-latency', type=float, default=0.2)
+    charts_parser.set_defaults(func=bench_charts)
+
+    templates_parser = subparsers.add_parser('templates', help="cold vs templated rendering of every chart")
+    templates_parser.add_argument('--renders', type=int, default=10)
+    templates_parser.add_argument('--years', type=int, default=18)
+    templates_parser.add_argument('--visits', type=int, default=1_000_000)
+    templates_parser.set_defaults(func=bench_templates)
+
+    fetch_parser = subparsers.add_parser('fetch', help="concurrent vs one-at-a-time downloads, and conditional API polls")
+    fetch_parser.add_argument('--files', type=int, default=8)
+    fetch_parser.add_argument('--years', type=int, default=18)
+    fetch_parser.add_argument('--visits', type=int, default=1_000_000)
+    fetch_parser.add_argument('--bandwidth', type=float, default=2, help="MB/s per connection")
+    fetch_parser.add_argument('--latency', type=float, default=0.1, help="seconds per request")
+    fetch_parser.add_argument('--concurrency', type=int, default=4)
+    fetch_parser.set_defaults(func=bench_fetch)
+
+    queries_parser = subparsers.add_parser('queries', help="p50/p99 latency of /donations and /newdonors under load")
+    queries_parser.add_argument('--queries', type=int, default=5000)
+    queries_parser.add_argument('--concurrency', type=int, default=50)
+    queries_parser.add_argument('--years', type=int, default=18)
+    queries_parser.add_argument('--latency', type=float, default=0.0, help="seconds per Bot API call")
+    queries_parser.set_defaults(func=bench_queries)
+
+    stages_parser = subparsers.add_parser('stages', help="per-stage breakdown of one report run, and the cost of the instrumentation")
+    stages_parser.add_argument('--visits', type=int, default=1_000_000)
+    stages_parser.add_argument('--workers', type=int, default=None)
+    stages_parser.add_argument('--upload-latency', type=float, default=0.2)
+    stages_parser.add_argument('--stages', type=int, default=10_000)
+    stages_parser.set_defaults(func=bench_stages)
+
+    sharded_parser = subparsers.add_parser('sharded', help="multi-core sharded aggregation at 1, 2, 4 and 8 workers")
+    sharded_parser.add_argument('--visits', type=int, default=5_000_000)
+    sharded_parser.add_argument('--row-group-size', type=int, default=250_000)
+    sharded_parser.add_argument('--workers', type=lambda value: [int(w) for w in value.split(',')], default=[1, 2, 4, 8])
+    sharded_parser.set_defaults(func=bench_sharded)
+
+    suite_parser = subparsers.add_parser('suite', help="time and memory of every step at a given data scale, saved as a JSON baseline")
+    suite_parser.add_argument('--scale', type=float, default=1, help="granular donors as a multiple of the 1x data (e.g. 10, 100)")
+    suite_parser.add_argument('--years', type=int, default=30)
+    suite_parser.add_argument('--repeat', type=int, default=3)
+    suite_parser.add_argument('--only', help="regex: run only the measurements whose name matches")
+    suite_parser.add_argument('--output', help=f"JSON file to write (default: {SUITE_FOLDER}/suite-<scale>x-<years>y.json)")
+    suite_parser.set_defaults(func=bench_suite)
+
+    compare_parser = subparsers.add_parser('compare', help="compare two suite baselines, fails on a regression (only growth across data sizes)")
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--tolerance', type=float, default=0.25, help="relative slowdown or memory growth that is flagged")
+    compare_parser.add_argument('--min-seconds', type=float, default=0.05, help="slowdowns smaller than this are noise")
+    compare_parser.add_argument('--min-memory-mb', type=float, default=16, help="memory growth smaller than this is noise")
+    compare_parser.set_defaults(func=bench_compare)
+
+    memory_parser = subparsers.add_parser('memory', help="peak RSS over repeated report cycles, fails on a leak")
+    memory_parser.add_argument('--visits', type=int, default=100_000, help="rows in the granular parquet")
+    memory_parser.add_argument('--cycles', type=int, default=100)
+    memory_parser.add_argument('--warmup', type=int, default=3)
+    memory_parser.add_argument('--max-growth-mb', type=float, default=50)
+    memory_parser.set_defaults(func=bench_memory)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
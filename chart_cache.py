@@ -0,0 +1,141 @@
+#content-addressed cache of the report charts: a chart whose input didn't change since an earlier run is
+#neither drawn again nor uploaded again (the Telegram file_id of its last upload is sent instead)
+import os
+import time
+import asyncio
+import hashlib
+
+import stages
+from jsonfile import load_json, save_json
+
+CHART_FOLDER = "data-charts"  #cached PNGs, named by the sha256 of their bytes
+INDEX_FILE = os.path.join(CHART_FOLDER, "index.json")  #chart key -> PNG, time it took to draw, last used
+FILE_IDS_FILE = os.path.join(CHART_FOLDER, "file_ids.json")  #bot id -> {sha256 of a PNG: Telegram file_id}
+MAX_CHARTS = 200  #least recently used charts beyond this are dropped
+
+def plots_version():
+    #a change to the plotting code changes every key
+    import matplotlib
+    digest = hashlib.sha256(matplotlib.__version__.encode())
+    for name in ("plots.py", "templates.py"):
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), name), "rb") as file:
+            digest.update(file.read())
+    return digest.hexdigest()
+
+def hash_value(digest, value):
+    import numpy as np
+    import pandas as pd
+
+    if isinstance(value, pd.DataFrame):
+        digest.update(repr(("DataFrame", list(value.columns), value.index.names, list(map(str, value.dtypes)))).encode())
+        digest.update(pd.util.hash_pandas_object(value, index=True).to_numpy().tobytes())
+    elif isinstance(value, pd.Series):
+        digest.update(repr(("Series", value.name, value.index.names, str(value.dtype))).encode())
+        digest.update(pd.util.hash_pandas_object(value, index=True).to_numpy().tobytes())
+    elif isinstance(value, np.ndarray):
+        digest.update(repr((value.dtype.str, value.shape)).encode())
+        digest.update(np.ascontiguousarray(value).tobytes())
+    elif isinstance(value, (list, tuple)):
+        digest.update(f"{type(value).__name__}{len(value)}".encode())
+        for item in value:
+            hash_value(digest, item)
+    else:
+        digest.update(repr(value).encode())
+
+def chart_inputs(plot_name, args, kwargs):
+    """
+    What a chart actually draws: the data after the plot's own filtering (see templates.py), so rows outside
+    the plotted years or states don't change its key.
+    """
+    from templates import TEMPLATES
+    kwargs = {name: value for name, value in kwargs.items() if name != "output_folder"}
+    if plot_name in TEMPLATES:
+        return TEMPLATES[plot_name].inputs(*args, **kwargs), {}
+    return args, kwargs
+
+def chart_key(plot_name, args, kwargs, version):
+    """
+    sha256 of what a chart depends on: the plot function, its (aggregated) inputs and parameters, and the plotting code.
+    """
+    digest = hashlib.sha256(f"{version}:{plot_name}".encode())
+    hash_value(digest, list(args))
+    for name in sorted(kwargs):
+        if name != "output_folder":
+            digest.update(name.encode())
+            hash_value(digest, kwargs[name])
+    return digest.hexdigest()
+
+class ChartCache:
+    """
+    Wraps a ChartRenderer: render(renderer, plot_name, *args, **kwargs) returns the cached PNG when a chart
+    with the same key was drawn before, and draws (and stores) it otherwise. A cached chart is not copied
+    to the output folder again; the copy from the run that drew it is still there.
+    """
+    def __init__(self):
+        self.index = load_json(INDEX_FILE)
+        self.version = plots_version()
+        self.hits = 0
+        self.misses = 0
+        self.seconds_saved = 0.0
+
+    def png_path(self, sha256):
+        return os.path.join(CHART_FOLDER, f"{sha256}.png")
+
+    def render(self, renderer, plot_name, *args, **kwargs):
+        key = chart_key(plot_name, *chart_inputs(plot_name, args, kwargs), self.version)
+        entry = self.index.get(key)
+        if entry and os.path.exists(self.png_path(entry["png"])):
+            with open(self.png_path(entry["png"]), "rb") as file:
+                png_bytes = file.read()
+            entry["used"] = time.time()
+            self.hits += 1
+            self.seconds_saved += entry["seconds"]
+            future = asyncio.get_running_loop().create_future()
+            future.set_result(png_bytes)
+            return future
+
+        self.misses += 1
+        started = time.perf_counter()
+        rendering = renderer.render(plot_name, *args, **kwargs)
+
+        async def store():
+            png_bytes = await rendering
+            sha256 = hashlib.sha256(png_bytes).hexdigest()
+            os.makedirs(CHART_FOLDER, exist_ok=True)
+            if not os.path.exists(self.png_path(sha256)):
+                with open(self.png_path(sha256) + ".tmp", "wb") as file:
+                    file.write(png_bytes)
+                os.replace(self.png_path(sha256) + ".tmp", self.png_path(sha256))
+            #from submission, so it includes waiting for a free worker; an estimate of what a hit saves
+            self.index[key] = {"png": sha256, "plot": plot_name, "seconds": round(time.perf_counter() - started, 3),
+                               "used": time.time()}
+            return png_bytes
+        return asyncio.ensure_future(store())
+
+    def file_ids(self, bot_id):
+        """
+        The Telegram file_ids of charts uploaded by this bot in earlier runs (file_ids only work for the bot that uploaded).
+        """
+        return load_json(FILE_IDS_FILE).get(bot_id, {})
+
+    def save(self, bot_id=None, file_ids=None):
+        """
+        Write the index (dropping the least recently used charts) and the file_ids, and report this run's hits.
+        """
+        for key in sorted(self.index, key=lambda key: self.index[key]["used"])[:-MAX_CHARTS]:
+            del self.index[key]
+        kept = {entry["png"] for entry in self.index.values()}
+        if os.path.isdir(CHART_FOLDER):
+            for name in os.listdir(CHART_FOLDER):
+                if name.endswith(".png") and name[:-4] not in kept:
+                    os.remove(os.path.join(CHART_FOLDER, name))
+        save_json(self.index, INDEX_FILE)
+
+        if bot_id is not None and file_ids is not None:
+            all_file_ids = load_json(FILE_IDS_FILE)
+            all_file_ids[bot_id] = {sha256: file_id for sha256, file_id in file_ids.items() if sha256 in kept}
+            save_json(all_file_ids, FILE_IDS_FILE)
+
+        stages.count(chart_cache_hits=self.hits, chart_cache_misses=self.misses,
+                     chart_cache_seconds_saved=round(self.seconds_saved, 3))
+        print(f"Chart cache: {self.hits} hits, {self.misses} misses, ~{self.seconds_saved:.2f}s of rendering saved")
@@ -0,0 +1,82 @@
+import os
+import hashlib
+import pandas as pd
+import pyarrow.feather as feather
+
+from jsonfile import load_json, save_json
+
+CACHE_FOLDER = "data-cache"  #folder where the typed columnar copies of the CSVs are kept
+INDEX_FILE = os.path.join(CACHE_FOLDER, "index.json")  #csv path -> (size, mtime, sha256), so unchanged files aren't re-hashed
+
+def source_hash(csv_path, index):
+    """
+    SHA-256 of a CSV file. The hash is only recomputed when the file's size or mtime changed.
+    """
+    stat = os.stat(csv_path)
+    entry = index.get(csv_path)
+    if entry and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+        return entry["sha256"]
+
+    sha256 = hashlib.sha256()
+    with open(csv_path, "rb") as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            sha256.update(chunk)
+    index[csv_path] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": sha256.hexdigest()}
+    return index[csv_path]["sha256"]
+
+def compact_types(data):
+    """
+    Convert a freshly parsed CSV to compact types: date as datetime64, state as a category,
+    and every count column as the smallest integer type that holds it.
+    """
+    for column in data.columns:
+        if column == "date":
+            data[column] = pd.to_datetime(data[column])
+        elif data[column].dtype == object:
+            data[column] = data[column].astype("category")
+        else:
+            values = pd.to_numeric(data[column], errors="coerce")
+            if values.isna().any():
+                data[column] = values
+            else:
+                data[column] = pd.to_numeric(values, downcast="integer")
+    return data
+
+def cache_path(csv_path, digest):
+    dataset_key = os.path.splitext(os.path.basename(csv_path))[0]
+    return os.path.join(CACHE_FOLDER, f"{dataset_key}-{digest[:16]}.arrow")
+
+def build_cache(csv_path, path):
+    """
+    Parse the CSV once and write it as an uncompressed Arrow IPC (Feather v2) file, which can be memory-mapped.
+    Older cache files of the same dataset are removed.
+    """
+    os.makedirs(CACHE_FOLDER, exist_ok=True)
+    data = compact_types(pd.read_csv(csv_path))
+
+    tmp_path = path + ".tmp"
+    feather.write_feather(data, tmp_path, compression="uncompressed")
+    os.replace(tmp_path, path)
+
+    prefix = os.path.basename(path).rsplit("-", 1)[0] + "-"
+    for name in os.listdir(CACHE_FOLDER):
+        if name.startswith(prefix) and name.endswith(".arrow") and name != os.path.basename(path):
+            os.remove(os.path.join(CACHE_FOLDER, name))
+
+def load_dataset(csv_path, columns=None):
+    """
+    Load a CSV through the columnar cache. The first load after the CSV changes parses it and
+    writes the cache; later loads memory-map the cache and read only the requested columns.
+    """
+    index = load_json(INDEX_FILE)
+    known = index.get(csv_path)
+    digest = source_hash(csv_path, index)
+    path = cache_path(csv_path, digest)
+
+    if not os.path.exists(path):
+        build_cache(csv_path, path)
+    if index.get(csv_path) != known:
+        save_json(index, INDEX_FILE)
+
+    table = feather.read_table(path, columns=columns, memory_map=True)
+    return table.to_pandas()
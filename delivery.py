@@ -0,0 +1,175 @@
+#sends the report to every subscriber chat concurrently, within Telegram's rate limits
+import time
+import asyncio
+import hashlib
+from telegram import Bot, InputMediaPhoto
+from telegram.error import RetryAfter, NetworkError, BadRequest
+from telegram.request import HTTPXRequest
+
+import stages
+
+#Telegram's limits: about 30 messages per second overall, and 20 messages per minute in a group chat
+GLOBAL_RATE = 30  #messages per second
+GLOBAL_BURST = 30
+PER_CHAT_RATE = 20 / 60  #messages per second
+PER_CHAT_BURST = 20  #a whole report fits in one burst, so a single chat is never slowed down
+CONNECTIONS = 16  #concurrent requests to the Bot API
+MAX_RETRIES = 5
+BACKOFF_SECONDS = 1
+
+def make_bot(token, base_url='https://api.telegram.org/bot'):
+    """
+    A telegram.Bot with a connection pool big enough for concurrent sends (the default pool has one connection).
+    """
+    request = HTTPXRequest(connection_pool_size=CONNECTIONS, pool_timeout=None)
+    return Bot(token=token, base_url=base_url, request=request)
+
+class TokenBucket:
+    """
+    Allows `rate` tokens per second on average, with bursts of up to `capacity` tokens.
+    """
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, tokens=1):
+        tokens = min(tokens, self.capacity)
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                await asyncio.sleep((tokens - self.tokens) / self.rate)
+
+def largest_photo_id(message):
+    return message.photo[-1].file_id if getattr(message, 'photo', None) else None
+
+class Delivery:
+    """
+    Sends messages, photos and media groups to every chat in chat_ids.
+
+    Chats are sent to concurrently, behind a global and a per-chat token bucket. An image is uploaded once,
+    to the first chat, and the file_id Telegram returns is reused for the other chats. Flood-control
+    (RetryAfter) errors wait the time Telegram asks for and retry.
+
+    file_ids from earlier runs (sha256 of an image -> file_id, see chart_cache.py) skip the upload altogether;
+    they are tried on the first chat alone, and the image is uploaded again if Telegram no longer knows them.
+
+    A chat that fails (it blocked the bot, was migrated or deleted, or kept failing past the retries) is logged and
+    dropped for the rest of the run, so one subscriber can't cost the others the report; an upload that fails on
+    the first chat moves on to the next one. Only when every chat has failed is the error raised.
+    """
+    def __init__(self, bot, chat_ids, file_ids=None):
+        self.bot = bot
+        self.chat_ids = list(chat_ids)
+        self.global_bucket = TokenBucket(GLOBAL_RATE, GLOBAL_BURST)
+        self.chat_buckets = {chat_id: TokenBucket(PER_CHAT_RATE, PER_CHAT_BURST) for chat_id in self.chat_ids}
+        self.connections = asyncio.Semaphore(CONNECTIONS)
+        self.file_ids = dict(file_ids or {})  #sha256 of an image -> its Telegram file_id
+        self.unconfirmed = set(self.file_ids)  #file_ids from earlier runs, not yet accepted by Telegram in this one
+        self.retries = 0
+        self.uploads = 0
+        self.reused = 0  #images sent by a file_id from an earlier run instead of uploaded
+        self.failed = {}  #chat_id -> the error that dropped it
+
+    async def call(self, method, chat_id, cost=1, **kwargs):
+        for attempt in range(MAX_RETRIES):
+            #per-chat first, so a busy chat doesn't hold on to global tokens while it waits
+            await self.chat_buckets[chat_id].acquire(cost)
+            await self.global_bucket.acquire(cost)
+            try:
+                async with self.connections:
+                    return await method(chat_id=chat_id, **kwargs)
+            except RetryAfter as e:
+                self.retries += 1
+                retry_after = e.retry_after
+                await asyncio.sleep(retry_after.total_seconds() if hasattr(retry_after, 'total_seconds') else retry_after)
+            except BadRequest:
+                #a subclass of NetworkError, but retrying the same request won't help
+                raise
+            except NetworkError:
+                if attempt == MAX_RETRIES - 1:
+                    raise
+                self.retries += 1
+                await asyncio.sleep(BACKOFF_SECONDS * 2 ** attempt)
+        raise RuntimeError(f"giving up on chat {chat_id} after {MAX_RETRIES} attempts")
+
+    def drop_chat(self, chat_id, error):
+        print(f"Sending to chat {chat_id} failed ({error!r}), skipping it for the rest of this report")
+        self.failed[chat_id] = error
+        self.chat_ids.remove(chat_id)
+        if not self.chat_ids:
+            raise error
+
+    async def send_to_all(self, chat_ids, send):
+        #a failed chat must not cancel the sends to the others, so collect the errors instead of raising the first
+        results = await asyncio.gather(*(send(chat_id) for chat_id in chat_ids), return_exceptions=True)
+        for chat_id, result in zip(chat_ids, results):
+            if isinstance(result, Exception):
+                self.drop_chat(chat_id, result)
+
+    async def send_message(self, text):
+        await self.send_to_all(list(self.chat_ids), lambda chat_id: self.call(self.bot.send_message, chat_id, text=text))
+
+    async def send_photo(self, png_bytes, caption=None):
+        await self.send_media_group([(png_bytes, caption)])
+
+    async def send_media_group(self, photos):
+        """
+        Send related charts together: photos is a list of (png_bytes, caption).
+        A single photo is sent with send_photo, as Telegram needs 2-10 items in a media group.
+        """
+        if not self.chat_ids:
+            return
+        keys = [hashlib.sha256(png_bytes).hexdigest() for png_bytes, _ in photos]
+
+        async def send(chat_id, media):
+            if len(photos) == 1:
+                message = await self.call(self.bot.send_photo, chat_id, photo=media[0], caption=photos[0][1])
+                return [message]
+            return await self.call(self.bot.send_media_group, chat_id, cost=len(photos),
+                                   media=[InputMediaPhoto(media=item, caption=caption)
+                                          for item, (_, caption) in zip(media, photos)])
+
+        async def upload(chat_id):
+            try:
+                return await send(chat_id, [self.file_ids.get(key, png_bytes) for key, (png_bytes, _) in zip(keys, photos)])
+            except BadRequest:
+                if not any(key in self.unconfirmed for key in keys):
+                    raise
+                #a file_id from an earlier run that Telegram doesn't accept any more: upload those images again
+                for key in keys:
+                    if key in self.unconfirmed:
+                        self.unconfirmed.discard(key)
+                        del self.file_ids[key]
+                return await send(chat_id, [self.file_ids.get(key, png_bytes) for key, (png_bytes, _) in zip(keys, photos)])
+
+        remaining = list(self.chat_ids)
+        if any(key not in self.file_ids or key in self.unconfirmed for key in keys):
+            #upload once, to the first chat that takes it, and remember the file_ids it returns
+            while True:
+                first = self.chat_ids[0]
+                try:
+                    messages = await upload(first)
+                    break
+                except Exception as e:
+                    self.drop_chat(first, e)
+            remaining = self.chat_ids[1:]
+            self.uploads += sum(key not in self.file_ids for key in keys)
+            reused = [png_bytes for key, (png_bytes, _) in zip(keys, photos) if key in self.unconfirmed]
+            self.reused += len(reused)
+            stages.count(upload_bytes_saved=sum(map(len, reused)))
+            stages.add(bytes_uploaded=sum(len(png_bytes) for key, (png_bytes, _) in zip(keys, photos) if key not in self.file_ids))
+            self.unconfirmed.difference_update(keys)
+            for key, message in zip(keys, messages or []):
+                if largest_photo_id(message):
+                    self.file_ids.setdefault(key, largest_photo_id(message))
+
+        await self.send_to_all(remaining, lambda chat_id: send(
+            chat_id, [self.file_ids.get(key, png_bytes) for key, (png_bytes, _) in zip(keys, photos)]))
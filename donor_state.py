@@ -0,0 +1,169 @@
+import os
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+
+from granular import read_visits
+from jsonfile import load_json, save_json
+
+DONOR_FOLDER = "data-donors"  #folder where the per-donor state table is kept
+STATE_FILE = os.path.join(DONOR_FOLDER, "state.json")  #which granular file and visits the table covers
+TABLE_FILE = os.path.join(DONOR_FOLDER, "donors.arrow")  #one row per donor code: first/last year, birth year, visits per year
+IDS_FILE = os.path.join(DONOR_FOLDER, "donor_ids.arrow")  #donor code -> original donor_id, only read when updating
+
+def save_table(table, path):
+    os.makedirs(DONOR_FOLDER, exist_ok=True)
+    tmp_path = path + ".tmp"
+    feather.write_feather(table, tmp_path, compression="uncompressed")
+    os.replace(tmp_path, path)
+
+def load_donors():
+    """
+    Load the donor table: one row per donor code with first_year, last_year, birth_year and
+    visits_<year> (the donor's number of visits in that year) for every year in the data.
+    """
+    return feather.read_table(TABLE_FILE, memory_map=True).to_pandas()
+
+def year_columns(donors):
+    return sorted((column for column in donors.columns if column.startswith("visits_")), key=lambda c: int(c[7:]))
+
+def presence_counts(donors):
+    """
+    The year x donor matrix of visit counts, as retention.build_presence_matrix returns it: (counts, min_year).
+    """
+    columns = year_columns(donors)
+    counts = np.stack([donors[column].to_numpy() for column in columns]) if columns else np.zeros((0, 0), np.uint16)
+    return counts, int(columns[0][7:]) if columns else 0
+
+def merge_visits(donors, ids, visits):
+    """
+    Fold new visits (an Arrow table from granular.read_visits) into the donor table.
+    Donors seen for the first time get the next free codes, so existing codes never change.
+    """
+    #codes of the donors in this batch: known ones from the ID table, new ones appended after them
+    encoded = pc.dictionary_encode(visits.column("donor_id").combine_chunks())
+    batch_ids = encoded.dictionary
+    known = pc.index_in(batch_ids, value_set=ids)
+    is_new = known.is_null().to_numpy(zero_copy_only=False)
+    batch_codes = known.fill_null(0).to_numpy(zero_copy_only=False).astype(np.int64)
+    batch_codes[is_new] = len(ids) + np.arange(is_new.sum())
+    codes = batch_codes[encoded.indices.to_numpy(zero_copy_only=False)]
+    ids = pa.concat_arrays([ids, batch_ids.filter(pa.array(is_new))])
+    n_donors = len(ids)
+
+    years = pc.year(visits.column("visit_date")).to_numpy(zero_copy_only=False).astype(np.int16)
+    birth_years = visits.column("birth_date").to_numpy().astype(np.int16)
+    per_donor = pd.DataFrame({"code": codes, "year": years, "birth": birth_years}).groupby("code")
+    batch = pd.DataFrame({"first": per_donor["year"].min(), "last": per_donor["year"].max(),
+                          "birth": per_donor["birth"].first()})
+
+    old_columns = year_columns(donors)
+    all_years = sorted({int(column[7:]) for column in old_columns} | set(np.unique(years).tolist()))
+    result = pd.DataFrame(index=pd.RangeIndex(n_donors))
+    first_year = np.full(n_donors, np.iinfo(np.int16).max, np.int16)
+    last_year = np.full(n_donors, np.iinfo(np.int16).min, np.int16)
+    birth_year = np.zeros(n_donors, np.int16)
+    if len(donors):
+        first_year[:len(donors)] = donors["first_year"]
+        last_year[:len(donors)] = donors["last_year"]
+        birth_year[:len(donors)] = donors["birth_year"]
+    first_year[batch.index] = np.minimum(first_year[batch.index], batch["first"].to_numpy())
+    last_year[batch.index] = np.maximum(last_year[batch.index], batch["last"].to_numpy())
+    #the birth year is a property of the donor, taken from their first recorded visit
+    new_codes = batch.index[batch.index >= len(donors)]
+    birth_year[new_codes] = batch.loc[new_codes, "birth"].to_numpy()
+    result["first_year"], result["last_year"], result["birth_year"] = first_year, last_year, birth_year
+
+    for year in all_years:
+        column = f"visits_{year}"
+        year_counts = np.zeros(n_donors, np.int64)
+        if column in donors.columns:
+            year_counts[:len(donors)] = donors[column]
+        year_counts += np.bincount(codes[years == year], minlength=n_donors)
+        result[column] = np.minimum(year_counts, np.iinfo(np.uint16).max).astype(np.uint16)
+    return result, ids
+
+def update_donor_state(granular_path):
+    """
+    Bring the donor table up to date with the granular parquet.
+
+    Only visits after the last processed visit_date are read (pushed down to the parquet reader) and merged in.
+    If the file no longer holds exactly the visits already processed plus those new ones (the history
+    was rewritten), the table is rebuilt from the whole file. Returns the number of visits processed.
+    """
+    stat = os.stat(granular_path)
+    state = load_json(STATE_FILE)
+    if (state.get("size"), state.get("mtime_ns")) == (stat.st_size, stat.st_mtime_ns) and os.path.exists(TABLE_FILE):
+        return 0
+
+    incremental = bool(state) and os.path.exists(TABLE_FILE) and os.path.exists(IDS_FILE)
+    visits = read_visits(granular_path, after=state["max_visit_date"] if incremental else None)
+    if incremental and pq.read_metadata(granular_path).num_rows - visits.num_rows != state["rows"]:
+        print("Granular history changed, rebuilding the donor table")
+        incremental = False
+        visits = read_visits(granular_path)
+
+    if incremental:
+        donors = load_donors()
+        ids = feather.read_table(IDS_FILE).column("donor_id").combine_chunks()
+        rows = state["rows"]
+    else:
+        donors = pd.DataFrame()
+        ids = pa.array([], pa.string())
+        rows = 0
+
+    if visits.num_rows:
+        donors, ids = merge_visits(donors, ids, visits)
+        save_table(pa.table({"donor_id": ids}), IDS_FILE)
+        save_table(pa.Table.from_pandas(donors, preserve_index=False), TABLE_FILE)
+        max_visit_date = pc.max(visits.column("visit_date")).as_py().isoformat()
+    else:
+        max_visit_date = state.get("max_visit_date")
+
+    save_json({"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "rows": rows + visits.num_rows,
+               "max_visit_date": max_visit_date}, STATE_FILE)
+    return visits.num_rows
+
+#===============Report aggregates from the donor table==============
+
+def donor_status_counts(donors):
+    """
+    Unique new and returning donors per year, as plots.donor_status_counts returns them.
+    """
+    first_year = donors["first_year"].to_numpy()
+    counts = {}
+    for column in year_columns(donors):
+        year = int(column[7:])
+        present = donors[column].to_numpy() > 0
+        new = int((first_year == year).sum())
+        counts[year] = {"New": new, "Returning": int(present.sum()) - new}
+    result = pd.DataFrame.from_dict(counts, orient="index", columns=["New", "Returning"])
+    result.index.name = "donation_year"
+    result.columns.name = "donor_status"
+    return result[[status for status in ["New", "Returning"] if result[status].any()]]
+
+def age_group_year_counts(donors, start_year, end_year):
+    """
+    Unique donors per age group and year, as plots.age_group_year_counts returns them.
+    """
+    from plots import AGE_BINS, AGE_LABELS
+
+    birth_year = donors["birth_year"].to_numpy()
+    parts = []
+    for column in year_columns(donors):
+        year = int(column[7:])
+        if not start_year <= year <= end_year:
+            continue
+        present = donors[column].to_numpy() > 0
+        age_group = pd.cut(year - birth_year[present], bins=AGE_BINS, labels=AGE_LABELS, right=False)
+        counts = pd.Series(age_group).value_counts(sort=False)
+        parts.append(pd.DataFrame({"age_group": counts.index, "donation_year": year, "donor_id": counts.to_numpy()}))
+    if not parts:
+        return pd.DataFrame({"age_group": pd.Categorical([], categories=AGE_LABELS, ordered=True),
+                             "donation_year": [], "donor_id": []})
+    result = pd.concat(parts, ignore_index=True)
+    result = result[result["donor_id"] > 0].sort_values(["age_group", "donation_year"], kind="stable")
+    return result.reset_index(drop=True)
@@ -1,115 +1,476 @@
-import requests
+import httpx
 import os
+import re
+import asyncio
+import contextlib
+import hashlib
+import argparse
 from datetime import datetime
-from io import BytesIO # for parquet
+
+import stages
+from jsonfile import load_json, save_json
 
 REPO = "MoH-Malaysia/data-darah-public"  #github repo
 BRANCH = "main"  #branch to monitor
 CSV_FOLDER = "data-darah-public"  #folder where CSV files will be saved
-LAST_COMMIT_FILE = "last_commit.txt"  #file to store the SHA id of the last processed commit
+LAST_COMMIT_FILE = "last_commit.txt"  #file used by older versions to store the SHA id of the last processed commit
+MANIFEST_FILE = "sync_manifest.json"  #file to store the last processed commit and per-file hashes/ETags
+GITHUB_API = "https://api.github.com"
+GRANULAR_URL = "https://dub.sh/ds-data-granular"
+
+CHUNK_SIZE = 1024 * 1024  #bytes held in memory at a time while downloading
+TIMEOUT = httpx.Timeout(60, connect=10)  #seconds
+MAX_RETRIES = 4
+BACKOFF_SECONDS = 1  #doubles after every failed attempt
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+MAX_DOWNLOADS = 4  #files downloaded at the same time
 
-def fetch_last_commit_sha():
+def make_client():
+    """
+    One pooled client for the whole sync, so requests to the same host reuse their connections.
+    A GITHUB_TOKEN, if set, raises the API rate limit from 60 to 5000 requests an hour.
     """
-    Fetch the SHA of the last processed commit from a file.
+    headers = {"Authorization": f"Bearer {os.environ['GITHUB_TOKEN']}"} if os.environ.get("GITHUB_TOKEN") else {}
+    return httpx.AsyncClient(headers=headers, timeout=TIMEOUT, follow_redirects=True,
+                             limits=httpx.Limits(max_connections=MAX_DOWNLOADS + 2))
+
+class IncompleteDownload(Exception):
+    pass
+
+def load_manifest():
     """
+    Load the sync manifest: the last processed commit plus, for every synced file,
+    its blob SHA, content hash, ETag/Last-Modified and the latest date it holds.
+    """
+    if os.path.exists(MANIFEST_FILE):
+        return load_json(MANIFEST_FILE)
+
+    manifest = {"last_commit": None, "files": {}}
+    #carry over the commit tracked by last_commit.txt so the first run is not a full re-sync
     if os.path.exists(LAST_COMMIT_FILE):
         with open(LAST_COMMIT_FILE, "r") as file:
-            return file.read().strip()
+            manifest["last_commit"] = file.read().strip() or None
+    return manifest
+
+def save_manifest(manifest):
+    """
+    Write the sync manifest atomically, so a crash never leaves it half-written.
+    """
+    save_json(manifest, MANIFEST_FILE)
+
+def fetch_last_commit_sha(manifest):
+    """
+    Fetch the SHA of the last processed commit from the manifest.
+    """
+    return manifest.get("last_commit")
+
+def update_last_commit_sha(manifest, commit_sha):
+    """
+    Update the SHA of the last processed commit in the manifest.
+    """
+    manifest["last_commit"] = commit_sha
+
+def conditional_headers(entry):
+    """
+    Build If-None-Match/If-Modified-Since headers from a manifest entry,
+    so the server answers 304 (no body) when the file has not changed.
+    """
+    headers = {}
+    if entry.get("etag"):
+        headers["If-None-Match"] = entry["etag"]
+    if entry.get("last_modified"):
+        headers["If-Modified-Since"] = entry["last_modified"]
+    return headers
+
+def update_manifest_entry(entry, response, sha256):
+    """
+    Record the validators and content hash of a downloaded file.
+    """
+    entry["etag"] = response.headers.get("ETag")
+    entry["last_modified"] = response.headers.get("Last-Modified")
+    entry["sha256"] = sha256
+
+def file_hashes(filepath):
+    """
+    Hash a file in chunks. Returns (sha256, git blob sha1), the latter matching the 'sha' GitHub reports for the file.
+    """
+    sha256 = hashlib.sha256()
+    blob_sha = hashlib.sha1(f"blob {os.path.getsize(filepath)}\0".encode())
+    with open(filepath, "rb") as file:
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), b""):
+            sha256.update(chunk)
+            blob_sha.update(chunk)
+    return sha256.hexdigest(), blob_sha.hexdigest()
+
+def expected_size(response, offset):
+    """
+    Total size the finished file should have, or None if it can't be known
+    (no length header, or a compressed body whose length is not the file size).
+    """
+    if response.headers.get("Content-Encoding", "identity") != "identity":
+        return None
+    content_range = re.match(r"bytes \d+-\d+/(\d+)", response.headers.get("Content-Range", ""))
+    if content_range:
+        return int(content_range.group(1))
+    if "Content-Length" in response.headers:
+        return offset + int(response.headers["Content-Length"])
     return None
 
-def update_last_commit_sha(commit_sha):
+def part_validator(tmp_path):
     """
-    Update the SHA of the last processed commit in a file.
+    The ETag (or Last-Modified) of the response a partial file was written from, for If-Range, or None.
     """
-    with open(LAST_COMMIT_FILE, "w") as file:
-        file.write(commit_sha)
+    validators = load_json(tmp_path + ".json")
+    etag = validators.get("etag")
+    #If-Range only takes a strong ETag
+    if etag and not etag.startswith("W/"):
+        return etag
+    return validators.get("last_modified")
 
-def fetch_latest_commit():
+def remove_part(tmp_path):
+    for path in (tmp_path, tmp_path + ".json"):
+        if os.path.exists(path):
+            os.remove(path)
+
+async def stream_download(client, url, filepath, headers=None, blob_sha=None):
+    """
+    Stream url to filepath in CHUNK_SIZE chunks, so memory stays flat whatever the file size.
+    The data goes to a .part file that is only renamed into place once its size (and git blob SHA, if given) checks out.
+    Failed attempts are retried with exponential backoff, resuming from the partial file with a Range request.
+    The resume is conditional on the validator of the response the partial file came from (If-Range, kept in
+    .part.json), so a file that changed upstream in the meantime comes back whole instead of as a mismatched tail.
+    Returns (response, sha256), or (response, None) when the server answered 304 Not Modified.
+    """
+    tmp_path = filepath + ".part"
+    for attempt in range(MAX_RETRIES + 1):
+        offset = os.path.getsize(tmp_path) if os.path.exists(tmp_path) else 0
+        validator = part_validator(tmp_path) if offset else None
+        if offset and not validator:
+            #no way to tell whether the server still has the version the partial file came from
+            remove_part(tmp_path)
+            offset = 0
+        request_headers = dict(headers or {})
+        if offset:
+            request_headers["Range"] = f"bytes={offset}-"
+            request_headers["If-Range"] = validator
+        resumable = False
+
+        try:
+            async with client.stream("GET", url, headers=request_headers) as response:
+                if response.status_code == 304:
+                    return response, None
+                if response.status_code in RETRY_STATUSES or response.status_code == 416:
+                    raise httpx.HTTPStatusError(f"HTTP {response.status_code}", request=response.request, response=response)
+                if response.status_code not in (200, 206):
+                    raise Exception(f"Failed to fetch data: HTTP {response.status_code}")
+
+                if response.status_code == 200:
+                    #no resume (or the file changed since the partial one), so write from the start
+                    offset = 0
+                    save_json({"etag": response.headers.get("ETag"), "last_modified": response.headers.get("Last-Modified")},
+                              tmp_path + ".json")
+                size = expected_size(response, offset)
+                resumable = size is not None  #a compressed body can't be resumed by byte range
+                with open(tmp_path, "ab" if offset else "wb") as file:
+                    async for chunk in response.aiter_bytes(CHUNK_SIZE):
+                        file.write(chunk)
+                        stages.add(bytes_downloaded=len(chunk))
+
+            if size is not None and os.path.getsize(tmp_path) != size:
+                raise IncompleteDownload(f"got {os.path.getsize(tmp_path)} of {size} bytes")
+            #hashing a big file would hold up the other downloads, so it runs in a thread
+            sha256, actual_blob_sha = await asyncio.to_thread(file_hashes, tmp_path)
+            if blob_sha and actual_blob_sha != blob_sha:
+                resumable = False
+                raise IncompleteDownload(f"checksum mismatch, expected blob {blob_sha}")
+
+            os.replace(tmp_path, filepath)
+            remove_part(tmp_path)
+            return response, sha256
+
+        except (httpx.TransportError, httpx.HTTPStatusError, IncompleteDownload) as e:
+            #keep a clean partial file to resume from, drop anything else
+            if not resumable:
+                remove_part(tmp_path)
+            if attempt == MAX_RETRIES:
+                raise
+            delay = BACKOFF_SECONDS * 2 ** attempt
+            print(f"Download of {url} failed ({e}), retrying in {delay}s..")
+            await asyncio.sleep(delay)
+
+def row_date(row):
+    #every dataset in data-darah-public starts with an ISO date column, so dates compare as bytes
+    return row[:10]
+
+def local_max_date(filepath):
+    """
+    Scan a local CSV for its latest date (only needed once per file, when the manifest has no date for it).
+    """
+    max_date = b""
+    with open(filepath, "rb") as file:
+        next(file, None)  #skip header
+        for row in file:
+            if row.strip():
+                max_date = max(max_date, row_date(row))
+    return max_date.decode() or None
+
+def csv_rows(filepath):
+    with open(filepath, "rb") as file:
+        next(file, None)  #skip header
+        return [row.rstrip(b"\r\n") for row in file if row.strip()]
+
+def replace_with_download(filepath, download_path):
+    max_date = local_max_date(download_path)
+    with open(download_path, "rb") as file:
+        rows_written = sum(1 for row in file if row.strip()) - 1
+    os.replace(download_path, filepath)
+    return rows_written, max_date, True
+
+def merge_csv(filepath, download_path, last_date):
+    """
+    Merge a freshly downloaded CSV into the local copy by appending only the rows dated after last_date.
+    The download simply replaces the local copy when there is no usable one or the header changed, and also
+    when its rows up to last_date are not exactly the local rows (a backfilled or revised row for an older date).
+    Returns (rows_written, max_date, replaced).
+    """
+    with open(download_path, "rb") as file:
+        header = file.readline().rstrip(b"\n")
+
+    local_header = None
+    if os.path.exists(filepath):
+        with open(filepath, "rb") as file:
+            local_header = file.readline().rstrip(b"\n")
+        if last_date is None:
+            last_date = local_max_date(filepath)
+
+    if local_header != header or last_date is None or not header.startswith(b"date,"):
+        return replace_with_download(filepath, download_path)
+
+    #the MoH files are sorted by state then date, so appended rows end up grouped by sync date instead
+    last_date = last_date.encode()
+    new_rows, old_rows = [], []
+    for row in csv_rows(download_path):
+        (new_rows if row_date(row) > last_date else old_rows).append(row)
+    #appending only the new dates would drop a row added or revised upstream for an older date for good,
+    #while the manifest records the upstream hash
+    if sorted(old_rows) != sorted(csv_rows(filepath)):
+        print(f"{os.path.basename(filepath)} changed upstream on or before {last_date.decode()}, replacing the local copy")
+        return replace_with_download(filepath, download_path)
+    os.remove(download_path)
+
+    if new_rows:
+        with open(filepath, "rb+") as file:
+            file.seek(0, os.SEEK_END)
+            file.seek(file.tell() - 1)
+            missing_newline = file.read(1) != b"\n"
+            file.write((b"\n" if missing_newline else b"") + b"\n".join(new_rows) + b"\n")
+        last_date = max(row_date(row) for row in new_rows)
+    return len(new_rows), last_date.decode(), False
+
+async def github_api(client, url, manifest, params=None, keep=lambda body: body):
+    """
+    GET a GitHub API endpoint conditionally: the ETag of the last answer goes out as If-None-Match, and a
+    304 (which GitHub doesn't count against the rate limit) reuses the body kept in the manifest.
+    keep trims the body to what is worth keeping there.
+    """
+    key = str(httpx.URL(url, params=params))
+    cached = manifest.setdefault("api", {}).get(key)
+    headers = {"If-None-Match": cached["etag"]} if cached and cached.get("etag") else {}
+    with stages.stage("github_api") as stage:
+        response = await client.get(url, params=params, headers=headers)
+        stage["bytes_downloaded"] += len(response.content)
+    manifest.setdefault("api_used", []).append(key)
+    if response.status_code == 304 and cached:
+        stages.count(github_api_not_modified=1)
+        return cached["body"]
+    response.raise_for_status()
+    stages.count(github_api_calls=1)
+    manifest["api"][key] = {"etag": response.headers.get("ETag"), "body": keep(response.json())}
+    return manifest["api"][key]["body"]
+
+async def fetch_latest_commit(client, manifest):
     """
     Fetch the latest commit from the GitHub repository.
     """
-    url = f"https://api.github.com/repos/{REPO}/commits"
+    url = f"{GITHUB_API}/repos/{REPO}/commits"
     params = {"sha": BRANCH, "per_page": 1}
-    response = requests.get(url, params=params)
-    return response.json()[0]  # Return the latest commit
+    commits = await github_api(client, url, manifest, params=params,
+                               keep=lambda body: [{"sha": c["sha"], "commit": {"author": {"date": c["commit"]["author"]["date"]}}}
+                                                  for c in body[:1]])
+    return commits[0]  # Return the latest commit
 
-def download_file(url, filename):
+async def download_file(client, url, filename, manifest, blob_sha=None, full=False):
     """
-    Download a file from the given URL.
+    Download a CSV file from the given URL and merge it into the local copy.
+    Unless full is set, the request is conditional and only new date rows are appended.
+    Returns True if the local file changed.
     """
-    response = requests.get(url)
-    if response.status_code == 200:
-        os.makedirs(CSV_FOLDER, exist_ok=True)
-        filepath = os.path.join(CSV_FOLDER, filename)
-        with open(filepath, 'wb') as file:
-            file.write(response.content)
+    entry = manifest["files"].setdefault(filename, {})
+    os.makedirs(CSV_FOLDER, exist_ok=True)
+    filepath = os.path.join(CSV_FOLDER, filename)
+    headers = {} if full or not os.path.exists(filepath) else conditional_headers(entry)
+
+    download_path = filepath + ".download"
+    with stages.stage(f"download:{filename}"):
+        response, sha256 = await stream_download(client, url, download_path, headers=headers, blob_sha=blob_sha)
+
+    if sha256 is None or (not full and entry.get("sha256") == sha256):
+        if sha256 is not None:
+            os.remove(download_path)
+        entry["sha"] = blob_sha
+        print(f"Unchanged: {filename}")
+        return False
+
+    if full:
+        os.replace(download_path, filepath)
+        entry.pop("max_date", None)  #worked out again on the next incremental sync
+        replaced = True
         print(f"Downloaded: {filename}")
+    else:
+        with stages.stage(f"merge:{filename}") as stage:
+            rows_written, entry["max_date"], replaced = await asyncio.to_thread(merge_csv, filepath, download_path, entry.get("max_date"))
+            stage["rows"] += rows_written
+        print(f"Downloaded: {filename} ({rows_written} new rows)")
+    if replaced:
+        #the rollups only parse what was appended to a file, so a replaced one is rebuilt from scratch
+        from rollups import invalidate
+        invalidate(os.path.splitext(filename)[0])
+    update_manifest_entry(entry, response, sha256)
+    entry["sha"] = blob_sha
+    return True
 
-def process_latest_commit(commit):
+async def process_latest_commit(client, commit, manifest, full=False):
     """
-    Process the latest commit, download CSV files if the commit is new.
+    Process the latest commit: if it is new and from today, download its changed CSV files together with the
+    granular parquet, MAX_DOWNLOADS at a time. Files whose blob SHA is already recorded in the manifest are skipped.
+    Returns (data_fetched, granular_fetched).
     """
     data_fetched = False  # Flag to indicate if new data was fetched
-    last_commit_sha = fetch_last_commit_sha()
+    granular_fetched = False
+    last_commit_sha = fetch_last_commit_sha(manifest)
     current_commit_sha = commit['sha']
 
     # Check if the current commit is different from the last processed commit
-    if last_commit_sha != current_commit_sha:
+    if full or last_commit_sha != current_commit_sha:
         commit_date = datetime.strptime(commit['commit']['author']['date'], "%Y-%m-%dT%H:%M:%SZ").date()
         today = datetime.now().date()
 
         # Process the commit only if it's from today
         if commit_date == today:
             print("Latest commit is from today! Fetching the data now..")
-            commit_url = f"https://api.github.com/repos/{REPO}/commits/{current_commit_sha}"
-            commit_response = requests.get(commit_url).json()
-            files = commit_response.get("files", [])
-            for file in files:
-                if file['filename'].endswith(".csv"):
-                    download_file(file['raw_url'], file['filename'])
-                    data_fetched = True  # Set flag to True as new data is fetched
-            update_last_commit_sha(current_commit_sha)
+            commit_url = f"{GITHUB_API}/repos/{REPO}/commits/{current_commit_sha}"
+            commit_response = await github_api(client, commit_url, manifest,
+                                               keep=lambda body: {"files": [{key: file.get(key) for key in ("filename", "sha", "raw_url")}
+                                                                            for file in body.get("files", [])]})
+            changed = []
+            for file in commit_response.get("files", []):
+                if not file['filename'].endswith(".csv"):
+                    continue
+                entry = manifest["files"].get(file['filename'], {})
+                if not full and file.get('sha') and entry.get('sha') == file['sha']:
+                    print(f"Unchanged: {file['filename']}")
+                    continue
+                changed.append(file)
+
+            slots = asyncio.Semaphore(MAX_DOWNLOADS)
+            async def limited(download):
+                async with slots:
+                    return await download
+            downloads = [download_file(client, file['raw_url'], file['filename'], manifest, blob_sha=file.get('sha'), full=full)
+                         for file in changed]
+            #the granular parquet is asked for on every new commit, not only along with changed CSVs: a retry after a
+            #failed sync finds its CSVs merged already, and the request is conditional, so it costs a 304 when unchanged
+            downloads.append(fetch_parquet_data(client, GRANULAR_URL, 'ds-data-granular', manifest, full=full))
+            #let every download finish (and be recorded in the manifest) before raising the first failure
+            results = await asyncio.gather(*map(limited, downloads), return_exceptions=True)
+            if any(result is True for result in results[:-1]):
+                #the merged CSVs are skipped as unchanged from now on, so the report they need is remembered until
+                #a sync gets through (see sync)
+                manifest["report_pending"] = True
+            for result in results:
+                if isinstance(result, BaseException):
+                    raise result
+            data_fetched, granular_fetched = any(results[:-1]), results[-1]
+            update_last_commit_sha(manifest, current_commit_sha)
         else:
             print("No new commit for today.")
     else:
         print("Latest commit already processed. No new files to download.")
 
-    return data_fetched
+    return data_fetched, granular_fetched
 
-def fetch_parquet_data(url,save_filename):
-    # Send a GET request to the URL
+async def fetch_parquet_data(client, url, save_filename, manifest, full=False):
+    """
+    Download the granular parquet, unless the server reports it unchanged since the last sync.
+    Returns True if a new file was saved.
+    """
     save_directory='data-granular'
-    response = requests.get(url)
+    # Create the save directory if it doesn't exist
+    os.makedirs(save_directory, exist_ok=True)
+    filepath = os.path.join(save_directory, save_filename)
+    entry = manifest["files"].setdefault(save_filename, {})
+    headers = {} if full or not os.path.exists(filepath) else conditional_headers(entry)
 
-    # Check if the request was successful
-    if response.status_code == 200:
-        # Create the save directory if it doesn't exist
-        os.makedirs(save_directory, exist_ok=True)
+    # Stream the Parquet data to the specified file
+    with stages.stage(f"download:{save_filename}"):
+        response, sha256 = await stream_download(client, url, filepath, headers=headers)
 
-        # Specify the full path to save the Parquet file
-        filepath = os.path.join(save_directory, save_filename)
+    if sha256 is None:
+        print(f"Unchanged: {save_filename}")
+        return False
 
-        # Save the Parquet data to the specified file
-        with open(filepath, 'wb') as file:
-            file.write(response.content)
+    update_manifest_entry(entry, response, sha256)
+    print(f"Downloaded: {save_filename}")
+    return True
 
-        print(f"Downloaded: {save_filename}")
-    else:
-        raise Exception(f"Failed to fetch data: HTTP {response.status_code}")
+async def sync(full=False, write_flag=True, client=None):
+    """
+    Sync the datasets. Returns True when new data was fetched; the flag file for send_to_telegram.py
+    is only written when write_flag is set (the scheduler daemon triggers the report in-process instead).
+    A long-running caller passes its own client, so connections stay open between syncs.
+    """
+    manifest = load_manifest()
+
+    #time every stage of the sync (see stages.py)
+    with stages.run("fetch"):
+        try:
+            async with make_client() if client is None else contextlib.nullcontext(client) as client:
+                #fetch data-darah-public, and the granular data with it
+                latest_commit = await fetch_latest_commit(client, manifest)
+                data_fetched, granular_fetched = await process_latest_commit(client, latest_commit, manifest, full=full)
+            #CSVs merged by an earlier sync that failed on another download still need their report
+            data_fetched = data_fetched or manifest.get("report_pending", False)
 
-def main():
-    #fetch data-darah-public
-    latest_commit = fetch_latest_commit()
-    data_fetched = process_latest_commit(latest_commit)
+            if data_fetched:
+                #fold the newly appended rows into the pre-aggregated rollups, off the event loop
+                from rollups import update_all
+                with stages.stage("rollups"):
+                    await asyncio.to_thread(update_all, CSV_FOLDER)
 
-    if data_fetched:
-        with open('data_fetched.txt', 'w') as flag_file:
-            flag_file.write('Data fetched')
+                if write_flag:
+                    with open('data_fetched.txt', 'w') as flag_file:
+                        flag_file.write('Data fetched')
+                manifest.pop("report_pending", None)
+
+            #fold the new visits into the per-donor table, unless the report recomputes from the whole granular file
+            recomputed = os.environ.get('GRANULAR_MEMORY_BUDGET_MB') or os.environ.get('GRANULAR_WORKERS')
+            if granular_fetched and not recomputed:
+                from donor_state import update_donor_state
+                with stages.stage("donor_state") as stage:
+                    stage["rows"] += await asyncio.to_thread(update_donor_state, os.path.join('data-granular', 'ds-data-granular'))
+        finally:
+            #keep only the API answers this sync asked for
+            used = set(manifest.pop("api_used", []))
+            manifest["api"] = {key: value for key, value in manifest.get("api", {}).items() if key in used}
+            #record whatever was merged, even if a later download failed, so rows are never appended twice
+            save_manifest(manifest)
+    return data_fetched
 
-    #fetch granular data
-        url = 'https://dub.sh/ds-data-granular'
-        save_filename='ds-data-granular'
-        fetch_parquet_data(url,save_filename)
+def main(full=False, write_flag=True):
+    return asyncio.run(sync(full=full, write_flag=write_flag))
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Fetch the latest blood donation data")
+    parser.add_argument('--full', action='store_true', help="re-download every file in full instead of syncing only the changes")
+    args = parser.parse_args()
+    main(full=args.full)
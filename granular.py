@@ -0,0 +1,94 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+GRANULAR_COLUMNS = ['donor_id', 'visit_date', 'birth_date']  #the only columns the report uses
+
+#the granular frame every report function reads: one row per visit, compact types, derived columns computed once
+#  donor_id       int32  dense code (0 .. n_donors-1), not the original ID
+#  donation_year  int16  year of the visit
+#  visit_day      int16  day of the year of the visit
+#  birth_date     int16  birth year
+#  age_at_visit   int16  donation_year - birth_date
+
+def visit_date_filter(schema, start_year=None, end_year=None, after=None):
+    """
+    Parquet filter on visit_date for start_year..end_year and/or visits after a date, in the column's
+    own type so it can be checked against the row group statistics.
+    """
+    date_type = schema.field('visit_date').type
+
+    def as_value(day):
+        day = pd.Timestamp(day)
+        if pa.types.is_string(date_type) or pa.types.is_large_string(date_type):
+            return day.strftime('%Y-%m-%d')
+        if pa.types.is_timestamp(date_type):
+            return day
+        return day.date()
+
+    filters = []
+    if start_year is not None:
+        filters.append(('visit_date', '>=', as_value(f'{start_year}-01-01')))
+    if end_year is not None:
+        filters.append(('visit_date', '<', as_value(f'{end_year + 1}-01-01')))
+    if after is not None:
+        #strings compare as dates too, as they are ISO formatted; a timestamp column compares from the next day
+        filters.append(('visit_date', '>=', as_value(pd.Timestamp(after) + pd.Timedelta(days=1))))
+    return filters or None
+
+def as_dates(array):
+    if pa.types.is_string(array.type) or pa.types.is_large_string(array.type):
+        array = pc.cast(pc.cast(array, pa.timestamp('s')), pa.date32(), safe=False)
+    elif pa.types.is_timestamp(array.type):
+        array = pc.cast(array, pa.date32(), safe=False)
+    return array
+
+def encode_donor_ids(column):
+    """
+    Dictionary-encode a donor_id column (Arrow ChunkedArray) to dense int32 codes.
+    """
+    #encoding the chunks in place shares one dictionary across them, without first copying the strings into one array
+    encoded = pc.dictionary_encode(column)
+    if encoded.num_chunks == 0:
+        return np.zeros(0, dtype=np.int32)
+    return np.concatenate([chunk.indices.to_numpy(zero_copy_only=False) for chunk in encoded.chunks]).astype(np.int32, copy=False)
+
+def build_frame(donor_codes, visit_date, birth_year):
+    donation_year = pc.year(visit_date).to_numpy(zero_copy_only=False).astype(np.int16)
+    birth_year = np.asarray(birth_year).astype(np.int16)
+    return pd.DataFrame({
+        'donor_id': donor_codes,
+        'donation_year': donation_year,
+        'visit_day': pc.day_of_year(visit_date).to_numpy(zero_copy_only=False).astype(np.int16),
+        'birth_date': birth_year,
+        'age_at_visit': donation_year - birth_year,
+    })
+
+def read_visits(path, start_year=None, end_year=None, after=None):
+    """
+    Read the columns the report uses as an Arrow table, with visit_date as date32.
+    start_year/end_year and after (a date, exclusive) are pushed down to the parquet reader,
+    which skips row groups outside the range.
+    """
+    filters = visit_date_filter(pq.read_schema(path), start_year, end_year, after)
+    table = pq.read_table(path, columns=GRANULAR_COLUMNS, filters=filters)
+    return table.set_column(1, 'visit_date', as_dates(table.column('visit_date').combine_chunks()))
+
+def load_granular(path, start_year=None, end_year=None):
+    """
+    Load the granular parquet into the compact frame above, for visits in start_year..end_year (default: all).
+    Note that first visits and retention cohorts need the whole history, so the report loads every year.
+    """
+    table = read_visits(path, start_year, end_year)
+    return build_frame(encode_donor_ids(table.column('donor_id')), table.column('visit_date'),
+                       table.column('birth_date').to_numpy())
+
+def from_frame(data):
+    """
+    Convert a raw granular DataFrame (donor_id, visit_date, birth_date) to the compact frame.
+    """
+    visit_date = pa.array(pd.to_datetime(data['visit_date']).to_numpy().astype('datetime64[D]'))
+    donor_codes, _ = pd.factorize(data['donor_id'])
+    return build_frame(donor_codes.astype(np.int32), visit_date, data['birth_date'].to_numpy())
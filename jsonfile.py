@@ -0,0 +1,22 @@
+#the small JSON files that track state between runs (sync manifest, rollup and donor state, cache indexes)
+import os
+import json
+
+def load_json(path):
+    """
+    The JSON object in path, or {} if it hasn't been written yet.
+    """
+    if os.path.exists(path):
+        with open(path, "r") as file:
+            return json.load(file)
+    return {}
+
+def save_json(data, path):
+    """
+    Write data to path atomically (a temporary file renamed over it), so a crash never leaves it half-written.
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as file:
+        json.dump(data, file, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
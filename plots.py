@@ -0,0 +1,244 @@
+#plot functions of the report. kept free of side effects at import, so render workers can import them
+import pandas as pd
+import os
+import io
+import matplotlib.pyplot as plt
+import matplotlib.dates as mdates
+import seaborn as sns
+
+OUTPUT_FOLDER = 'output'  #where copies of the charts are saved, pass output_folder=None to skip the disk
+#file name of each chart (the copy in the output folder)
+CHART_FILES = {
+    'count_new_donors_by_year': '1-New_Donors_Plot.png',
+    'plot_blood_donation_trends': '2-Monthly_Donations_Trend.png',
+    'plot_returning_new_donor_counts': '4-Count_new_returning_donor.png',
+    'plot_blood_donation_trends_by_state': '5-Donations_by_State.png',
+    'plot_donor_counts_by_age_and_year': '6-Donor_Count_Age_Year.png',
+    #one file per threshold, so the three heatmaps don't overwrite each other
+    'plot_donor_retention_heatmap': '7-Retention_Rate_Heatmap_{donated_min_x_times}x.png',
+}
+
+#every chart is drawn by a draw_* function that returns the figure, so templates.py can keep the figure and reuse it
+
+#to render a figure to PNG bytes and optionally keep a copy on disk
+def figure_png(fig, filename, output_folder):
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format='png')
+    png_bytes = buffer.getvalue()
+
+    if output_folder:
+        os.makedirs(output_folder, exist_ok=True)
+        with open(os.path.join(output_folder, filename), 'wb') as file:
+            file.write(png_bytes)
+    return png_bytes
+
+#to render a finished figure to PNG bytes, and close it so figures never pile up
+def finish_figure(fig, filename, output_folder):
+    png_bytes = figure_png(fig, filename, output_folder)
+    plt.close(fig)
+    return png_bytes
+
+#yearly totals of new donors in Malaysia (data is the 'yearly' rollup of newdonors_state, already summed)
+def new_donors_per_year(data, start_year, end_year):
+    malaysia_data = data[data['state'] == 'Malaysia']
+    return malaysia_data[malaysia_data['year'].between(start_year, end_year)].set_index('year')['total']
+
+#To count new donors by year and create a bar chart
+def count_new_donors_by_year(data, start_year, end_year, output_folder=OUTPUT_FOLDER):
+    fig = draw_new_donors_by_year(new_donors_per_year(data, start_year, end_year), start_year, end_year)
+    return finish_figure(fig, CHART_FILES['count_new_donors_by_year'], output_folder)
+
+def draw_new_donors_by_year(new_donors_by_year, start_year, end_year):
+    fig = plt.figure(figsize=(9, 5)) 
+    bars = plt.bar(new_donors_by_year.index, new_donors_by_year, color='blue', width=0.6)  
+    plt.xlabel('Year')
+    plt.ylabel('Total')
+    plt.title(f'New Donors ({start_year} to {end_year})')
+    plt.xticks(new_donors_by_year.index, rotation=0)
+
+    #annotation
+    for bar in bars:
+        height = bar.get_height()
+        plt.text(bar.get_x() + bar.get_width()/2.0, height, f'{int(height)}', ha='center', va='bottom')
+
+    plt.tight_layout()    
+    return fig
+
+
+#monthly donations in Malaysia (data is the 'monthly' rollup of donations_state, already summed)
+def monthly_donations(data, start_year, end_year):
+    #filter data based on the certain years and 'state' must be from 'Malaysia'
+    filtered_data = data[(data['month'].dt.year >= start_year) & (data['month'].dt.year <= end_year) & (data['state'] == 'Malaysia')]
+    return filtered_data.rename(columns={'month': 'date', 'daily': 'total_donations'}).reset_index(drop=True)
+
+#to plot monthly blood donation trends, and create a line chart
+def plot_blood_donation_trends(data, start_year, end_year, output_folder=OUTPUT_FOLDER):
+    fig = draw_blood_donation_trends(monthly_donations(data, start_year, end_year), start_year, end_year)
+    return finish_figure(fig, CHART_FILES['plot_blood_donation_trends'], output_folder)
+
+def draw_blood_donation_trends(monthly_total_donations, start_year, end_year):
+    fig = plt.figure(figsize=(15, 6))
+    sns.lineplot(x='date', y='total_donations', data=monthly_total_donations, color='maroon', marker='o')
+    plt.title(f'Trend of Total Monthly Blood Donations in Malaysia ({start_year} - {end_year})')
+    plt.xlabel('Month and Year')
+    plt.ylabel('Total Donations')
+
+    #format x-axis to show 'Month Year'
+    plt.gca().xaxis.set_major_formatter(mdates.DateFormatter('%b %Y'))
+    plt.gca().xaxis.set_major_locator(mdates.MonthLocator(interval=1))
+    plt.xticks(rotation=90)
+    plt.grid(True, which='both', linestyle='--', linewidth=0.5)
+
+    #annotate, but only the most recent data point (bcs its too crowded if all is annotated)
+    if not monthly_total_donations.empty:
+        last_row = monthly_total_donations.iloc[-1]
+        plt.text(last_row['date'], last_row['total_donations'], f"{last_row['total_donations']}", color='black', ha='center', va='bottom')
+
+    plt.tight_layout()
+    return fig
+
+#yearly donations per state (years as columns), the smallest state total first (data is the 'yearly' rollup of donations_state)
+def donations_by_state(data, start_year, end_year):
+    yearly_donations = data[(data['year'] >= start_year) & (data['year'] <= end_year) & (data['state'] != 'Malaysia')] #state != Malaysia
+
+    #pivot the data to hv years as columns
+    pivoted_data = yearly_donations.pivot(index='state', columns='year', values='daily').fillna(0)
+
+    #sum of donations for each state
+    total_donations_by_state = pivoted_data.sum(axis=1).sort_values(ascending=True)
+    return pivoted_data.loc[total_donations_by_state.index]
+
+def plot_blood_donation_trends_by_state(data, start_year, end_year, output_folder=OUTPUT_FOLDER):
+    fig = draw_blood_donation_trends_by_state(donations_by_state(data, start_year, end_year), start_year, end_year)
+    return finish_figure(fig, CHART_FILES['plot_blood_donation_trends_by_state'], output_folder)
+
+def draw_blood_donation_trends_by_state(sorted_pivoted_data, start_year, end_year):
+    overall_total = sorted_pivoted_data.to_numpy().sum()
+
+    #draw on our own axes; pandas would otherwise open a second figure and leave this one blank
+    fig, ax = plt.subplots(figsize=(10, 10))
+    sorted_pivoted_data.plot(kind='barh', stacked=True, ax=ax)
+    plt.title(f'Comparison of Total Blood Donations by State ({start_year}-{end_year})')
+    plt.xlabel('Total Donations')
+    plt.ylabel('State')
+
+    ax.grid(axis='x', linestyle='--', alpha=0.7)
+    #annotate to show count & %
+    for idx, state in enumerate(sorted_pivoted_data.index):
+        total_donations = sorted_pivoted_data.loc[state].sum()
+        percentage = (total_donations/overall_total)*100
+        plt.annotate(f'{total_donations:,.0f} ({percentage:.1f}%)', (total_donations + 500, idx), fontsize=10, va='center')
+
+    #remove x-axis tick labels bcs crowded
+    plt.xticks([])
+    plt.legend(title='Year')
+    return fig
+
+#to find how many new & returning donors donate each year (aggregated once in the main process, plotted in a worker)
+#data is the compact granular frame from granular.py, which is shared and never modified here
+def donor_status_counts(data):
+    first_donation_year = data.groupby('donor_id')['donation_year'].transform('min')
+
+    #determine status; whether each donation was made by a 'New' or 'Returning' donor
+    #the first donation year of each donor is 'New', every later year 'Returning'
+    donor_status = pd.Series('Returning', index=data.index).where(data['donation_year'] != first_donation_year, 'New')
+
+    #agg count unique donors per year by status; new or returning
+    donor_counts_per_year = data['donor_id'].groupby([data['donation_year'], donor_status.rename('donor_status')]).nunique().unstack(fill_value=0)
+    return donor_counts_per_year
+
+def plot_returning_new_donor_counts(donor_counts_per_year, output_folder=OUTPUT_FOLDER):
+    fig = draw_returning_new_donor_counts(donor_counts_per_year)
+    return finish_figure(fig, CHART_FILES['plot_returning_new_donor_counts'], output_folder)
+
+def draw_returning_new_donor_counts(donor_counts_per_year):
+    fig = plt.figure(figsize=(10, 6))
+
+    #stacked bar chart
+    bars_new = plt.bar(donor_counts_per_year.index.astype(str), donor_counts_per_year['New'], color='lightgreen', label='New')
+    bars_returning = plt.bar(donor_counts_per_year.index.astype(str), donor_counts_per_year['Returning'], bottom=donor_counts_per_year['New'], color='skyblue', label='Returning')
+
+    plt.grid(axis='y', linestyle='--', alpha=0.7)
+
+    #annotate
+    for bars in [bars_new, bars_returning]:
+        for bar in bars:
+            yval = bar.get_height()
+            text = plt.text(bar.get_x() + bar.get_width() / 2, bar.get_y() + yval / 2, int(yval), ha='center', va='center')
+            text.set_visible(yval > 0)  # Only annotate non-zero bars (hidden, so a template can show it later)
+
+    plt.title('Count of New-Donors & Returning-Donors Per Year')
+    plt.xlabel('Year')
+    plt.ylabel('Count of Donors')
+    plt.xticks(rotation=0) 
+    plt.legend()
+    plt.tight_layout()
+    return fig
+
+AGE_BINS = [17, 25, 30, 35, 40, 45, 50, 55]
+AGE_LABELS = ['17-24', '25-29', '30-34', '35-39', '40-44', '45-49', '50-54']
+
+#to count unique donors per age group & year (aggregated once in the main process, plotted in a worker)
+def age_group_year_counts(data, start_year, end_year):
+    #filter for the years between start_year and end_year
+    filtered_data = data[data['donation_year'].between(start_year, end_year)]
+    age_group = pd.cut(filtered_data['age_at_visit'], bins=AGE_BINS, labels=AGE_LABELS, right=False).rename('age_group')
+
+    #make sure count unique donor_id
+    age_group_year_counts = filtered_data['donor_id'].groupby([age_group, filtered_data['donation_year']], observed=True).nunique().reset_index() 
+    #observed=true bcs the default observe=false is deprecating (got FutureWarning)
+
+    age_group_year_counts = age_group_year_counts[age_group_year_counts['age_group'].isin(AGE_LABELS)] #labels is only until age 50-54
+    return age_group_year_counts
+
+def plot_donor_counts_by_age_and_year(age_group_year_counts, start_year, end_year, output_folder=OUTPUT_FOLDER):
+    fig = draw_donor_counts_by_age_and_year(age_group_year_counts, start_year, end_year)
+    return finish_figure(fig, CHART_FILES['plot_donor_counts_by_age_and_year'], output_folder)
+
+def draw_donor_counts_by_age_and_year(age_group_year_counts, start_year, end_year):
+    fig = plt.figure(figsize=(10, 6))
+    sns.barplot(x='age_group', y='donor_id', hue='donation_year', data=age_group_year_counts) #huee is the year
+    plt.title(f'Count of Donors by Age Group and Year ({start_year}-{end_year})')
+    plt.xlabel('Age Group')
+    plt.ylabel('Count of Donors')
+    plt.legend(title='Donation Year', bbox_to_anchor=(1.05, 1), loc='upper left')
+
+    plt.tight_layout()
+    return fig
+
+#percentage_data comes from retention.retention_tables, which builds all thresholds in one pass
+def plot_donor_retention_heatmap(percentage_data, donated_min_x_times, output_folder=OUTPUT_FOLDER):
+    fig = draw_donor_retention_heatmap(percentage_data, donated_min_x_times)
+    filename = CHART_FILES['plot_donor_retention_heatmap'].format(donated_min_x_times=donated_min_x_times)
+    return finish_figure(fig, filename, output_folder)
+
+def draw_donor_retention_heatmap(percentage_data, donated_min_x_times):
+    fig = plt.figure(figsize=(8, 8))
+    ax = sns.heatmap(percentage_data, annot=True, cmap="Blues", fmt="d", cbar=False)
+    plt.title(f'% of Donors Still Donating After N Years (at least {donated_min_x_times}x times)')
+    plt.xlabel('N Years since the donors first donation')
+    plt.ylabel('Year (cohort)')
+    ax.xaxis.tick_top()
+    ax.xaxis.set_label_position('top') 
+    plt.yticks(rotation=0)
+    
+    ax.text(5, 10, sample_interpretation(percentage_data, donated_min_x_times), fontsize=10, color='black', ha='left', va='center')
+    
+    for text in ax.texts:
+        if text.get_text() == '0':
+            text.set_text('')
+    return fig
+
+#dynamic sample interpretation
+def sample_interpretation(percentage_data, donated_min_x_times):
+    example_year = 2023  #example
+    example_n_years = 1  #example
+    if example_n_years < percentage_data.shape[1]:  # Ensure N is within the range
+        example_percentage = percentage_data.loc[example_year, example_n_years]
+        sample_interpretation = (f"Sample Interpretation:\n"
+                                 f"In cohort year {example_year}, {example_percentage}% of those who donated\n"
+                                 f"at least {donated_min_x_times}x in {example_year} have\n"
+                                 f"made donation after {example_n_years} year({example_year+1}).")
+    else:
+        sample_interpretation = "Sample interpretation not available for the selected N years."
+    return sample_interpretation
@@ -0,0 +1,187 @@
+#interactive commands: subscribers ask for donation counts by state and period, e.g. "/donations Selangor 2024-03"
+#or "/newdonors Johor last 30 days", answered from prefix sums kept in memory
+import os
+import re
+import asyncio
+import calendar
+import numpy as np
+
+FOLDER_PATH = './data-darah-public'
+#command -> (dataset, column that is summed, what it counts)
+DATASETS = {'donations': ('donations_state', 'daily', 'Blood donations'),
+            'newdonors': ('newdonors_state', 'total', 'New donors')}
+REFRESH_SECONDS = 60  #how often the CSVs are checked for new data while the bot is running
+USAGE = ("Usage: /{command} [state] [period]\n"
+         "period: 2024, 2024-03, 2024-03-05, 2024-03-01 2024-03-31 or last 30 days (default: the latest day)\n"
+         "e.g. /{command} Selangor 2024-03, /{command} Johor last 30 days")
+
+def normalize(name):
+    return re.sub(r'[^a-z ]', '', name.lower()).split()
+
+class PrefixSums:
+    """
+    The daily totals of one dataset per state, as running sums over a dense calendar:
+    sums[state, i] is the total of the days before start + i, so any date range sums in O(1).
+    """
+    def __init__(self, data, measure):
+        dates = data['date'].to_numpy().astype('datetime64[D]')
+        self.start = dates.min()
+        self.end = dates.max()
+        states = data['state'].astype(str).to_numpy()
+        self.states, state_codes = np.unique(states, return_inverse=True)
+        days = (dates - self.start).astype(np.int64)
+        daily = np.zeros((len(self.states), int(days.max()) + 1), dtype=np.int64)
+        np.add.at(daily, (state_codes, days), data[measure].to_numpy().astype(np.int64))
+        self.sums = np.zeros((len(self.states), daily.shape[1] + 1), dtype=np.int64)
+        np.cumsum(daily, axis=1, out=self.sums[:, 1:])
+        self.lookup = {tuple(normalize(state)): i for i, state in enumerate(self.states)}
+
+    def find_state(self, words):
+        """
+        The state named by words: an exact match, or the only state whose name ends with them ("kuala lumpur").
+        """
+        key = tuple(normalize(' '.join(words)))
+        if key in self.lookup:
+            return self.states[self.lookup[key]]
+        matches = [state for name, state in zip(self.lookup, self.states) if key and name[-len(key):] == key]
+        return matches[0] if len(matches) == 1 else None
+
+    def total(self, state, first, last):
+        """
+        Sum of state's days from first to last (datetime64[D], inclusive), clipped to the data.
+        """
+        row = self.sums[self.lookup[tuple(normalize(state))]]
+        first = max(first, self.start)
+        last = min(last, self.end)
+        if first > last:
+            return None
+        return int(row[(last - self.start).astype(int) + 1] - row[(first - self.start).astype(int)])
+
+def parse_period(words, as_of):
+    """
+    Split a query into (state words, first day, last day, label), the period being the trailing words.
+    """
+    day = r'\d{4}-\d{2}-\d{2}'
+    text = ' '.join(words).lower()
+    match = re.search(r'(?:^|\s)last (\d+) days?$', text)
+    if match:
+        n = int(match.group(1))
+        first = as_of - np.timedelta64(n - 1, 'D')
+        return text[:match.start()].split(), first, as_of, f"last {n} days ({first} to {as_of})"
+    match = re.search(rf'(?:^|\s)({day})(?: to | )({day})$', text)
+    if match:
+        first, last = np.datetime64(match.group(1)), np.datetime64(match.group(2))
+        return text[:match.start()].split(), first, last, f"{first} to {last}"
+    match = re.search(rf'(?:^|\s)({day}|\d{{4}}-\d{{2}}|\d{{4}})$', text)
+    if match:
+        period = match.group(1)
+        if len(period) == 4:
+            first, last, label = np.datetime64(f'{period}-01-01'), np.datetime64(f'{period}-12-31'), period
+        elif len(period) == 7:
+            year, month = map(int, period.split('-'))
+            first = np.datetime64(f'{period}-01')
+            last = first + np.timedelta64(calendar.monthrange(year, month)[1] - 1, 'D')
+            label = f"{calendar.month_name[month]} {year}"
+        else:
+            first = last = np.datetime64(period)
+            label = period
+        return text[:match.start()].split(), first, last, label
+    return words, as_of, as_of, f"{as_of}"
+
+class QueryStore:
+    """
+    Prefix sums of every dataset in DATASETS, built once from the CSVs and never modified, so it can be
+    swapped for a new one while queries are being answered.
+    """
+    def __init__(self, folder_path=FOLDER_PATH):
+        from dataset_cache import load_dataset
+
+        self.signature = csv_signature(folder_path)
+        self.datasets = {}
+        for command, (dataset, measure, _) in DATASETS.items():
+            data = load_dataset(os.path.join(folder_path, f"{dataset}.csv"), columns=['date', 'state', measure])
+            self.datasets[command] = PrefixSums(data, measure)
+
+    def answer(self, command, args):
+        """
+        The reply to "/command args".
+        """
+        sums = self.datasets[command]
+        try:
+            state_words, first, last, label = parse_period(args, sums.end)
+        except ValueError:
+            return USAGE.format(command=command)
+        state = sums.find_state(state_words) if state_words else 'Malaysia'
+        if state is None:
+            return f"Unknown state: {' '.join(state_words)}\n" + USAGE.format(command=command)
+        if first > last:
+            return USAGE.format(command=command)
+
+        total = sums.total(state, first, last)
+        what = DATASETS[command][2]
+        if total is None:
+            return f"No data for {label} (data from {sums.start} to {sums.end})"
+        covered = (min(last, sums.end) - max(first, sums.start)).astype(int) + 1
+        note = f" (data up to {sums.end})" if last > sums.end else ""
+        average = f", {total / covered:,.0f} per day" if covered > 1 else ""
+        return f"{what} in {state}, {label}: {total:,}{average}{note}"
+
+def csv_signature(folder_path):
+    signature = []
+    for dataset, _, _ in DATASETS.values():
+        stat = os.stat(os.path.join(folder_path, f"{dataset}.csv"))
+        signature.append((stat.st_size, stat.st_mtime_ns))
+    return tuple(signature)
+
+class StoreHolder:
+    """
+    The current QueryStore. refresh() builds a new one in a thread when the CSVs changed and swaps it in with a
+    single assignment, so every query sees either the old data or the new, never a mix.
+    """
+    def __init__(self, folder_path=FOLDER_PATH):
+        self.folder_path = folder_path
+        self.store = QueryStore(folder_path)
+
+    async def refresh(self):
+        if csv_signature(self.folder_path) == self.store.signature:
+            return False
+        self.store = await asyncio.to_thread(QueryStore, self.folder_path)
+        return True
+
+    async def refresh_loop(self, interval=REFRESH_SECONDS):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.refresh()
+            except Exception as e:
+                print(f"Query store refresh failed: {e}")
+
+#===============Telegram commands==============
+
+def build_application(token, holder, base_url='https://api.telegram.org/bot'):
+    """
+    A python-telegram-bot Application answering /donations and /newdonors from holder's store.
+    """
+    from telegram.ext import Application, CommandHandler, filters
+
+    def handler(command):
+        async def reply(update, context):
+            await update.effective_message.reply_text(holder.store.answer(command, context.args))
+        return reply
+
+    async def post_init(application):
+        application.create_task(holder.refresh_loop())
+
+    application = Application.builder().token(token).base_url(base_url).concurrent_updates(True).post_init(post_init).build()
+    for command in DATASETS:
+        #CommandHandler also matches an edited command, which has no update.message; answer each command once
+        application.add_handler(CommandHandler(command, handler(command), filters=filters.UpdateType.MESSAGE))
+    return application
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+    load_dotenv()
+
+    holder = StoreHolder()
+    print(f"Answering queries on data up to {holder.store.datasets['donations'].end}")
+    build_application(os.environ.get('BOT_TOKEN'), holder).run_polling()
@@ -0,0 +1,76 @@
+#renders the report charts to PNG bytes in a pool of worker processes, so charts draw in parallel while earlier ones upload
+import os
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+
+import stages
+
+def init_renderer():
+    #headless backend, and imported once per process instead of once per chart
+    import matplotlib
+    matplotlib.use('Agg')
+    import plots  # noqa: F401
+
+def init_worker():
+    #a forked worker inherits the run that was open in the parent; its renders are recorded by the parent instead
+    stages.current_run.set(None)
+    stages.open_stages.set(())
+    init_renderer()
+
+def render_png(plot_name, args, kwargs, templated=False):
+    """
+    Run one plot function from plots.py, which returns the figure it drew as PNG bytes, or with templated
+    reuse the figure this process drew for the chart last time (see templates.py).
+    Returns (png_bytes, the stage record of the render).
+    """
+    import plots
+    with stages.stage(f'render:{plot_name}') as stage:
+        if templated:
+            import templates
+            png_bytes = templates.render(plot_name, *args, **kwargs)
+        else:
+            png_bytes = getattr(plots, plot_name)(*args, **kwargs)
+    return png_bytes, stage
+
+class ChartRenderer:
+    """
+    Submit charts with render(plot_name, *args, **kwargs), which returns an asyncio future of the PNG bytes.
+    With workers=0 every chart is rendered inline, one after another (the old behaviour).
+    Copies of the charts are also saved to output_folder, unless it is None.
+    With templated, every process keeps each chart's figure and only updates its data on the next render,
+    which pays off when the renderer stays open for many reports (the scheduler daemon).
+    """
+    def __init__(self, workers=None, output_folder='output', templated=False):
+        self.workers = os.cpu_count() if workers is None else workers
+        self.output_folder = output_folder
+        self.templated = templated
+        self.pool = None
+
+    def __enter__(self):
+        if self.workers:
+            self.pool = ProcessPoolExecutor(max_workers=self.workers, initializer=init_worker)
+        else:
+            #inline renders are stages of the run that is open here, so the stage context is left alone
+            init_renderer()
+        return self
+
+    def __exit__(self, *exc):
+        if self.pool:
+            self.pool.shutdown(cancel_futures=True)
+        elif self.templated:
+            import templates
+            templates.close_all()
+
+    def render(self, plot_name, *args, **kwargs):
+        kwargs.setdefault('output_folder', self.output_folder)
+        loop = asyncio.get_running_loop()
+        if self.pool:
+            async def rendered():
+                png_bytes, stage = await loop.run_in_executor(self.pool, render_png, plot_name, args, kwargs, self.templated)
+                #measured in the worker process, kept in this process's run
+                stages.record(stage)
+                return png_bytes
+            return asyncio.ensure_future(rendered())
+        future = loop.create_future()
+        future.set_result(render_png(plot_name, args, kwargs, self.templated)[0])
+        return future
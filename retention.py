@@ -0,0 +1,91 @@
+import numpy as np
+import pandas as pd
+
+#number of set bits for every possible byte, used to count donors in the packed bitsets
+POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+def build_presence_matrix(data):
+    """
+    Build the year x donor matrix of visit counts in a single pass over the granular data
+    (the compact frame from granular.py, where donor_id is already a dense int32 code).
+    Returns (counts, min_year), where counts[year - min_year, donor_code] is the number
+    of visits made by that donor in that year.
+    """
+    visit_year = data['donation_year'].to_numpy()
+    codes = data['donor_id'].to_numpy()
+    n_donors = int(codes.max()) + 1
+
+    min_year = int(visit_year.min())
+    max_year = int(visit_year.max())
+    n_years = max_year - min_year + 1
+
+    #stable sort on a small int is a radix sort, so this groups the visits by year in O(n)
+    year_idx = (visit_year - min_year).astype(np.int16)
+    order = np.argsort(year_idx, kind='stable')
+    bounds = np.searchsorted(year_idx[order], np.arange(n_years + 1))
+
+    counts = np.zeros((n_years, n_donors), dtype=np.uint16)
+    for y in range(n_years):
+        year_codes = codes[order[bounds[y]:bounds[y + 1]]]
+        year_counts = np.bincount(year_codes, minlength=n_donors)
+        counts[y] = np.minimum(year_counts, np.iinfo(np.uint16).max)
+
+    return counts, min_year
+
+def popcount_rows(bitsets):
+    """
+    Count the set bits along the last axis of a packed bitset array.
+    """
+    return POPCOUNT_TABLE[bitsets].sum(axis=-1, dtype=np.int64)
+
+def retention_tables(data, thresholds):
+    """
+    Compute the retention heatmap tables for several donated_min_x_times thresholds at once.
+
+    For each threshold x, the cohort of a year is every donor who donated at least x times
+    in that year, and cell (year, N) is the % of that cohort who donated again in year + N.
+    Returns a dict {x: DataFrame} indexed by cohort year with N years as columns.
+    """
+    counts, min_year = build_presence_matrix(data)
+    return retention_from_counts(counts, min_year, thresholds)
+
+def retention_from_counts(counts, min_year, thresholds):
+    """
+    retention_tables from an already built year x donor matrix of visit counts (see build_presence_matrix).
+    """
+    cohort_sizes, still_donating = cohort_counts(counts, thresholds)
+    return retention_percentages(cohort_sizes, still_donating, min_year, thresholds)
+
+def cohort_counts(counts, thresholds):
+    """
+    The donor counts behind the retention tables, for a year x donor matrix of visit counts:
+    cohort_sizes[t, y] donors with at least thresholds[t] visits in year y, and still_donating[t, y, N]
+    of those who visited again in year y + N. Both are plain sums over donors, so the counts of
+    disjoint sets of donors can be added together.
+    """
+    n_years = counts.shape[0]
+    thresholds = list(thresholds)
+
+    #one bit per donor, one row per year
+    presence = np.packbits(counts > 0, axis=1)
+    cohorts = np.stack([np.packbits(counts >= x, axis=1) for x in thresholds])
+
+    cohort_sizes = popcount_rows(cohorts)  # (thresholds, years)
+    still_donating = np.zeros((len(thresholds), n_years, n_years), dtype=np.int64)
+    for N in range(n_years):
+        #cohort year y against visit year y + N, for every threshold and cohort year at once
+        still_donating[:, :n_years - N, N] = popcount_rows(cohorts[:, :n_years - N] & presence[N:])
+    return cohort_sizes, still_donating
+
+def retention_percentages(cohort_sizes, still_donating, min_year, thresholds):
+    """
+    Turn cohort_counts into the retention tables: {x: DataFrame} indexed by cohort year with N years as columns.
+    """
+    n_years = cohort_sizes.shape[1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        percentages = np.where(cohort_sizes[:, :, None] > 0,
+                               np.rint(still_donating / cohort_sizes[:, :, None] * 100), 0).astype(int)
+
+    years = range(min_year, min_year + n_years)
+    return {x: pd.DataFrame(percentages[i], index=years, columns=range(n_years))
+            for i, x in enumerate(thresholds)}
@@ -0,0 +1,142 @@
+import os
+import io
+import hashlib
+import pandas as pd
+import pyarrow.feather as feather
+
+import stages
+from dataset_cache import load_dataset
+from jsonfile import load_json, save_json
+
+ROLLUP_FOLDER = "data-rollups"  #folder where the pre-aggregated tables are kept
+STATE_FILE = os.path.join(ROLLUP_FOLDER, "state.json")  #how far into each CSV the rollups have been updated
+MEASURES = {"donations_state": "daily", "newdonors_state": "total"}  #dataset -> column that gets summed
+TAIL_BYTES = 4096  #bytes before the processed offset that are hashed to detect a rewritten CSV
+
+def rollup_path(dataset, grain):
+    return os.path.join(ROLLUP_FOLDER, f"{dataset}-{grain}.arrow")
+
+def save_rollup(data, dataset, grain):
+    os.makedirs(ROLLUP_FOLDER, exist_ok=True)
+    tmp_path = rollup_path(dataset, grain) + ".tmp"
+    feather.write_feather(data.reset_index(drop=True), tmp_path, compression="uncompressed")
+    os.replace(tmp_path, rollup_path(dataset, grain))
+
+def load_rollup(dataset, grain):
+    """
+    Load one rollup table:
+    - 'monthly': state, month (first day of the month), <measure>
+    - 'yearly': state, year, <measure>
+    - 'latest': state, date, <measure> for the most recent date only
+    """
+    return feather.read_table(rollup_path(dataset, grain), memory_map=True).to_pandas()
+
+def as_of(dataset):
+    """
+    Latest date covered by a dataset's rollups.
+    """
+    return pd.Timestamp(load_json(STATE_FILE)[dataset]["max_date"])
+
+def tail_hash(csv_path, offset):
+    with open(csv_path, "rb") as file:
+        file.seek(max(0, offset - TAIL_BYTES))
+        return hashlib.sha256(file.read(offset - max(0, offset - TAIL_BYTES))).hexdigest()
+
+def read_new_rows(csv_path, offset, measure):
+    """
+    Parse only the rows appended to the CSV after byte offset.
+    """
+    with open(csv_path, "rb") as file:
+        header = file.readline()
+        file.seek(offset)
+        tail = file.read()
+    data = pd.read_csv(io.BytesIO(header + tail), usecols=["date", "state", measure])
+    data["date"] = pd.to_datetime(data["date"])
+    return data
+
+def aggregate(rows, measure):
+    """
+    Sum rows into the monthly and yearly state totals.
+    """
+    #sum in int64, the cached CSVs use compact int types that would overflow
+    rows = rows.assign(state=rows["state"].astype(str), **{measure: rows[measure].astype("int64")})
+    monthly = rows.groupby(["state", rows["date"].dt.to_period("M").dt.to_timestamp().rename("month")])[measure].sum().reset_index()
+    yearly = rows.groupby(["state", rows["date"].dt.year.rename("year")])[measure].sum().reset_index()
+    return monthly, yearly
+
+def merge_totals(old, new, keys, measure):
+    """
+    Add new partial totals into an existing rollup table.
+    """
+    if old is None:
+        return new
+    merged = pd.concat([old, new]).groupby(keys, as_index=False)[measure].sum()
+    return merged.sort_values(keys)
+
+def invalidate(dataset):
+    """
+    Make the next update rebuild a dataset's rollups from the whole CSV. fetch_data_latest_commit calls it when it
+    replaces a file instead of appending to it, as the tail hash misses a revision that keeps the file's length.
+    """
+    state = load_json(STATE_FILE)
+    if state.pop(dataset, None) is not None:
+        save_json(state, STATE_FILE)
+
+def update_rollups(dataset, csv_path):
+    """
+    Bring a dataset's rollups up to date with its CSV.
+
+    fetch_data_latest_commit mostly appends new date rows to the CSVs, so only the bytes after the last processed
+    offset are parsed and added to the existing totals. The rollups are rebuilt from the whole file after
+    invalidate() (the file was replaced), or when the hash of the bytes just before the offset changed.
+    Returns the number of rows processed.
+    """
+    measure = MEASURES[dataset]
+    state = load_json(STATE_FILE)
+    entry = state.get(dataset)
+    size = os.path.getsize(csv_path)
+
+    incremental = (entry is not None and entry["offset"] <= size
+                   and tail_hash(csv_path, entry["offset"]) == entry["tail_sha256"]
+                   and all(os.path.exists(rollup_path(dataset, grain)) for grain in ("monthly", "yearly", "latest")))
+    if incremental and entry["offset"] == size:
+        return 0
+
+    if incremental:
+        rows = read_new_rows(csv_path, entry["offset"], measure)
+        rows = rows[rows["date"] > pd.Timestamp(entry["max_date"])]
+        old_monthly, old_yearly = load_rollup(dataset, "monthly"), load_rollup(dataset, "yearly")
+    else:
+        rows = load_dataset(csv_path, columns=["date", "state", measure])
+        old_monthly = old_yearly = None
+        if rows.empty:
+            raise ValueError(f"{csv_path} has no rows")
+
+    if not rows.empty:
+        monthly, yearly = aggregate(rows, measure)
+        save_rollup(merge_totals(old_monthly, monthly, ["state", "month"], measure), dataset, "monthly")
+        save_rollup(merge_totals(old_yearly, yearly, ["state", "year"], measure), dataset, "yearly")
+
+        latest = rows[rows["date"] == rows["date"].max()]
+        latest = latest.assign(state=latest["state"].astype(str), **{measure: latest[measure].astype("int64")})
+        latest = latest.groupby(["state", "date"], as_index=False)[measure].sum()
+        save_rollup(latest, dataset, "latest")
+        max_date = rows["date"].max()
+    else:
+        max_date = pd.Timestamp(entry["max_date"])
+
+    state[dataset] = {"offset": size, "tail_sha256": tail_hash(csv_path, size),
+                      "max_date": max_date.strftime("%Y-%m-%d")}
+    save_json(state, STATE_FILE)
+    return len(rows)
+
+def update_all(folder_path):
+    """
+    Update the rollups of every dataset in MEASURES found in folder_path.
+    """
+    for dataset in MEASURES:
+        csv_path = os.path.join(folder_path, f"{dataset}.csv")
+        if os.path.exists(csv_path):
+            rows = update_rollups(dataset, csv_path)
+            print(f"Rollups updated: {dataset} ({rows} rows)")
+            stages.add(rows=rows)
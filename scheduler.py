@@ -1,17 +1,116 @@
 #pip install schedule
-import schedule
+import os
 import time
+import asyncio
+import argparse
 import subprocess
 
+POLL_INTERVAL = int(os.environ.get('POLL_INTERVAL', 3600))  #seconds between checks for new data in daemon mode
+
 def run_fetch_data():
     subprocess.run(["python", "fetch_data_latest_commit.py"])
 
 def run_send_to_telegram():
     subprocess.run(["python", "send_to_telegram.py"])
 
-schedule.every(1).hours.do(run_fetch_data)
-schedule.every(1).hours.at(":30").do(run_send_to_telegram)
+def run_subprocess_schedule():
+    """
+    The original mode: a fresh interpreter for every job, tied together by the data_fetched.txt flag.
+    """
+    import schedule
+
+    schedule.every(1).hours.do(run_fetch_data)
+    schedule.every(1).hours.at(":30").do(run_send_to_telegram)
+
+    while True:
+        schedule.run_pending()
+        time.sleep(1)
+
+#===============Daemon mode==============
+
+async def fetch_once(client=None):
+    """
+    Run one sync on the daemon's event loop, over its client if given. Returns True when new data was fetched.
+    """
+    import fetch_data_latest_commit
+    return await fetch_data_latest_commit.sync(write_flag=False, client=client)
+
+async def report_once(renderer):
+    import send_to_telegram
+    await send_to_telegram.main(renderer=renderer)
+
+async def fetch_loop(data_ready, interval, holder=None):
+    import fetch_data_latest_commit
+    #one client for the life of the daemon, so every sync reuses the connections (and TLS sessions) of the last
+    async with fetch_data_latest_commit.make_client() as client:
+        while True:
+            try:
+                if await fetch_once(client):
+                    data_ready.set()
+                    if holder:
+                        #answer commands from the new data as soon as it is here
+                        await holder.refresh()
+            except Exception as e:
+                print(f"Fetch failed: {e}")
+            await asyncio.sleep(interval)
+
+async def report_loop(data_ready, renderer):
+    while True:
+        await data_ready.wait()
+        data_ready.clear()
+        try:
+            await report_once(renderer)
+        except Exception as e:
+            print(f"Report failed: {e}")
+
+async def serve_commands(holder):
+    """
+    Answer the interactive /donations and /newdonors commands (see queries.py) until cancelled.
+    """
+    from queries import build_application
+    application = build_application(os.environ.get('BOT_TOKEN'), holder)
+    async with application:
+        await application.start()
+        await application.updater.start_polling()
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await application.updater.stop()
+            await application.stop()
+
+async def run_daemon(interval=POLL_INTERVAL, commands=False):
+    """
+    One long-running process: imports, the HTTP sessions, the render pool and the loaded data stay warm between
+    cycles, and the report runs right after a fetch that found new data.
+    With commands, the daemon also answers subscribers' queries, from a store refreshed after every fetch.
+    """
+    #import everything up front, so the first report doesn't pay for it
+    import fetch_data_latest_commit  # noqa: F401
+    import send_to_telegram  # noqa: F401
+    import pandas, rollups, retention, plots, delivery  # noqa: F401,E401
+    from render import ChartRenderer
+
+    data_ready = asyncio.Event()
+    holder = None
+    if commands:
+        from queries import StoreHolder
+        holder = StoreHolder()
+    #the renderer stays open for the life of the daemon, so each chart's figure is drawn once and then updated
+    with ChartRenderer(templated=True) as renderer:
+        print(f"Daemon started, checking for new data every {interval}s")
+        jobs = [fetch_loop(data_ready, interval, holder), report_loop(data_ready, renderer)]
+        if holder:
+            jobs.append(serve_commands(holder))
+        await asyncio.gather(*jobs)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fetch the data and send the report on a schedule")
+    parser.add_argument('--daemon', action='store_true', help="run as one long-lived asyncio process instead of a subprocess per job")
+    parser.add_argument('--interval', type=int, default=POLL_INTERVAL, help="seconds between checks for new data (daemon mode)")
+    parser.add_argument('--commands', action='store_true', help="also answer /donations and /newdonors queries (daemon mode)")
+    args = parser.parse_args()
 
-while True:
-    schedule.run_pending()
-    time.sleep(1)
+    if args.daemon:
+        asyncio.run(run_daemon(args.interval, commands=args.commands))
+    else:
+        run_subprocess_schedule()
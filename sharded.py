@@ -0,0 +1,71 @@
+#computes the granular report aggregates on every core, with the visits sharded by a hash of donor_id
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from streaming import spill_partitions, partial_aggregates, merge_partials, report_aggregates
+
+BATCH_ROWS = 1_000_000  #visits per record batch read from the parquet
+
+def spill_row_groups(path, folder, row_groups, n_shards, task):
+    """
+    Map step: split the visits of some row groups into one Arrow stream file per shard.
+    Returns (shard paths, min year, max year).
+    """
+    return spill_partitions(path, folder, n_shards, BATCH_ROWS, row_groups=row_groups, prefix=f'part-{task}')
+
+def shard_aggregates(paths, min_year, n_years, thresholds):
+    """
+    Reduce step: the partial aggregates of one shard, from the files every map task wrote for it.
+    The files are memory-mapped, so the visits are read straight from the page cache without a copy.
+    """
+    tables = []
+    for path in paths:
+        with pa.memory_map(path) as source:
+            tables.append(pa.ipc.open_stream(source).read_all())
+    visits = pa.concat_tables(tables)
+    if not visits.num_rows:
+        return None
+    return partial_aggregates(visits.column('donor_id'), visits.column('year').to_numpy(),
+                              visits.column('birth_year').to_numpy().astype(np.int64),
+                              min_year, n_years, thresholds)
+
+def sharded_granular_aggregates(path, start_year, end_year, thresholds=(1, 3, 6), workers=None, spill_folder=None):
+    """
+    Compute (donor_counts_per_year, age_counts, retention_by_threshold) in a pool of worker processes.
+
+    Every statistic of the report is a sum over donors, so the visits are split by a hash of donor_id
+    into one shard per worker: the workers first split the file's row groups between them, then each
+    aggregates one shard, and the partial counts are added up exactly. With workers=0 everything runs
+    inline, one shard after another.
+    """
+    thresholds = list(thresholds)
+    workers = os.cpu_count() if workers is None else workers
+    n_shards = max(1, workers)
+    n_row_groups = pq.read_metadata(path).num_row_groups
+    #the map step parallelizes over row groups, so a file written as one row group is split by a single task
+    tasks = [list(range(task, n_row_groups, n_shards)) for task in range(min(n_shards, n_row_groups))]
+
+    with tempfile.TemporaryDirectory(dir=spill_folder) as folder:
+        pool = ProcessPoolExecutor(max_workers=workers) if workers else None
+        run = pool.map if pool else map
+        try:
+            spilled = list(run(spill_row_groups, [path] * len(tasks), [folder] * len(tasks), tasks,
+                               [n_shards] * len(tasks), range(len(tasks))))
+            years = [(low, high) for _, low, high in spilled if low is not None]
+            if not years:
+                raise ValueError(f"{path} has no visits")
+            min_year = min(low for low, _ in years)
+            n_years = max(high for _, high in years) - min_year + 1
+
+            shards = [[paths[shard] for paths, _, _ in spilled] for shard in range(n_shards)]
+            partials = run(shard_aggregates, shards, [min_year] * n_shards, [n_years] * n_shards,
+                           [thresholds] * n_shards)
+            totals = merge_partials(partial for partial in partials if partial is not None)
+        finally:
+            if pool:
+                pool.shutdown()
+    return report_aggregates(totals, min_year, start_year, end_year, thresholds)
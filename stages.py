@@ -0,0 +1,216 @@
+#per-stage instrumentation of the fetch -> aggregate -> render -> send pipeline
+#every stage records wall time, CPU time, peak RSS growth, bytes downloaded/uploaded and rows processed;
+#each run appends them to metrics/stages.jsonl and rewrites metrics/<job>.prom for node_exporter's textfile collector
+import os
+import json
+import time
+import threading
+import contextlib
+import contextvars
+from datetime import datetime, timezone
+
+METRICS_FOLDER = os.environ.get('METRICS_FOLDER', 'metrics')
+LOG_FILE = 'stages.jsonl'
+#set to cprofile (or pyinstrument, if installed) to keep a profile of the slowest stage of every run
+PROFILE_STAGES = os.environ.get('PROFILE_STAGES', '').lower()
+COUNTERS = ('bytes_downloaded', 'bytes_uploaded', 'rows')
+
+current_run = contextvars.ContextVar('current_run', default=None)
+open_stages = contextvars.ContextVar('open_stages', default=())  #the stages open in this thread/task, innermost last
+
+#every stage open in the process, so a peak reset for one stage doesn't lose the peak of the others
+active = []
+active_lock = threading.Lock()
+
+def memory_peak():
+    """
+    (current RSS, peak RSS) in bytes, from /proc (Linux), or (0, 0) where that is not available.
+    """
+    try:
+        with open('/proc/self/status') as file:
+            status = dict(line.split(':', 1) for line in file if line.startswith(('VmRSS', 'VmHWM')))
+        return int(status['VmRSS'].split()[0]) * 1024, int(status['VmHWM'].split()[0]) * 1024
+    except (OSError, KeyError):
+        return 0, 0
+
+def reset_peak():
+    #"5" resets the process's peak RSS to its current RSS (Linux 4.0+); without it the peak is since process start
+    try:
+        with open('/proc/self/clear_refs', 'w') as file:
+            file.write('5')
+    except OSError:
+        pass
+
+def note_peak():
+    _, peak = memory_peak()
+    for record in active:
+        record['_peak'] = max(record['_peak'], peak)
+
+class Run:
+    """
+    The stages of one run of a job (fetch or report).
+    """
+    def __init__(self, job):
+        self.job = job
+        self.run_id = os.urandom(6).hex()
+        self.started = datetime.now(timezone.utc)
+        self.records = []
+        self.totals = {}  #run-level counts, from count()
+        self.profiles = {}  #id of a record -> its profiler, while PROFILE_STAGES is set
+        self.lock = threading.Lock()
+
+    def add(self, record, profiler=None):
+        with self.lock:
+            self.records.append(record)
+            if profiler is not None:
+                self.profiles[id(record)] = profiler
+
+def new_profiler():
+    if PROFILE_STAGES == 'pyinstrument':
+        from pyinstrument import Profiler
+        return Profiler(async_mode='disabled')
+    import cProfile
+    return cProfile.Profile()
+
+@contextlib.contextmanager
+def stage(name, **counters):
+    """
+    Measure the block as a stage of the current run. Yields the stage's record, whose counters can be
+    increased directly or with add(), which goes to the innermost open stage.
+    Outside of a run (in a render worker, say) the record is measured but not kept.
+    """
+    this_run = current_run.get()
+    record = {'stage': name, **{counter: 0 for counter in COUNTERS}, **counters}
+    parents = open_stages.get()
+    token = open_stages.set(parents + (record,))
+
+    #only outermost stages are profiled, as a thread can't run two profilers
+    profiler = new_profiler() if PROFILE_STAGES and this_run and not parents else None
+    with active_lock:
+        note_peak()
+        reset_peak()
+        rss, record['_peak'] = memory_peak()
+        active.append(record)
+    wall, cpu = time.perf_counter(), time.process_time()
+    if profiler:
+        profiler.enable() if hasattr(profiler, 'enable') else profiler.start()
+    try:
+        yield record
+    finally:
+        if profiler:
+            profiler.disable() if hasattr(profiler, 'disable') else profiler.stop()
+        record['wall_seconds'] = round(time.perf_counter() - wall, 6)
+        #process-wide: includes whatever else ran meanwhile (threads of other stages, pyarrow's thread pool)
+        record['cpu_seconds'] = round(time.process_time() - cpu, 6)
+        with active_lock:
+            note_peak()
+            active.remove(record)
+        record['peak_rss_delta'] = max(0, record.pop('_peak') - rss)
+        open_stages.reset(token)
+        if this_run:
+            this_run.add(record, profiler)
+
+def add(**counters):
+    """
+    Increase counters (bytes_downloaded, bytes_uploaded, rows) of the innermost open stage, if any.
+    """
+    opened = open_stages.get()
+    if opened:
+        for counter, value in counters.items():
+            opened[-1][counter] = opened[-1].get(counter, 0) + value
+
+def count(**values):
+    """
+    Add to run-level counts that don't belong to one stage (chart cache hits, say).
+    """
+    this_run = current_run.get()
+    if this_run:
+        with this_run.lock:
+            for name, value in values.items():
+                this_run.totals[name] = this_run.totals.get(name, 0) + value
+
+def record(stage_record):
+    """
+    Keep a stage measured elsewhere (a render worker process) in the current run.
+    """
+    this_run = current_run.get()
+    if this_run:
+        this_run.add(dict(stage_record))
+
+@contextlib.contextmanager
+def run(job):
+    """
+    Collect the stages of the block as one run of job, and write them out at the end, even if it fails.
+    """
+    this_run = Run(job)
+    token = current_run.set(this_run)
+    try:
+        yield this_run
+    finally:
+        current_run.reset(token)
+        write_metrics(this_run)
+
+def prometheus_name(name):
+    return ''.join(c if c.isalnum() else '_' for c in name)
+
+def write_metrics(this_run, folder=None):
+    folder = folder or METRICS_FOLDER
+    os.makedirs(folder, exist_ok=True)
+    with open(os.path.join(folder, LOG_FILE), 'a') as file:
+        for stage_record in this_run.records:
+            file.write(json.dumps({'run': this_run.run_id, 'job': this_run.job,
+                                   'time': this_run.started.isoformat(timespec='seconds'), **stage_record}) + '\n')
+        if this_run.totals:
+            file.write(json.dumps({'run': this_run.run_id, 'job': this_run.job,
+                                   'time': this_run.started.isoformat(timespec='seconds'), 'totals': this_run.totals}) + '\n')
+
+    #a stage can run more than once per run (a chart per threshold), so the gauges hold the sums per stage name
+    totals = {}
+    for stage_record in this_run.records:
+        total = totals.setdefault(stage_record['stage'], {'count': 0})
+        total['count'] += 1
+        for key in ('wall_seconds', 'cpu_seconds', *COUNTERS):
+            total[key] = total.get(key, 0) + stage_record.get(key, 0)
+        total['peak_rss_delta'] = max(total.get('peak_rss_delta', 0), stage_record.get('peak_rss_delta', 0))
+
+    metrics = [('wall_seconds', 'Wall time of the stage in the last run'),
+               ('cpu_seconds', 'CPU time of the process during the stage in the last run'),
+               ('peak_rss_delta', 'Peak RSS growth during the stage in the last run, in bytes'),
+               ('bytes_downloaded', 'Bytes downloaded by the stage in the last run'),
+               ('bytes_uploaded', 'Bytes uploaded by the stage in the last run'),
+               ('rows', 'Rows processed by the stage in the last run'),
+               ('count', 'Times the stage ran in the last run')]
+    lines = []
+    for key, description in metrics:
+        metric = f'blood_bot_stage_{key}' + ('_bytes' if key == 'peak_rss_delta' else '')
+        lines += [f'# HELP {metric} {description}', f'# TYPE {metric} gauge']
+        lines += [f'{metric}{{pipeline="{this_run.job}",stage="{name}"}} {total[key]}' for name, total in totals.items()]
+    for name, value in this_run.totals.items():
+        metric = f'blood_bot_{prometheus_name(name)}'
+        lines += [f'# HELP {metric} {name} in the last run', f'# TYPE {metric} gauge',
+                  f'{metric}{{pipeline="{this_run.job}"}} {value}']
+    lines += ['# HELP blood_bot_last_run_timestamp_seconds Start of the last run',
+              '# TYPE blood_bot_last_run_timestamp_seconds gauge',
+              f'blood_bot_last_run_timestamp_seconds{{pipeline="{this_run.job}"}} {this_run.started.timestamp():.0f}']
+    #written to a temporary file and renamed, so the collector never reads half a file
+    prom_path = os.path.join(folder, f'{prometheus_name(this_run.job)}.prom')
+    with open(prom_path + '.tmp', 'w') as file:
+        file.write('\n'.join(lines) + '\n')
+    os.replace(prom_path + '.tmp', prom_path)
+
+    if this_run.profiles:
+        write_profile(this_run, folder)
+
+def write_profile(this_run, folder):
+    slowest = max((r for r in this_run.records if id(r) in this_run.profiles), key=lambda r: r['wall_seconds'])
+    profiler = this_run.profiles[id(slowest)]
+    path = os.path.join(folder, f'{prometheus_name(this_run.job)}-{prometheus_name(slowest["stage"])}')
+    if hasattr(profiler, 'dump_stats'):
+        import pstats
+        profiler.dump_stats(path + '.prof')
+        print(f"Slowest stage: {slowest['stage']} ({slowest['wall_seconds']:.2f}s), profile saved to {path}.prof")
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(15)
+    else:
+        with open(path + '.html', 'w') as file:
+            file.write(profiler.output_html())
+        print(f"Slowest stage: {slowest['stage']} ({slowest['wall_seconds']:.2f}s), profile saved to {path}.html")
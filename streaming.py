@@ -0,0 +1,160 @@
+#out-of-core computation of the granular report aggregates, for granular data larger than the memory we can spare
+import os
+import math
+import tempfile
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from granular import GRANULAR_COLUMNS, as_dates, encode_donor_ids
+from retention import cohort_counts, retention_percentages
+
+MEMORY_BUDGET = 256 * 1024 * 1024  #bytes of working memory for the aggregation (on top of the loaded libraries)
+ROW_BYTES = 160  #estimated peak working memory per visit while a partition is aggregated
+READER_BYTES = 32 * 1024 * 1024  #part of the budget kept for the parquet reader, which decodes a row group's pages at a time
+READ_BUFFER = 1024 * 1024  #the reader streams column chunks through a buffer this size instead of loading them whole
+
+def partition_count(n_rows, memory_budget):
+    if memory_budget <= READER_BYTES * 1.5:
+        raise ValueError(f"memory budget must be more than {READER_BYTES * 1.5 / 2**20:.0f}MB")
+    return max(1, math.ceil(n_rows * ROW_BYTES / (memory_budget - READER_BYTES)))
+
+def donor_partitions(donor_ids, n_partitions):
+    """
+    Partition number of every visit, from a hash of its donor_id, so all visits of a donor land together.
+    """
+    if n_partitions == 1:
+        return np.zeros(len(donor_ids), np.int64)
+    #hash each distinct ID once (the dictionary is already unique, so hash_array needs no categorizing pass)
+    encoded = pc.dictionary_encode(donor_ids)
+    hashes = pd.util.hash_array(encoded.dictionary.to_numpy(zero_copy_only=False), categorize=False)
+    return (hashes % n_partitions).astype(np.int64)[encoded.indices.to_numpy(zero_copy_only=False)]
+
+def spill_partitions(path, folder, n_partitions, batch_rows, row_groups=None, prefix='partition'):
+    """
+    Pass 1: stream the parquet in record batches and append each visit (donor_id, year, birth year)
+    to the Arrow stream file of its donor partition. Returns (partition paths, min year, max year).
+    row_groups limits the pass to some of the file's row groups (default: all).
+    """
+    schema = pa.schema([('donor_id', pa.string()), ('year', pa.int16()), ('birth_year', pa.int16())])
+    paths = [os.path.join(folder, f'{prefix}-{i}.arrows') for i in range(n_partitions)]
+    writers = [pa.ipc.new_stream(partition_path, schema) for partition_path in paths]
+    min_year, max_year = None, None
+    try:
+        parquet_file = pq.ParquetFile(path, buffer_size=READ_BUFFER)
+        for batch in parquet_file.iter_batches(batch_size=batch_rows, row_groups=row_groups,
+                                               columns=GRANULAR_COLUMNS, use_threads=False):
+            donor_ids = batch.column('donor_id').cast(pa.string())
+            years = pc.year(as_dates(batch.column('visit_date'))).cast(pa.int16())
+            if len(years):
+                batch_min, batch_max = pc.min_max(years).values()
+                min_year = batch_min.as_py() if min_year is None else min(min_year, batch_min.as_py())
+                max_year = batch_max.as_py() if max_year is None else max(max_year, batch_max.as_py())
+
+            visits = pa.record_batch([donor_ids, years, batch.column('birth_date').cast(pa.int16())], schema=schema)
+            partitions = donor_partitions(donor_ids, n_partitions)
+            order = np.argsort(partitions, kind='stable')
+            visits = visits.take(pa.array(order))
+            bounds = np.searchsorted(partitions[order], np.arange(n_partitions + 1))
+            for i, writer in enumerate(writers):
+                if bounds[i + 1] > bounds[i]:
+                    writer.write_batch(visits.slice(bounds[i], bounds[i + 1] - bounds[i]))
+    finally:
+        for writer in writers:
+            writer.close()
+    return paths, min_year, max_year
+
+def partial_aggregates(donor_ids, years, birth_years, min_year, n_years, thresholds):
+    """
+    The report aggregates of one set of donors, as counts that add up across disjoint sets of donors:
+    present/new donors per year, distinct donors per (age group, year) and the retention cohort counts.
+    """
+    from plots import AGE_BINS, AGE_LABELS
+
+    codes = encode_donor_ids(donor_ids).astype(np.int64)
+    n_donors = int(codes.max()) + 1 if len(codes) else 0
+    year_idx = np.asarray(years, dtype=np.int64) - min_year
+
+    counts = np.bincount(year_idx * n_donors + codes, minlength=n_years * n_donors).reshape(n_years, n_donors)
+    counts = np.minimum(counts, np.iinfo(np.uint16).max).astype(np.uint16)
+    present = counts > 0
+    first_year = present.argmax(axis=0)
+
+    #the age group of every visit, as pd.cut(right=False) assigns it; distinct (donor, year, age group) are counted
+    n_groups = len(AGE_LABELS)
+    group = np.searchsorted(AGE_BINS, np.asarray(years, dtype=np.int64) - birth_years, side='right') - 1
+    valid = (group >= 0) & (group < n_groups)
+    keys = np.unique((codes[valid] * n_years + year_idx[valid]) * n_groups + group[valid])
+    age = np.bincount(keys % (n_years * n_groups), minlength=n_years * n_groups).reshape(n_years, n_groups).T
+
+    cohort_sizes, still_donating = cohort_counts(counts, thresholds)
+    return {
+        'present': present.sum(axis=1).astype(np.int64),
+        'new': np.bincount(first_year, minlength=n_years).astype(np.int64) if n_donors else np.zeros(n_years, np.int64),
+        'age': age.astype(np.int64),
+        'cohort_sizes': cohort_sizes,
+        'still_donating': still_donating,
+    }
+
+def merge_partials(partials):
+    totals = None
+    for partial in partials:
+        totals = partial if totals is None else {key: totals[key] + value for key, value in partial.items()}
+    return totals
+
+def report_aggregates(totals, min_year, start_year, end_year, thresholds):
+    """
+    Turn merged partial aggregates into what the report plots, in the same shape as the in-memory path
+    (plots.donor_status_counts, plots.age_group_year_counts and retention.retention_tables).
+    """
+    from plots import AGE_LABELS
+
+    n_years = len(totals['present'])
+    years = np.arange(min_year, min_year + n_years)
+    observed = totals['present'] > 0
+    donor_counts_per_year = pd.DataFrame({'New': totals['new'], 'Returning': totals['present'] - totals['new']},
+                                         index=pd.Index(years, name='donation_year'))[observed]
+    donor_counts_per_year.columns.name = 'donor_status'
+    if not donor_counts_per_year['Returning'].any():
+        donor_counts_per_year = donor_counts_per_year[['New']]
+
+    groups, year_offsets = np.nonzero(totals['age'])
+    age_counts = pd.DataFrame({
+        'age_group': pd.Categorical.from_codes(groups, categories=AGE_LABELS, ordered=True),
+        'donation_year': years[year_offsets],
+        'donor_id': totals['age'][groups, year_offsets],
+    })
+    age_counts = age_counts[age_counts['donation_year'].between(start_year, end_year)].reset_index(drop=True)
+
+    retention_by_threshold = retention_percentages(totals['cohort_sizes'], totals['still_donating'], min_year, thresholds)
+    return donor_counts_per_year, age_counts, retention_by_threshold
+
+def stream_granular_aggregates(path, start_year, end_year, thresholds=(1, 3, 6), memory_budget=MEMORY_BUDGET, spill_folder=None):
+    """
+    Compute (donor_counts_per_year, age_counts, retention_by_threshold) without ever holding the whole
+    granular data in memory: visits are spilled to disk in partitions by donor hash, sized so that one
+    partition fits memory_budget, and every partition is aggregated on its own.
+    """
+    thresholds = list(thresholds)
+    n_rows = pq.read_metadata(path).num_rows
+    n_partitions = partition_count(n_rows, memory_budget)
+    batch_rows = max(10_000, (memory_budget - READER_BYTES) // (ROW_BYTES * 4))
+
+    with tempfile.TemporaryDirectory(dir=spill_folder) as folder:
+        paths, min_year, max_year = spill_partitions(path, folder, n_partitions, batch_rows)
+        if min_year is None:
+            raise ValueError(f"{path} has no visits")
+        n_years = max_year - min_year + 1
+
+        partials = []
+        for partition_path in paths:
+            with pa.OSFile(partition_path) as file:
+                visits = pa.ipc.open_stream(file).read_all()
+            if visits.num_rows:
+                partials.append(partial_aggregates(visits.column('donor_id'), visits.column('year').to_numpy(),
+                                                   visits.column('birth_year').to_numpy().astype(np.int64),
+                                                   min_year, n_years, thresholds))
+            del visits
+    return report_aggregates(merge_partials(partials), min_year, start_year, end_year, thresholds)
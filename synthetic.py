@@ -0,0 +1,476 @@
+#synthetic data and local stand-ins (the data server, the Telegram Bot API, the bot itself) shared by benchmark.py
+#and the tests, so neither ever touches the live datasets or Telegram
+import asyncio
+import contextlib
+import hashlib
+import io
+import json
+import os
+import re
+import sys
+import pickle
+import subprocess
+import threading
+import time
+from datetime import datetime
+from types import SimpleNamespace
+from email import message_from_bytes
+from urllib.parse import parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+import fetch_data_latest_commit
+
+STATES = ['Malaysia', 'Johor', 'Kedah', 'Kelantan', 'Melaka', 'Negeri Sembilan', 'Pahang', 'Perak',
+          'Pulau Pinang', 'Sabah', 'Sarawak', 'Selangor', 'Terengganu', 'W.P. Kuala Lumpur']
+DONATIONS_COLUMNS = ['daily', 'blood_a', 'blood_b', 'blood_o', 'blood_ab', 'location_centre', 'location_mobile',
+                     'type_wholeblood', 'type_apheresis_platelet', 'type_apheresis_plasma', 'type_other',
+                     'social_civilian', 'social_student', 'social_policeArmy',
+                     'donations_new', 'donations_regular', 'donations_irregular']
+NEWDONORS_COLUMNS = ['17-24', '25-29', '30-34', '35-39', '40-44', '45-49', '50-54', '55-59', '60-64', 'other', 'total']
+
+#===============Synthetic data==============
+
+def granular_arrays(n_visits, start_year=2012, end_year=2024, seed=0):
+    """
+    Synthetic visits as numpy arrays: (donor codes, days since start_year-01-01, birth year per visit).
+    """
+    rng = np.random.default_rng(seed)
+    n_donors = max(1, n_visits // 4)  #some visits fall after end_year and get dropped, so start with extra donors
+
+    #each donor starts in some year and keeps donating for a random number of visits
+    first_day = rng.integers(0, (end_year - start_year + 1) * 365, size=n_donors)
+    visits_per_donor = rng.geometric(1 / 6, size=n_donors)
+    donor_codes = np.repeat(np.arange(n_donors), visits_per_donor)
+    gaps = rng.integers(60, 400, size=len(donor_codes))
+
+    #days since the donor's first visit, restarting at every new donor
+    offsets = np.cumsum(gaps)
+    starts = np.r_[0, np.flatnonzero(np.diff(donor_codes)) + 1]
+    offsets -= np.repeat(offsets[starts], np.diff(np.r_[starts, len(donor_codes)]))
+    days = first_day[donor_codes] + offsets
+
+    last_day = (pd.Timestamp(f'{end_year + 1}-01-01') - pd.Timestamp(f'{start_year}-01-01')).days
+    keep = np.flatnonzero(days < last_day)[:n_visits]
+    birth_year = rng.integers(1950, 2006, size=n_donors)
+    return donor_codes[keep], days[keep], birth_year[donor_codes[keep]]
+
+def make_granular_data(n_visits, start_year=2012, end_year=2024, seed=0):
+    """
+    Generate a synthetic granular dataset shaped like ds-data-granular
+    (donor_id, visit_date, birth_date) with roughly n_visits rows.
+    """
+    donor_codes, days, birth_year = granular_arrays(n_visits, start_year, end_year, seed)
+    data = pd.DataFrame({
+        'donor_id': pd.Series(donor_codes).map('{:07d}'.format),
+        'visit_date': pd.Timestamp(f'{start_year}-01-01') + pd.to_timedelta(days, unit='D'),
+        'birth_date': birth_year,
+    })
+    return data
+
+def write_granular_parquet(path, n_visits, start_year=2012, end_year=2024, seed=0, row_group_size=1_000_000, chunk_visits=None):
+    """
+    Write a synthetic ds-data-granular straight from Arrow arrays (no Python strings, so it scales to
+    tens of millions of rows), sorted by visit date like an append-only export.
+    With chunk_visits, the visits are generated and written that many at a time so memory stays bounded
+    (each chunk brings its own donors and is sorted by date on its own).
+    """
+    chunk_visits = chunk_visits or n_visits
+    epoch_day = (pd.Timestamp(f'{start_year}-01-01') - pd.Timestamp('1970-01-01')).days
+    rows, first_code, writer = 0, 0, None
+    try:
+        for chunk, start in enumerate(range(0, n_visits, chunk_visits)):
+            chunk_size = min(chunk_visits, n_visits - start)
+            donor_codes, days, birth_year = granular_arrays(chunk_size, start_year, end_year, seed + chunk)
+            order = np.argsort(days, kind='stable')
+            donor_ids = pc.utf8_lpad(pc.cast(pa.array(donor_codes[order] + first_code), pa.string()), 7, '0')
+            table = pa.table({
+                'donor_id': donor_ids,
+                'visit_date': pa.array((days[order] + epoch_day).astype(np.int32), pa.date32()),
+                'birth_date': pa.array(birth_year[order]),
+            })
+            writer = writer or pq.ParquetWriter(path, table.schema)
+            writer.write_table(table, row_group_size=row_group_size)
+            rows += table.num_rows
+            first_code += max(1, chunk_size // 4)  #granular_arrays numbers the donors of a chunk below this
+    finally:
+        if writer:
+            writer.close()
+    return rows
+
+def make_state_data(columns, start_date, end_date, seed=0):
+    """
+    Generate a synthetic state-level daily dataset (date, state, *columns) sorted like the
+    MoH CSVs: by state, then by date.
+    """
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range(start_date, end_date, freq='D')
+    data = pd.DataFrame({
+        'date': np.tile(dates.strftime('%Y-%m-%d'), len(STATES)),
+        'state': np.repeat(STATES, len(dates)),
+    })
+    for column in columns:
+        data[column] = rng.integers(0, 500, size=len(data))
+    return data
+
+def to_csv_bytes(data):
+    return data.to_csv(index=False).encode()
+
+#===============Local HTTP stand-in==============
+
+def git_blob_sha(content):
+    return hashlib.sha1(f'blob {len(content)}\0'.encode() + content).hexdigest()
+
+class MockDataServer:
+    """
+    A local stand-in for the GitHub API, raw.githubusercontent.com and the granular parquet link.
+    Serves ETags, answers If-None-Match with 304 and Range with 206 (or the whole file when If-Range names an
+    older version), counts the body bytes it sends and throttles them to bandwidth (bytes/s) so transfer time shows up like it would over the internet.
+    Setting drop_after makes the next responses cut the connection after that many body bytes.
+    Every request waits latency seconds first. API calls answered with a body are counted in api_calls
+    (they count against GitHub's rate limit), 304s to conditional API calls in api_not_modified (they don't).
+    """
+    def __init__(self, bandwidth=None, latency=0):
+        self.bandwidth = bandwidth
+        self.latency = latency
+        self.api_calls = 0
+        self.api_not_modified = 0
+        self.drop_after = None
+        self.drops_left = 0
+        self.files = {}  #path -> bytes
+        self.commit = None
+        self.bytes_sent = 0
+        self.requests = 0
+        self.lock = threading.Lock()
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                path = self.path.split('?')[0]
+                with server.lock:
+                    server.requests += 1
+                time.sleep(server.latency)
+                if path == f'/repos/{fetch_data_latest_commit.REPO}/commits':
+                    return self.send_api(json.dumps([server.commit]).encode())
+                if path.startswith(f'/repos/{fetch_data_latest_commit.REPO}/commits/'):
+                    return self.send_api(json.dumps(server.commit_detail()).encode())
+                if path in server.files:
+                    content = server.files[path]
+                    etag = f'"{hashlib.sha1(content).hexdigest()}"'
+                    if self.headers.get('If-None-Match') == etag:
+                        self.send_response(304)
+                        self.send_header('ETag', etag)
+                        self.end_headers()
+                        return
+                    byte_range = re.match(r'bytes=(\d+)-', self.headers.get('Range', ''))
+                    if byte_range and self.headers.get('If-Range', etag) == etag:
+                        start = int(byte_range.group(1))
+                        return self.send_body(content[start:], etag=etag, status=206,
+                                              content_range=f'bytes {start}-{len(content) - 1}/{len(content)}')
+                    return self.send_body(content, etag=etag)
+                self.send_response(404)
+                self.end_headers()
+
+            def send_api(self, body):
+                etag = f'"{hashlib.sha1(body).hexdigest()}"'
+                if self.headers.get('If-None-Match') == etag:
+                    with server.lock:
+                        server.api_not_modified += 1
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.end_headers()
+                    return
+                with server.lock:
+                    server.api_calls += 1
+                return self.send_body(body, etag=etag)
+
+            def send_body(self, body, etag=None, status=200, content_range=None):
+                self.send_response(status)
+                self.send_header('Content-Length', str(len(body)))
+                if etag:
+                    self.send_header('ETag', etag)
+                if content_range:
+                    self.send_header('Content-Range', content_range)
+                self.end_headers()
+                chunk_size = 64 * 1024
+                for offset in range(0, len(body), chunk_size):
+                    if server.drop_after is not None and offset >= server.drop_after and server.drops_left > 0:
+                        server.drops_left -= 1
+                        self.close_connection = True
+                        return
+                    chunk = body[offset:offset + chunk_size]
+                    self.wfile.write(chunk)
+                    with server.lock:
+                        server.bytes_sent += len(chunk)
+                    if server.bandwidth:
+                        time.sleep(len(chunk) / server.bandwidth)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.httpd.server_address[1]}'
+
+    def publish(self, files):
+        """
+        Publish a new upstream commit touching the given CSV files ({filename: bytes}).
+        """
+        for filename, content in files.items():
+            self.files[f'/raw/{filename}'] = content
+        self.changed = list(files)
+        sha = hashlib.sha1(repr(sorted(self.files.items())).encode()).hexdigest()
+        self.commit = {'sha': sha, 'commit': {'author': {'date': datetime.now().strftime('%Y-%m-%dT%H:%M:%SZ')}}}
+
+    def commit_detail(self):
+        return {'files': [{'filename': filename,
+                           'sha': git_blob_sha(self.files[f'/raw/{filename}']),
+                           'raw_url': f'{self.url}/raw/{filename}'} for filename in self.changed]}
+
+    def reset_counters(self):
+        self.bytes_sent = 0
+        self.requests = 0
+        self.api_calls = 0
+        self.api_not_modified = 0
+
+    def __enter__(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+@contextlib.contextmanager
+def pointed_at(server, workdir):
+    """
+    Run fetch_data_latest_commit against the stand-in server, inside workdir.
+    """
+    old_api, old_granular, old_cwd = fetch_data_latest_commit.GITHUB_API, fetch_data_latest_commit.GRANULAR_URL, os.getcwd()
+    fetch_data_latest_commit.GITHUB_API = server.url
+    fetch_data_latest_commit.GRANULAR_URL = f'{server.url}/granular'
+    os.chdir(workdir)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            yield
+    finally:
+        os.chdir(old_cwd)
+        fetch_data_latest_commit.GITHUB_API, fetch_data_latest_commit.GRANULAR_URL = old_api, old_granular
+
+class FakeBotAPIServer:
+    """
+    A local stand-in for the Telegram Bot API (getMe, sendMessage, sendPhoto, sendMediaGroup).
+    Every call takes `latency` seconds plus upload time at `bandwidth` bytes/s, and the same limits as Telegram
+    are enforced (per chat and global), answering 429 with a retry_after when a client goes over them.
+    """
+    def __init__(self, latency=0.05, bandwidth=2e6, per_chat_rate=20 / 60, per_chat_burst=20, global_rate=30, global_burst=30):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.limits = (per_chat_rate, per_chat_burst, global_rate, global_burst)
+        self.buckets = {}  #chat_id or None (global) -> [tokens, updated]
+        self.calls = 0
+        self.rate_limited = 0
+        self.uploaded_bytes = 0
+        self.messages = 0
+        self.lock = threading.Lock()
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                method = self.path.rsplit('/', 1)[-1]
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if method == 'getMe':
+                    return self.reply(200, {'ok': True, 'result': {'id': 123456, 'is_bot': True, 'first_name': 'benchmark',
+                                                                   'username': 'benchmark_bot'}})
+                fields, uploads = self.parse_fields(body)
+                time.sleep(server.latency + uploads / server.bandwidth)
+
+                media = json.loads(fields['media']) if method == 'sendMediaGroup' else []
+                cost = len(media) or 1
+                with server.lock:
+                    server.calls += 1
+                    retry_after = server.take(fields['chat_id'], cost)
+                    if retry_after:
+                        server.rate_limited += 1
+                    else:
+                        server.uploaded_bytes += uploads
+                        server.messages += cost
+                if retry_after:
+                    return self.reply(429, {'ok': False, 'error_code': 429,
+                                            'description': f'Too Many Requests: retry after {retry_after}',
+                                            'parameters': {'retry_after': retry_after}})
+
+                chat_id = int(fields['chat_id'])
+                if method == 'sendMessage':
+                    result = server.message(chat_id, None)
+                elif method == 'sendPhoto':
+                    result = server.message(chat_id, fields['photo'])
+                else:
+                    result = [server.message(chat_id, item['media']) for item in media]
+                self.reply(200, {'ok': True, 'result': result})
+
+            def parse_fields(self, body):
+                #form fields, plus the number of bytes that were file uploads
+                content_type = self.headers.get('Content-Type', '')
+                if not content_type.startswith('multipart/'):
+                    return {name: values[0] for name, values in parse_qs(body.decode()).items()}, 0
+                fields, uploads = {}, 0
+                message = message_from_bytes(f'Content-Type: {content_type}\r\n\r\n'.encode() + body)
+                for part in message.get_payload():
+                    name = part.get_param('name', header='content-disposition')
+                    value = part.get_payload(decode=True)
+                    if part.get_filename():
+                        uploads += len(value)
+                        fields[name] = 'attach://' + name
+                    else:
+                        fields[name] = value.decode()
+                return fields, uploads
+
+            def reply(self, status, payload):
+                body = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        class Server(ThreadingHTTPServer):
+            request_queue_size = 128  #many clients connect at once in the queries load test
+
+        self.httpd = Server(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.httpd.server_address[1]}/bot'
+
+    def take(self, chat_id, cost):
+        """
+        Take cost tokens from the chat's and the global bucket, or return how many seconds to wait.
+        """
+        per_chat_rate, per_chat_burst, global_rate, global_burst = self.limits
+        now = time.monotonic()
+        buckets = [(chat_id, per_chat_rate, per_chat_burst), (None, global_rate, global_burst)]
+        for key, rate, burst in buckets:
+            tokens, updated = self.buckets.get(key, (burst, now))
+            self.buckets[key] = [min(burst, tokens + (now - updated) * rate), now]
+        for key, rate, burst in buckets:
+            missing = min(cost, burst) - self.buckets[key][0]
+            if missing > 0:
+                return max(1, int(np.ceil(missing / rate)))
+        for key, _, _ in buckets:
+            self.buckets[key][0] -= cost
+        return 0
+
+    def message(self, chat_id, photo):
+        message = {'message_id': self.messages, 'date': int(time.time()), 'chat': {'id': chat_id, 'type': 'group'}}
+        if photo is not None:
+            #an upload gets a new file_id, a file_id sent back is the same photo
+            file_id = f'photo-{self.uploaded_bytes}-{self.messages}' if photo.startswith('attach://') else photo
+            message['photo'] = [{'file_id': file_id, 'file_unique_id': file_id, 'width': 1000, 'height': 600}]
+        return message
+
+    def __enter__(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+#===============Report workspace==============
+
+class FakeBot:
+    """
+    Stands in for telegram.Bot: every call just waits upload_latency seconds.
+    Like Telegram, it rejects file_ids it never issued.
+    """
+    def __init__(self, upload_latency=0.0):
+        self.upload_latency = upload_latency
+        self.photos = []
+        self.messages = []
+        self.file_ids = set()
+
+    def check_file_ids(self, photos):
+        from telegram.error import BadRequest
+        if any(isinstance(photo, str) and photo not in self.file_ids for photo in photos):
+            raise BadRequest("Wrong file identifier/http url specified")
+
+    def sent_message(self, chat_id, caption, photo):
+        self.photos.append((chat_id, caption, photo))
+        file_id = photo if isinstance(photo, str) else f'file-{id(self)}-{len(self.photos)}'
+        self.file_ids.add(file_id)
+        return SimpleNamespace(photo=[SimpleNamespace(file_id=file_id)])
+
+    async def send_photo(self, chat_id, photo, caption=None):
+        await asyncio.sleep(self.upload_latency)
+        self.check_file_ids([photo])
+        return self.sent_message(chat_id, caption, photo)
+
+    async def send_media_group(self, chat_id, media):
+        await asyncio.sleep(self.upload_latency)
+        self.check_file_ids([item.media for item in media])
+        return [self.sent_message(chat_id, item.caption, item.media) for item in media]
+
+    async def send_message(self, chat_id, text):
+        await asyncio.sleep(self.upload_latency)
+        self.messages.append((chat_id, text))
+
+def make_report_workspace(workdir, years=18, visits=1_000_000):
+    """
+    Lay out synthetic data-darah-public CSVs and a granular parquet in workdir, as the report expects them.
+    """
+    end_date = pd.Timestamp('2024-06-30')
+    start_date = end_date - pd.DateOffset(years=years)
+    os.makedirs(os.path.join(workdir, 'data-darah-public'), exist_ok=True)
+    os.makedirs(os.path.join(workdir, 'data-granular'), exist_ok=True)
+    make_state_data(DONATIONS_COLUMNS, start_date, end_date, seed=1).to_csv(
+        os.path.join(workdir, 'data-darah-public', 'donations_state.csv'), index=False)
+    make_state_data(NEWDONORS_COLUMNS, start_date, end_date, seed=2).to_csv(
+        os.path.join(workdir, 'data-darah-public', 'newdonors_state.csv'), index=False)
+    make_granular_data(visits).to_parquet(os.path.join(workdir, 'data-granular', 'ds-data-granular'))
+    with open(os.path.join(workdir, 'data_fetched.txt'), 'w') as flag_file:
+        flag_file.write('Data fetched')
+
+@contextlib.contextmanager
+def report_module(workdir, bot, chart_cache=False):
+    """
+    Import send_to_telegram inside workdir with a fake bot. The data_fetched.txt flag is only checked when the
+    script runs (data_was_fetched()), so main() can be called directly.
+    The chart cache is off unless chart_cache is set, so repeated runs draw and upload every chart.
+    """
+    old_cwd = os.getcwd()
+    os.chdir(workdir)
+    os.environ.setdefault('BOT_TOKEN', '123456:benchmark')
+    os.environ.setdefault('CHAT_ID', '-100123456')
+    os.environ['CHART_CACHE'] = '1' if chart_cache else '0'
+    try:
+        import send_to_telegram
+        send_to_telegram.bot = bot
+        with contextlib.redirect_stdout(io.StringIO()):
+            yield send_to_telegram
+    finally:
+        os.chdir(old_cwd)
+
+#===============Memory measurement==============
+
+#runs the streaming aggregation in a fresh interpreter and pickles (result, RSS after imports, peak RSS) in KB
+STREAM_JOB = ("import pickle, re, sys; sys.path.insert(0, {repo!r}); import plots, streaming; "
+              "rss = lambda field: int(re.search(field + r':\\s+(\\d+)', open('/proc/self/status').read()).group(1)); "
+              "baseline = rss('VmRSS'); "
+              "result = streaming.stream_granular_aggregates(sys.argv[1], 2019, 2024, memory_budget=int(sys.argv[2])); "
+              "pickle.dump((result, baseline, rss('VmHWM')), open(sys.argv[3], 'wb'))")
+
+def run_streaming_job(path, memory_budget, output):
+    """
+    Stream the granular aggregates of path in a fresh interpreter, so its peak RSS is the aggregation's own.
+    Returns (result, RSS after imports, peak RSS), the last two in KB; output is the file the result goes through.
+    """
+    repo = os.path.dirname(os.path.abspath(__file__))
+    subprocess.run([sys.executable, '-c', STREAM_JOB.format(repo=repo), path, str(memory_budget), output], check=True)
+    with open(output, 'rb') as file:
+        return pickle.load(file)
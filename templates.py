@@ -0,0 +1,251 @@
+#reusable figure templates for long-running render processes (the scheduler daemon's render workers):
+#each chart's figure, axes, styling, ticks and annotations are drawn once per layout, and later renders
+#only put the new numbers into its artists (bar heights, line data, heatmap cells, annotation text)
+import numpy as np
+import matplotlib.pyplot as plt
+from matplotlib.ticker import FixedLocator, FixedFormatter
+from seaborn.utils import relative_luminance
+
+import plots
+
+templates = {}  #plot name -> the template of its current layout, kept for the life of the process
+
+class Template:
+    """
+    A chart's figure kept open between renders. Subclasses give the plot's inputs (the prepared data the
+    draw_* function of plots.py takes), the key of the layout they need, and how to update the artists.
+    A render with a different key draws a new figure.
+    """
+    value_axis = 'y'  #the axis whose limits follow the data, rescaled after an update (the other only changes with the key)
+    tight_layout = True  #the draw function ran tight_layout, so it runs again if the tick labels get wider
+    freeze_x = False  #after the first render, keep the x ticks computed then instead of locating them every time
+
+    def __init__(self, key, inputs):
+        self.key = key
+        self.fig = self.draw(*inputs)
+        self.ax = self.fig.axes[0]
+        self.label_width = self.tick_label_width()
+        self.frozen = False
+
+    def tick_label_width(self):
+        axis = self.ax.yaxis
+        ticks = axis.get_major_locator()()
+        return max((len(str(label)) for label in axis.get_major_formatter().format_ticks(ticks)), default=0)
+
+    def refresh(self, inputs):
+        self.update(*inputs)
+        if self.value_axis:
+            self.rescale()
+        if self.tight_layout:
+            width = self.tick_label_width()
+            if width > self.label_width:
+                self.fig.tight_layout()
+                self.label_width = width
+
+    def rescale(self):
+        #the data limits along the value axis, from the bar ends and line points; cheaper than relim(), which
+        #walks the path of every patch
+        ends = []
+        for patch in self.ax.patches:
+            if self.value_axis == 'y':
+                ends += [patch.get_y(), patch.get_y() + patch.get_height()]
+            else:
+                ends += [patch.get_x(), patch.get_x() + patch.get_width()]
+        for line in self.ax.lines:
+            ends += list(line.get_ydata() if self.value_axis == 'y' else line.get_xdata())
+        ends = np.asarray(ends, dtype=float)
+        ends = ends[np.isfinite(ends)]
+        if not len(ends):
+            return
+        if self.value_axis == 'y':
+            self.ax.dataLim.intervaly = ends.min(), ends.max()
+        else:
+            self.ax.dataLim.intervalx = ends.min(), ends.max()
+        self.ax.autoscale_view(scalex=self.value_axis == 'x', scaley=self.value_axis == 'y')
+
+    def save(self, filename, output_folder):
+        png_bytes = plots.figure_png(self.fig, filename, output_folder)
+        if self.freeze_x and not self.frozen:
+            #the x range only changes with the key, so the ticks located for this render stay right
+            axis = self.ax.xaxis
+            labels = [label.get_text() for label in axis.get_ticklabels()]
+            axis.set_major_locator(FixedLocator(axis.get_ticklocs()))
+            axis.set_major_formatter(FixedFormatter(labels))
+            self.frozen = True
+        return png_bytes
+
+    def filename(self, *inputs):
+        return plots.CHART_FILES[self.name]
+
+    def close(self):
+        plt.close(self.fig)
+
+class NewDonorsTemplate(Template):
+    name = 'count_new_donors_by_year'
+    draw = staticmethod(plots.draw_new_donors_by_year)
+
+    @staticmethod
+    def inputs(data, start_year, end_year):
+        return plots.new_donors_per_year(data, start_year, end_year), start_year, end_year
+
+    @staticmethod
+    def layout(new_donors_by_year, start_year, end_year):
+        return tuple(new_donors_by_year.index), start_year, end_year
+
+    def update(self, new_donors_by_year, start_year, end_year):
+        for bar, text, height in zip(self.ax.patches, self.ax.texts, new_donors_by_year):
+            bar.set_height(height)
+            text.set_y(height)
+            text.set_text(f'{int(height)}')
+
+class DonationTrendsTemplate(Template):
+    name = 'plot_blood_donation_trends'
+    draw = staticmethod(plots.draw_blood_donation_trends)
+    freeze_x = True  #a month locator over the whole range is the slowest part of this chart
+
+    @staticmethod
+    def inputs(data, start_year, end_year):
+        return plots.monthly_donations(data, start_year, end_year), start_year, end_year
+
+    @staticmethod
+    def layout(monthly_total_donations, start_year, end_year):
+        return tuple(monthly_total_donations['date']), start_year, end_year
+
+    def update(self, monthly_total_donations, start_year, end_year):
+        #seaborn draws the line in date order
+        self.ax.lines[0].set_ydata(monthly_total_donations.sort_values('date')['total_donations'].to_numpy())
+        if self.ax.texts:
+            last_row = monthly_total_donations.iloc[-1]
+            self.ax.texts[0].set_y(last_row['total_donations'])
+            self.ax.texts[0].set_text(f"{last_row['total_donations']}")
+
+class DonationsByStateTemplate(Template):
+    name = 'plot_blood_donation_trends_by_state'
+    draw = staticmethod(plots.draw_blood_donation_trends_by_state)
+    value_axis = 'x'
+    tight_layout = False
+
+    @staticmethod
+    def inputs(data, start_year, end_year):
+        return plots.donations_by_state(data, start_year, end_year), start_year, end_year
+
+    @staticmethod
+    def layout(sorted_pivoted_data, start_year, end_year):
+        #the states move up and down the chart as their totals change, without a new layout
+        return tuple(sorted(sorted_pivoted_data.index)), tuple(sorted_pivoted_data.columns), start_year, end_year
+
+    def update(self, sorted_pivoted_data, start_year, end_year):
+        self.ax.yaxis.set_major_formatter(FixedFormatter(list(sorted_pivoted_data.index)))
+        #one container of bars per year, stacked left to right
+        values = sorted_pivoted_data.to_numpy(dtype=float)
+        lefts = np.cumsum(values, axis=1) - values
+        for bars, widths, starts in zip(self.ax.containers, values.T, lefts.T):
+            for bar, width, left in zip(bars, widths, starts):
+                bar.set_x(left)
+                bar.set_width(width)
+        totals = values.sum(axis=1)
+        overall_total = totals.sum()
+        for annotation, total in zip(self.ax.texts, totals):
+            #the text sits at the annotated point (no xytext), so both move
+            annotation.xy = annotation.xyann = (total + 500, annotation.xy[1])
+            annotation.set_text(f'{total:,.0f} ({(total / overall_total) * 100:.1f}%)')
+
+class DonorStatusTemplate(Template):
+    name = 'plot_returning_new_donor_counts'
+    draw = staticmethod(plots.draw_returning_new_donor_counts)
+
+    @staticmethod
+    def inputs(donor_counts_per_year):
+        return (donor_counts_per_year,)
+
+    @staticmethod
+    def layout(donor_counts_per_year):
+        return tuple(donor_counts_per_year.index), tuple(donor_counts_per_year.columns)
+
+    def update(self, donor_counts_per_year):
+        bars_new, bars_returning = self.ax.containers
+        for bar, new in zip(bars_new, donor_counts_per_year['New']):
+            bar.set_height(new)
+        for bar, new, returning in zip(bars_returning, donor_counts_per_year['New'], donor_counts_per_year['Returning']):
+            bar.set_y(new)
+            bar.set_height(returning)
+        #a text per bar, in the order they were drawn; zero bars keep theirs hidden
+        for text, bar in zip(self.ax.texts, [*bars_new, *bars_returning]):
+            yval = bar.get_height()
+            text.set_position((bar.get_x() + bar.get_width() / 2, bar.get_y() + yval / 2))
+            text.set_text(f'{int(yval)}')
+            text.set_visible(yval > 0)
+
+class AgeGroupTemplate(Template):
+    name = 'plot_donor_counts_by_age_and_year'
+    draw = staticmethod(plots.draw_donor_counts_by_age_and_year)
+
+    @staticmethod
+    def inputs(age_group_year_counts, start_year, end_year):
+        #seaborn draws a container of bars per year, each with the age groups of that year in order
+        return age_group_year_counts.sort_values(['donation_year', 'age_group']), start_year, end_year
+
+    @staticmethod
+    def layout(age_group_year_counts, start_year, end_year):
+        return (tuple(zip(age_group_year_counts['donation_year'], age_group_year_counts['age_group'].astype(str))),
+                start_year, end_year)
+
+    def update(self, age_group_year_counts, start_year, end_year):
+        bars = [bar for container in self.ax.containers for bar in container]
+        for bar, count in zip(bars, age_group_year_counts['donor_id']):
+            bar.set_height(count)
+
+class RetentionHeatmapTemplate(Template):
+    name = 'plot_donor_retention_heatmap'
+    draw = staticmethod(plots.draw_donor_retention_heatmap)
+    value_axis = None  #the heatmap sets its own limits
+    tight_layout = False
+
+    @staticmethod
+    def inputs(percentage_data, donated_min_x_times):
+        return percentage_data, donated_min_x_times
+
+    @staticmethod
+    def layout(percentage_data, donated_min_x_times):
+        #the three thresholds share one layout
+        return tuple(percentage_data.index), tuple(percentage_data.columns)
+
+    def update(self, percentage_data, donated_min_x_times):
+        values = percentage_data.to_numpy()
+        mesh = self.ax.collections[0]
+        mesh.set_array(values.ravel())
+        mesh.set_clim(values.min(), values.max())
+        #the cell annotations come first, then the sample interpretation; text colors as seaborn picks them
+        for text, value, color in zip(self.ax.texts, values.flat, mesh.cmap(mesh.norm(values.ravel()))):
+            text.set_text('' if value == 0 else f'{value:d}')
+            text.set_color('.15' if relative_luminance(color) > .408 else 'w')
+        self.ax.texts[-1].set_text(plots.sample_interpretation(percentage_data, donated_min_x_times))
+        self.ax.set_title(f'% of Donors Still Donating After N Years (at least {donated_min_x_times}x times)')
+
+    def filename(self, percentage_data, donated_min_x_times):
+        return plots.CHART_FILES[self.name].format(donated_min_x_times=donated_min_x_times)
+
+TEMPLATES = {template.name: template for template in [NewDonorsTemplate, DonationTrendsTemplate, DonationsByStateTemplate,
+                                                       DonorStatusTemplate, AgeGroupTemplate, RetentionHeatmapTemplate]}
+
+def render(plot_name, *args, output_folder=plots.OUTPUT_FOLDER, **kwargs):
+    """
+    Render a chart of plots.py like the plot function itself would (same arguments, PNG bytes out),
+    reusing the figure of the last render when the layout is the same.
+    """
+    template_class = TEMPLATES[plot_name]
+    inputs = template_class.inputs(*args, **kwargs)
+    key = template_class.layout(*inputs)
+    template = templates.get(plot_name)
+    if template is not None and template.key == key:
+        template.refresh(inputs)
+    else:
+        if template is not None:
+            template.close()
+        template = templates[plot_name] = template_class(key, inputs)
+    return template.save(template.filename(*inputs), output_folder)
+
+def close_all():
+    for template in templates.values():
+        template.close()
+    templates.clear()
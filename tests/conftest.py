@@ -0,0 +1,27 @@
+#the bot is a set of top-level scripts: make them importable, and run every test in its own folder, since they
+#read and write data-darah-public/, data-rollups/ and the rest relative to the working directory
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+def assert_same_aggregates(expected, actual):
+    """
+    The (donor status counts, age group counts, retention tables) of two granular aggregation paths are equal.
+    """
+    assert (expected[0].values == actual[0].values).all()
+    assert (expected[1].astype(str).values == actual[1].astype(str).values).all()
+    assert set(expected[2]) == set(actual[2])
+    for x in expected[2]:
+        assert expected[2][x].equals(actual[2][x]), f"retention table {x}x differs"
+
+@pytest.fixture
+def same_aggregates():
+    return assert_same_aggregates
@@ -0,0 +1,58 @@
+import asyncio
+
+import pytest
+from telegram.error import Forbidden
+
+import delivery
+from synthetic import FakeBot
+
+PHOTOS = [(b"chart-1", "first"), (b"chart-2", "second")]
+
+class BlockedBot(FakeBot):
+    """
+    A FakeBot that some chats have blocked, as Telegram answers a chat that removed the bot.
+    """
+    def __init__(self, blocked):
+        super().__init__()
+        self.blocked = set(blocked)
+
+    def check_chat(self, chat_id):
+        if chat_id in self.blocked:
+            raise Forbidden("Forbidden: bot was blocked by the user")
+
+    async def send_photo(self, chat_id, photo, caption=None):
+        self.check_chat(chat_id)
+        return await super().send_photo(chat_id, photo, caption)
+
+    async def send_media_group(self, chat_id, media):
+        self.check_chat(chat_id)
+        return await super().send_media_group(chat_id, media)
+
+    async def send_message(self, chat_id, text):
+        self.check_chat(chat_id)
+        return await super().send_message(chat_id, text)
+
+def send_report(bot, chat_ids):
+    sender = delivery.Delivery(bot, chat_ids)
+    async def run():
+        await sender.send_media_group(PHOTOS)
+        await sender.send_photo(b"chart-3")
+        await sender.send_message("done")
+    asyncio.run(run())
+    return sender
+
+@pytest.mark.parametrize("blocked", [1, 2])
+def test_blocked_chat_does_not_stop_the_others(blocked):
+    bot = BlockedBot(blocked=[blocked])
+    sender = send_report(bot, [1, 2, 3])
+    others = {1, 2, 3} - {blocked}
+    assert {chat_id for chat_id, _, _ in bot.photos} == others
+    assert len(bot.photos) == 3 * len(others)
+    assert {chat_id for chat_id, _ in bot.messages} == others
+    assert list(sender.failed) == [blocked]
+    #the images were still uploaded once, whichever chat took them
+    assert sender.uploads == 3
+
+def test_report_fails_when_every_chat_fails():
+    with pytest.raises(Forbidden):
+        send_report(BlockedBot(blocked=[1, 2]), [1, 2])
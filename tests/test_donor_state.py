@@ -0,0 +1,38 @@
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+import donor_state
+import granular
+import plots
+from retention import retention_from_counts, retention_tables
+from synthetic import write_granular_parquet
+
+def donor_table_aggregates():
+    donors = donor_state.load_donors()
+    return (donor_state.donor_status_counts(donors), donor_state.age_group_year_counts(donors, 2019, 2024),
+            retention_from_counts(*donor_state.presence_counts(donors), thresholds=[1, 3, 6]))
+
+def full_history_aggregates(path):
+    data = granular.load_granular(path)
+    return plots.donor_status_counts(data), plots.age_group_year_counts(data, 2019, 2024), retention_tables(data, [1, 3, 6])
+
+def test_merged_visits_match_the_full_history(workdir, same_aggregates):
+    write_granular_parquet("full", 50_000)
+    table = pq.read_table("full")
+    last_day = pc.max(table.column("visit_date"))
+    #yesterday's file, then today's with one more day of visits
+    pq.write_table(table.filter(pc.less(table.column("visit_date"), last_day)), "ds-data-granular")
+    donor_state.update_donor_state("ds-data-granular")
+    pq.write_table(table, "ds-data-granular")
+
+    new_visits = donor_state.update_donor_state("ds-data-granular")
+    assert new_visits == pc.sum(pc.equal(table.column("visit_date"), last_day)).as_py()
+    same_aggregates(full_history_aggregates("ds-data-granular"), donor_table_aggregates())
+
+def test_rewritten_history_is_rebuilt(workdir, same_aggregates):
+    write_granular_parquet("ds-data-granular", 20_000, seed=1)
+    donor_state.update_donor_state("ds-data-granular")
+    #a different history with the same last day: the row count no longer adds up
+    write_granular_parquet("ds-data-granular", 30_000, seed=2)
+    donor_state.update_donor_state("ds-data-granular")
+    same_aggregates(full_history_aggregates("ds-data-granular"), donor_table_aggregates())
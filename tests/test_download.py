@@ -0,0 +1,57 @@
+import asyncio
+import os
+
+import httpx
+import pytest
+
+import fetch_data_latest_commit as fetch
+from synthetic import MockDataServer
+
+VERSION_1 = bytes(range(256)) * 4096  #1MB
+VERSION_2 = bytes(reversed(range(256))) * 5120
+
+@pytest.fixture
+def server(monkeypatch):
+    monkeypatch.setattr(fetch, "MAX_RETRIES", 1)
+    monkeypatch.setattr(fetch, "BACKOFF_SECONDS", 0)
+    monkeypatch.setattr(fetch, "CHUNK_SIZE", 64 * 1024)  #so a cut-off response leaves what it got on disk
+    with MockDataServer() as server:
+        yield server
+
+def download(server, path="/granular", filepath="ds-data-granular"):
+    async def run():
+        async with httpx.AsyncClient() as client:
+            return await fetch.stream_download(client, server.url + path, filepath)
+    return asyncio.run(run())
+
+def cut_off(server):
+    #every response is cut after 256KB until the retries run out, leaving a .part behind
+    server.drop_after, server.drops_left = 256 * 1024, 100
+    with pytest.raises(httpx.TransportError):
+        download(server)
+    server.drops_left = 0
+    assert os.path.exists("ds-data-granular.part")
+
+def test_resumes_the_same_version(workdir, server):
+    server.files["/granular"] = VERSION_1
+    cut_off(server)
+    sent = server.bytes_sent
+    download(server)
+    assert open("ds-data-granular", "rb").read() == VERSION_1
+    assert server.bytes_sent - sent < len(VERSION_1)
+    assert not os.path.exists("ds-data-granular.part") and not os.path.exists("ds-data-granular.part.json")
+
+def test_changed_file_is_downloaded_whole(workdir, server):
+    server.files["/granular"] = VERSION_1
+    cut_off(server)
+    server.files["/granular"] = VERSION_2
+    download(server)
+    assert open("ds-data-granular", "rb").read() == VERSION_2
+
+def test_part_without_a_validator_is_not_resumed(workdir, server):
+    #a .part left by an older version of the bot, with nothing to send as If-Range
+    with open("ds-data-granular.part", "wb") as file:
+        file.write(VERSION_1[:300_000])
+    server.files["/granular"] = VERSION_2
+    download(server)
+    assert open("ds-data-granular", "rb").read() == VERSION_2
@@ -0,0 +1,30 @@
+import asyncio
+
+import matplotlib.pyplot as plt
+import psutil
+
+from synthetic import FakeBot, make_report_workspace, report_module
+
+WARMUP = 2  #imports, caches and matplotlib's font cache
+CYCLES = 8
+MAX_GROWTH_MB = 50  #as benchmark.py memory allows over 100 cycles
+
+def test_repeated_reports_do_not_leak(workdir, monkeypatch):
+    #report_module sets these for the fake bot; restore them after the test
+    for name, value in [("BOT_TOKEN", "123456:test"), ("CHAT_ID", "-100123456"), ("CHART_CACHE", "0")]:
+        monkeypatch.setenv(name, value)
+    make_report_workspace(workdir, years=3, visits=20_000)
+    bot = FakeBot()
+    process = psutil.Process()
+    with report_module(workdir, bot) as send_to_telegram:
+        for _ in range(WARMUP):
+            asyncio.run(send_to_telegram.main(render_workers=0, output_folder=None))
+        baseline = peak = process.memory_info().rss
+        for _ in range(CYCLES):
+            bot.photos.clear()
+            asyncio.run(send_to_telegram.main(render_workers=0, output_folder=None))
+            peak = max(peak, process.memory_info().rss)
+            assert bot.photos, "the report sent no charts"
+
+    assert not plt.get_fignums(), "figures were left open"
+    assert (peak - baseline) / 1e6 < MAX_GROWTH_MB
@@ -0,0 +1,53 @@
+from fetch_data_latest_commit import merge_csv
+
+HEADER = b"date,state,daily"
+ROWS = [b"2024-01-01,Johor,1", b"2024-01-02,Johor,2", b"2024-01-01,Selangor,3", b"2024-01-02,Selangor,4"]
+
+def write_csv(path, rows, header=HEADER):
+    path.write_bytes(header + b"\n" + b"".join(row + b"\n" for row in rows))
+
+def read_rows(path):
+    return path.read_bytes().splitlines()[1:]
+
+def test_appends_only_new_dates(workdir):
+    local, download = workdir / "donations_state.csv", workdir / "download.csv"
+    write_csv(local, ROWS)
+    new = [b"2024-01-03,Johor,5", b"2024-01-03,Selangor,6"]
+    write_csv(download, ROWS[:2] + new[:1] + ROWS[2:] + new[1:])
+
+    assert merge_csv(str(local), str(download), "2024-01-02") == (2, "2024-01-03", False)
+    assert read_rows(local) == ROWS + new
+    assert not download.exists()
+
+def test_last_date_is_read_from_the_local_copy(workdir):
+    local, download = workdir / "donations_state.csv", workdir / "download.csv"
+    write_csv(local, ROWS)
+    write_csv(download, ROWS + [b"2024-01-03,Johor,5"])
+
+    assert merge_csv(str(local), str(download), None) == (1, "2024-01-03", False)
+
+def test_backfilled_row_replaces_the_local_copy(workdir):
+    local, download = workdir / "donations_state.csv", workdir / "download.csv"
+    write_csv(local, ROWS)
+    upstream = ROWS + [b"2024-01-02,Melaka,7", b"2024-01-03,Johor,5"]
+    write_csv(download, upstream)
+
+    assert merge_csv(str(local), str(download), "2024-01-02") == (len(upstream), "2024-01-03", True)
+    assert read_rows(local) == upstream
+
+def test_revised_row_replaces_the_local_copy(workdir):
+    local, download = workdir / "donations_state.csv", workdir / "download.csv"
+    write_csv(local, ROWS)
+    upstream = [ROWS[0], b"2024-01-02,Johor,20", *ROWS[2:], b"2024-01-03,Johor,5"]
+    write_csv(download, upstream)
+
+    merge_csv(str(local), str(download), "2024-01-02")
+    assert read_rows(local) == upstream
+
+def test_changed_header_replaces_the_local_copy(workdir):
+    local, download = workdir / "donations_state.csv", workdir / "download.csv"
+    write_csv(local, ROWS)
+    write_csv(download, [row + b",0" for row in ROWS], header=HEADER + b",blood_a")
+
+    assert merge_csv(str(local), str(download), "2024-01-02") == (len(ROWS), "2024-01-02", True)
+    assert local.read_bytes().startswith(HEADER + b",blood_a\n")
@@ -0,0 +1,68 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from queries import PrefixSums, build_application, parse_period
+from synthetic import make_state_data
+
+@pytest.fixture(scope="module")
+def data():
+    data = make_state_data(["daily"], "2023-12-01", "2024-03-31", seed=3)
+    data["date"] = pd.to_datetime(data["date"])
+    return data
+
+def expected_total(data, state, first, last):
+    rows = data[(data["state"] == state) & (data["date"] >= first) & (data["date"] <= last)]
+    return int(rows["daily"].sum())
+
+@pytest.mark.parametrize("first, last", [("2024-01-01", "2024-01-31"), ("2023-12-01", "2023-12-01"),
+                                         ("2024-02-15", "2024-03-31"), ("2023-12-01", "2024-03-31")])
+def test_totals_match_the_rows(data, first, last):
+    sums = PrefixSums(data, "daily")
+    for state in ["Malaysia", "Johor", "W.P. Kuala Lumpur"]:
+        assert sums.total(state, np.datetime64(first), np.datetime64(last)) == expected_total(data, state, first, last)
+
+def test_totals_are_clipped_to_the_data(data):
+    sums = PrefixSums(data, "daily")
+    assert sums.total("Johor", np.datetime64("2020-01-01"), np.datetime64("2030-01-01")) == expected_total(data, "Johor", "2020-01-01", "2030-01-01")
+    assert sums.total("Johor", np.datetime64("2025-01-01"), np.datetime64("2025-12-31")) is None
+
+def test_find_state(data):
+    sums = PrefixSums(data, "daily")
+    assert sums.find_state(["selangor"]) == "Selangor"
+    assert sums.find_state(["kuala", "lumpur"]) == "W.P. Kuala Lumpur"
+    assert sums.find_state(["pulau", "pinang"]) == "Pulau Pinang"
+    assert sums.find_state(["atlantis"]) is None
+
+AS_OF = np.datetime64("2024-03-31")
+
+@pytest.mark.parametrize("words, expected", [
+    ([], ([], "2024-03-31", "2024-03-31")),
+    (["Johor"], (["johor"], "2024-03-31", "2024-03-31")),
+    (["Selangor", "2024"], (["selangor"], "2024-01-01", "2024-12-31")),
+    (["2024-02"], ([], "2024-02-01", "2024-02-29")),
+    (["Melaka", "2024-03-05"], (["melaka"], "2024-03-05", "2024-03-05")),
+    (["2024-03-01", "2024-03-10"], ([], "2024-03-01", "2024-03-10")),
+    (["2024-03-01", "to", "2024-03-10"], ([], "2024-03-01", "2024-03-10")),
+    (["Kuala", "Lumpur", "last", "7", "days"], (["kuala", "lumpur"], "2024-03-25", "2024-03-31")),
+    (["last", "1", "day"], ([], "2024-03-31", "2024-03-31")),
+])
+def test_parse_period(words, expected):
+    state_words, first, last, _ = parse_period(words, AS_OF)
+    #the state words are matched case-insensitively (see PrefixSums.find_state)
+    assert ([word.lower() for word in state_words], first, last) == (expected[0], np.datetime64(expected[1]), np.datetime64(expected[2]))
+
+def test_parse_period_rejects_a_bad_date():
+    with pytest.raises(ValueError):
+        parse_period(["2024-02-30"], AS_OF)
+
+def command_update(text, edited=False):
+    from telegram import Update
+    message = {"message_id": 1, "date": 0, "chat": {"id": 1, "type": "private"}, "text": text}
+    return Update.de_json({"update_id": 1, "edited_message" if edited else "message": message}, None)
+
+def test_edited_commands_are_not_answered_again():
+    #CommandHandler's own filters decide which kinds of update its command can come in
+    for handler in build_application("123456:test", holder=None).handlers[0]:
+        assert handler.filters.check_update(command_update("/donations johor"))
+        assert not handler.filters.check_update(command_update("/donations johor", edited=True))
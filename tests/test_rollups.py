@@ -0,0 +1,86 @@
+import asyncio
+import shutil
+
+import pandas as pd
+
+import fetch_data_latest_commit as fetch
+import rollups
+from synthetic import DONATIONS_COLUMNS, MockDataServer, make_granular_data, make_state_data, pointed_at, to_csv_bytes
+
+def write_days(data, last_day, path="data-darah-public/donations_state.csv"):
+    data[data["date"] <= last_day].to_csv(path, index=False)
+
+def append_day(data, day, path="data-darah-public/donations_state.csv"):
+    #as fetch_data_latest_commit.merge_csv does: the new day's rows at the end of the file
+    data[data["date"] == day].to_csv(path, mode="a", header=False, index=False)
+
+def rollup_tables():
+    return {grain: rollups.load_rollup("donations_state", grain).reset_index(drop=True)
+            for grain in ("monthly", "yearly", "latest")}
+
+def rebuilt_tables():
+    shutil.rmtree(rollups.ROLLUP_FOLDER)
+    rollups.update_all("data-darah-public")
+    return rollup_tables()
+
+def assert_same_tables(tables, expected):
+    for grain in expected:
+        pd.testing.assert_frame_equal(tables[grain], expected[grain], check_dtype=False)
+
+def test_appended_days_match_a_rebuild(workdir):
+    (workdir / "data-darah-public").mkdir()
+    data = make_state_data(DONATIONS_COLUMNS[:1], "2023-11-01", "2024-01-02", seed=1)
+    write_days(data, "2023-12-31")
+    rollups.update_all("data-darah-public")
+    for day in ["2024-01-01", "2024-01-02"]:
+        append_day(data, day)
+        assert rollups.update_rollups("donations_state", "data-darah-public/donations_state.csv") == data["date"].eq(day).sum()
+    assert rollups.as_of("donations_state") == pd.Timestamp("2024-01-02")
+    assert_same_tables(rollup_tables(), rebuilt_tables())
+
+def test_unchanged_csv_is_not_read_again(workdir):
+    (workdir / "data-darah-public").mkdir()
+    write_days(make_state_data(DONATIONS_COLUMNS[:1], "2024-01-01", "2024-01-31"), "2024-01-31")
+    rollups.update_all("data-darah-public")
+    assert rollups.update_rollups("donations_state", "data-darah-public/donations_state.csv") == 0
+
+def test_rewritten_csv_is_rebuilt(workdir):
+    (workdir / "data-darah-public").mkdir()
+    data = make_state_data(DONATIONS_COLUMNS[:1], "2024-01-01", "2024-02-29", seed=1)
+    write_days(data, "2024-02-28")
+    rollups.update_all("data-darah-public")
+    #a revised count for an old day, with a new day: the file is replaced rather than appended to
+    data.loc[0, "daily"] += 1000
+    write_days(data, "2024-02-29")
+    rollups.update_all("data-darah-public")
+    tables = rollup_tables()
+    assert tables["yearly"]["daily"].sum() == data["daily"].sum()
+    assert_same_tables(tables, rebuilt_tables())
+
+def revise_same_width(data):
+    #a count corrected upstream by one, which keeps every row (and the file) the same length
+    row = data.index[data["daily"].between(100, 998)][0]
+    data.loc[row, "daily"] += 1
+
+def test_invalidated_csv_is_rebuilt(workdir):
+    (workdir / "data-darah-public").mkdir()
+    data = make_state_data(DONATIONS_COLUMNS[:1], "2024-01-01", "2024-02-29", seed=1)
+    write_days(data, "2024-02-29")
+    rollups.update_all("data-darah-public")
+    revise_same_width(data)
+    write_days(data, "2024-02-29")
+    rollups.invalidate("donations_state")
+    rollups.update_all("data-darah-public")
+    assert rollup_tables()["yearly"]["daily"].sum() == data["daily"].sum()
+
+def test_sync_that_replaces_a_csv_rebuilds_its_rollups(workdir):
+    data = make_state_data(DONATIONS_COLUMNS[:1], "2024-01-01", "2024-02-29", seed=1)
+    with MockDataServer() as server, pointed_at(server, workdir):
+        make_granular_data(1000).to_parquet("granular.parquet")
+        server.files["/granular"] = open("granular.parquet", "rb").read()
+        server.publish({"donations_state.csv": to_csv_bytes(data)})
+        asyncio.run(fetch.sync())
+        revise_same_width(data)
+        server.publish({"donations_state.csv": to_csv_bytes(data)})
+        asyncio.run(fetch.sync())
+        assert rollup_tables()["yearly"]["daily"].sum() == data["daily"].sum()
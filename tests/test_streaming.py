@@ -0,0 +1,33 @@
+import granular
+import plots
+import streaming
+from retention import retention_tables
+from sharded import sharded_granular_aggregates
+from synthetic import run_streaming_job, write_granular_parquet
+
+BUDGET = 64 * 1024 * 1024  #small enough that the test data takes several partitions
+
+def in_memory_aggregates(path):
+    data = granular.load_granular(path)
+    return plots.donor_status_counts(data), plots.age_group_year_counts(data, 2019, 2024), retention_tables(data, [1, 3, 6])
+
+def test_streaming_matches_in_memory(workdir, monkeypatch, same_aggregates):
+    rows = write_granular_parquet("ds-data-granular", 100_000, row_group_size=20_000)
+    #pretend every visit takes far more memory, so this small file is spilled to several partitions
+    monkeypatch.setattr(streaming, "ROW_BYTES", 2000)
+    assert streaming.partition_count(rows, BUDGET) > 1
+    streamed = streaming.stream_granular_aggregates("ds-data-granular", 2019, 2024, memory_budget=BUDGET)
+    same_aggregates(in_memory_aggregates("ds-data-granular"), streamed)
+
+def test_sharded_matches_in_memory(workdir, same_aggregates):
+    write_granular_parquet("ds-data-granular", 100_000, row_group_size=20_000)
+    sharded = sharded_granular_aggregates("ds-data-granular", 2019, 2024, workers=2)
+    same_aggregates(in_memory_aggregates("ds-data-granular"), sharded)
+
+def test_streaming_stays_within_its_memory_budget(workdir, same_aggregates):
+    #as benchmark.py streaming checks it, at a size where the visits don't fit the budget
+    rows = write_granular_parquet("ds-data-granular", 500_000)
+    assert streaming.partition_count(rows, BUDGET) > 1
+    streamed, baseline_kb, peak_kb = run_streaming_job("ds-data-granular", BUDGET, "result.pickle")
+    assert (peak_kb - baseline_kb) * 1024 <= BUDGET
+    same_aggregates(in_memory_aggregates("ds-data-granular"), streamed)
@@ -0,0 +1,37 @@
+import asyncio
+import os
+
+import pytest
+
+import fetch_data_latest_commit as fetch
+from synthetic import DONATIONS_COLUMNS, MockDataServer, make_granular_data, make_state_data, pointed_at, to_csv_bytes
+
+@pytest.fixture
+def server(workdir, monkeypatch):
+    monkeypatch.setattr(fetch, "BACKOFF_SECONDS", 0)
+    with MockDataServer() as server, pointed_at(server, workdir):
+        yield server
+
+def publish(server):
+    data = make_state_data(DONATIONS_COLUMNS[:1], "2024-01-01", "2024-01-31")
+    server.publish({"donations_state.csv": to_csv_bytes(data)})
+
+def test_report_survives_a_failed_download(server):
+    publish(server)
+    #the parquet link is down, after the CSVs were merged
+    with pytest.raises(Exception, match="HTTP 404"):
+        asyncio.run(fetch.sync())
+    assert os.path.exists("data-darah-public/donations_state.csv")
+    assert not os.path.exists("data_fetched.txt")
+
+    make_granular_data(1000).to_parquet("granular.parquet")
+    with open("granular.parquet", "rb") as file:
+        server.files["/granular"] = file.read()
+    #the CSVs are unchanged now, but their report and the parquet are still due
+    assert asyncio.run(fetch.sync())
+    assert os.path.exists("data_fetched.txt")
+    assert os.path.exists("data-granular/ds-data-granular")
+
+    os.remove("data_fetched.txt")
+    assert not asyncio.run(fetch.sync())
+    assert not os.path.exists("data_fetched.txt")